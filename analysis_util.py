@@ -0,0 +1,422 @@
+import logging
+import time
+
+import numpy as np
+
+from lazy_import import LazyModule
+cv2=LazyModule('cv2')
+
+#THRESHOLDS
+#Saturation threshold to filter out too white areas in the dark conditions.
+SAT_THR=15
+#HSV eucledean distance threshold to filter out pxls that changed color
+HSV_DIST_THR=0.2
+#Fraction of changed pxls in order
+# to consider that the LED color is different from off state.
+CHANGED_COLOR_FRACTION_THR = 0.013
+#The difference between 'a' and 'b' channels in L*a*b* space
+# is lower for orange and higher for red.
+RED_ORANGE_a_b_diff_THR_NIGHT = 24
+RED_ORANGE_a_b_diff_THR_DAY = 35
+
+def red_orange_a_b_diff_thr(night):
+    return RED_ORANGE_a_b_diff_THR_NIGHT if night else RED_ORANGE_a_b_diff_THR_DAY
+
+"""Stacks frames into one array
+Args:
+frames: list of frames of size MxNx3 or an array of size TxMxNx3
+Returns:
+contiguous uint8 array of size TxMxNx3
+"""
+def frame_stack(frames):
+    if isinstance(frames, np.ndarray):
+        return np.ascontiguousarray(frames, dtype=np.uint8)
+    return np.stack(frames).astype(np.uint8, copy=False)
+
+"""Converts a stack of BGR frames to another color space with one cvtColor call
+Args:
+stack: array of size (...)xMxNx3 in BGR color space
+code: cv2 color conversion code
+Returns:
+array of the same size as stack in the requested color space
+"""
+def convert_stack(stack, code):
+    if stack.size == 0:
+        return stack.copy()
+    flat=np.ascontiguousarray(stack).reshape(-1, stack.shape[-2], 3)
+    return cv2.cvtColor(flat, code).reshape(stack.shape)
+
+"""Counts eucledean distance between frames and off-frame, broadcast over leading axes
+Args:
+off_hsv: off-frame of size MxNx3 in HSV color space
+leds_hsv: frame(s) of size (...)xMxNx3 in HSV color space
+Returns:
+eucledean distance (float32 array of size (...)xMxN) in HSV space between each frame and off-frame
+"""
+def hsv_distance(off_hsv, leds_hsv):
+    off=np.asarray(off_hsv, dtype=np.float32) / np.float32(255.0)
+    led=np.asarray(leds_hsv, dtype=np.float32) / np.float32(255.0)
+    two_pi=np.float32(2*np.pi)
+
+    off_vs=off[...,2]*off[...,1]
+    led_vs=led[...,2]*led[...,1]
+    dx=off_vs*np.cos(two_pi*off[...,0]) - led_vs*np.cos(two_pi*led[...,0])
+    dy=off_vs*np.sin(two_pi*off[...,0]) - led_vs*np.sin(two_pi*led[...,0])
+    dz=off[...,2] - led[...,2]
+    return np.sqrt(dx*dx + dy*dy + dz*dz)
+
+"""Computes per-frame color statistics for a whole capture at once
+Args:
+frames: list of frames of size MxNx3 or an array of size TxMxNx3 (BGR)
+night: 1 or 0. Information about environment
+off: a frame of size MxNx3 (BGR)
+Returns:
+dict with arrays of length T:
+    'fractions': fraction of pxls that changed color
+    'colors': 1 if the frame is considered ON, 0 otherwise
+    'a_means', 'b_means': mean 'a' and 'b' of changed pxls in L*a*b* (nan for OFF frames)
+"""
+def frame_stack_statistics(frames, night, off):
+    stack=frame_stack(frames)
+    n_frames=stack.shape[0]
+    if n_frames == 0:
+        empty=np.zeros(0)
+        return {'fractions': empty, 'colors': empty.astype(np.uint8), 'a_means': empty, 'b_means': empty}
+    n_pxls=stack.shape[1]*stack.shape[2]
+
+    off_hsv=cv2.cvtColor(off,cv2.COLOR_BGR2HSV)
+    leds_hsv=convert_stack(stack, cv2.COLOR_BGR2HSV)
+
+    #mask to filter pxls that changed color
+    mask=hsv_distance(off_hsv, leds_hsv) >= HSV_DIST_THR
+    #mask to filter out "too white" pxls
+    if night:
+        mask&=leds_hsv[...,1] > SAT_THR
+
+    #Masked out pxls become [0,0,0]; changed pxls with a zero channel are dropped as well
+    masked=stack.reshape(n_frames, n_pxls, 3) * mask.reshape(n_frames, n_pxls, 1)
+    zero=masked == 0
+    keep=~zero.any(axis=2)
+    #np.delete(pxls, np.where(pxls==[0,0,0]), axis=0) also drops the pxls whose
+    #index equals a channel index that contained a zero - kept for identical decisions
+    channel_has_zero=zero.any(axis=1)
+    for channel in range(min(3, n_pxls)):
+        keep[:, channel]&=~channel_has_zero[:, channel]
+
+    counts=np.count_nonzero(keep, axis=1)
+    fractions=counts/n_pxls
+    colors=(fractions > CHANGED_COLOR_FRACTION_THR).astype(np.uint8)
+
+    #find 'a' channel mean and 'b' channel mean of changed pxls
+    lab=convert_stack(stack, cv2.COLOR_BGR2Lab).reshape(n_frames, n_pxls, 3)
+    weights=keep.astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        a_means=np.einsum('tp,tp->t', weights, lab[...,1].astype(np.float64))/counts
+        b_means=np.einsum('tp,tp->t', weights, lab[...,2].astype(np.float64))/counts
+    a_means[colors == 0]=np.nan
+    b_means[colors == 0]=np.nan
+    return {'fractions': fractions, 'colors': colors, 'a_means': a_means, 'b_means': b_means}
+
+"""Counts the number of color switches
+Args:
+colors: sequence of 1 (ON) and 0 (OFF) per frame
+Returns:
+length of the sequence reduced from form 11110000111110000111 to form 10101
+"""
+def count_switches(colors):
+    colors=np.asarray(colors)
+    if colors.size == 0:
+        return 0
+    return 1 + int(np.count_nonzero(colors[1:] != colors[:-1]))
+
+"""Decides the LED color from the a/b means of the ON frames
+Args:
+a_means_avg: average of 'a' channel means over ON frames
+b_means_avg: average of 'b' channel means over ON frames
+night: 1 or 0
+Returns:
+str 'green', 'orange' or 'red'
+"""
+def classify_color(a_means_avg, b_means_avg, night):
+    #green is usually closer to green on the scale green-red,
+    #since the middle is 128, if the 'a' channel is lower than 128,
+    # the LED is green
+    if a_means_avg < 128:
+        return 'green'
+    #The red and orange are too close to each other,
+    # but orange has less difference between 'a' and 'b' channel:
+    if abs(b_means_avg - a_means_avg) < red_orange_a_b_diff_thr(night):
+        return 'orange'
+    return 'red'
+
+"""Decides LED behavior from the number of color switches
+Args:
+number_of_switches: number of ON/OFF runs during a 5 s capture
+color: detected color
+Returns:
+str 'CONSTANT', 'FLASH_FAST' or 'FLASH_SLOW'
+"""
+def classify_switches(number_of_switches, color):
+    #constant behavior is either on or off
+    if number_of_switches < 4 or color == 'off':
+        return 'CONSTANT'
+    #during 5 seconds with 30 fps we get approx 150 frames (in reality 166-168)
+    #When FLASH_SLOW there are approx 6 - 7 changes,
+    #when FLASH_FAST - around 22 - 23 changes.
+    if number_of_switches < 13:
+        return 'FLASH_SLOW'
+    return 'FLASH_FAST'
+
+"""Decides LED color and behavior from per-frame statistics
+Args:
+stats: dict returned by frame_stack_statistics
+night: 1 or 0
+Returns:
+(color, behavior): color is the str 'green', 'orange', 'off' or 'red'
+behavior: str 'CONSTANT', 'FLASH_FAST' or 'FLASH_SLOW'
+"""
+def classify_statistics(stats, night):
+    colors=stats['colors']
+    color=classify_stats_color(stats, night)
+    #the number of times the color changed during the test time
+    number_of_switches=count_switches(colors)
+    behavior=classify_switches(number_of_switches, color)
+    logging.debug('switches under 5s: ' + str(number_of_switches))
+    return (color, behavior)
+
+"""Decides LED color from per-frame statistics
+Args:
+stats: dict returned by frame_stack_statistics
+night: 1 or 0
+Returns:
+str 'green', 'orange', 'off' or 'red'
+"""
+def classify_stats_color(stats, night):
+    color='off'
+    colors=stats['colors']
+    if colors.size:
+        logging.debug('max fraction: ' + str(np.max(stats['fractions'])) + ' min fraction: ' + str(np.min(stats['fractions'])))
+
+    #number of frames that changed the color
+    non_off_frames=np.count_nonzero(colors)
+    logging.debug('color frames: ' + str(non_off_frames))
+
+    #find channel average over all ON frames
+    if non_off_frames > 3:
+        on=colors == 1
+        a_means_avg=np.mean(stats['a_means'][on])
+        b_means_avg=np.mean(stats['b_means'][on])
+        logging.debug('a_means avg: ' + str(a_means_avg))
+        logging.debug('b_means avg: ' + str(b_means_avg))
+        color=classify_color(a_means_avg, b_means_avg, night)
+    return color
+
+#ON/OFF cycles per second of the blinking behaviors
+#(approx 6 - 7 and 22 - 23 switches during 5 seconds)
+FLASH_SLOW_FREQUENCY=0.67
+FLASH_FAST_FREQUENCY=2.3
+#Blink frequency between FLASH_SLOW and FLASH_FAST (geometric mean, so both are equally far in log scale)
+FLASH_FREQUENCY_THR=float(np.sqrt(FLASH_SLOW_FREQUENCY*FLASH_FAST_FREQUENCY))
+#Time a FLASH_SLOW LED stays in one state, and the longest such time with some tolerance for the duty cycle
+FLASH_SLOW_HALF_PERIOD=1/FLASH_SLOW_FREQUENCY/2
+FLASH_SLOW_MAX_HALF_PERIOD=1.5*FLASH_SLOW_HALF_PERIOD
+#Minimum confidence of the timestamp based classification to stop the capture
+BLINK_CONFIDENCE_THR=0.8
+
+"""Finds the times when the LED switched between ON and OFF
+Args:
+colors: 1 (ON) or 0 (OFF) per frame
+timestamps: capture time of every frame in seconds
+Returns:
+array of switch times, in the middle between the two frames around each switch
+"""
+def switch_times(colors, timestamps):
+    colors=np.asarray(colors)
+    timestamps=np.asarray(timestamps, dtype=np.float64)
+    changed=np.flatnonzero(colors[1:] != colors[:-1])
+    return (timestamps[changed] + timestamps[changed+1])/2
+
+"""Estimates blink frequency and duty cycle from capture timestamps.
+Works with any frame rate, dropped frames and short windows: the frequency is fitted
+to the measured times between switches, instead of counting switches in a fixed window.
+Args:
+colors: 1 (ON) or 0 (OFF) per frame
+timestamps: capture time of every frame in seconds
+Returns:
+dict:
+    'frequency': ON/OFF cycles per second, 0 for a constant LED
+    'duty_cycle': fraction of the time the LED was ON
+    'switches': number of switches
+    'span': analyzed time in seconds
+    'behavior': 'CONSTANT', 'FLASH_SLOW' or 'FLASH_FAST'
+    'confidence': 0..1, how certain the behavior is given the window length and regularity
+"""
+def estimate_blink(colors, timestamps):
+    colors=np.asarray(colors)
+    timestamps=np.asarray(timestamps, dtype=np.float64)
+    result={'frequency': 0.0, 'duty_cycle': 0.0, 'switches': 0, 'span': 0.0, 'behavior': 'CONSTANT', 'confidence': 0.0}
+    if colors.size < 2:
+        return result
+    #every frame lasts until the next one, the last one as long as a typical frame
+    durations=np.diff(timestamps)
+    durations=np.append(durations, np.median(durations))
+    span=float(durations.sum())
+    edges=switch_times(colors, timestamps)
+    result.update(span=span, switches=len(edges), duty_cycle=float(np.sum(durations[colors == 1])/span))
+
+    #one switch at most: the LED changed its state at the beginning of the capture and stayed in it
+    if len(edges) < 2:
+        longest=max(edges[0]-timestamps[0], timestamps[-1]-edges[0]) if len(edges) else span
+        #a FLASH_SLOW LED would have switched after half of its period
+        result['confidence']=float(np.clip((longest - FLASH_SLOW_HALF_PERIOD)/FLASH_SLOW_HALF_PERIOD, 0, 1))
+        return result
+
+    half_periods=np.diff(edges)
+    #full periods don't depend on the duty cycle
+    periods=edges[2:]-edges[:-2]
+    period=float(np.median(periods)) if len(periods) else 2*float(np.median(half_periods))
+    #a single pulse longer than FLASH_SLOW can be is a change of the state, not blinking
+    if np.max(half_periods) > FLASH_SLOW_MAX_HALF_PERIOD:
+        result['confidence']=0.5
+        return result
+
+    frequency=1/period
+    behavior='FLASH_SLOW' if frequency < FLASH_FREQUENCY_THR else 'FLASH_FAST'
+    #distance from the decision threshold in log scale, 1 at the nominal frequency
+    margin=np.clip(abs(np.log(frequency/FLASH_FREQUENCY_THR))/np.log(FLASH_FAST_FREQUENCY/FLASH_FREQUENCY_THR), 0, 1)
+    #regularity of the measured periods
+    regularity=np.clip(1 - np.std(periods)/np.mean(periods), 0, 1) if len(periods) > 1 else 1.0
+    #the estimate needs at least one full period
+    measured=min(1.0, len(half_periods)/2)
+    result.update(frequency=float(frequency), behavior=behavior, confidence=float(margin*regularity*measured))
+    return result
+
+"""Decides LED color and behavior from per-frame statistics and capture timestamps
+Args:
+stats: dict returned by frame_stack_statistics
+timestamps: capture time of every frame of stats
+night: 1 or 0
+Returns:
+(color, behavior, blink): color and behavior as classify_statistics, blink is the dict of estimate_blink
+"""
+def classify_statistics_timed(stats, timestamps, night):
+    color=classify_stats_color(stats, night)
+    blink=estimate_blink(stats['colors'], timestamps)
+    behavior='CONSTANT' if color == 'off' else blink['behavior']
+    logging.debug('blink frequency: {0:.2f} Hz duty cycle: {1:.2f} confidence: {2:.2f} over {3:.2f} s'.format(
+        blink['frequency'], blink['duty_cycle'], blink['confidence'], blink['span']))
+    return (color, behavior, blink)
+
+BLINK_CLASSIFIERS=['switches', 'timestamps']
+
+#Minimum time in seconds an unchanged ON/OFF state has to last to be considered CONSTANT.
+#FLASH_SLOW switches approx every 0.75 s, so two of its half periods fit in this window.
+CONSTANT_SETTLE_TIME=2.0
+#Minimum distance of the a/b averages from the color decision thresholds for the color to be settled
+COLOR_SETTLE_MARGIN=4
+#Number of switches after which the behavior can only be FLASH_FAST
+FLASH_FAST_SWITCHES=13
+
+'''
+Analyzes frames one at a time while they are being captured.
+Produces the same decision as whichBehavior over the same frames, but
+can tell when the decision is settled, so that the capture can be stopped early.
+Args:
+night: 1 or 0. Information about environment
+off: a frame of size MxNx3 (same as the size of each fed frame)
+classifier: 'switches' - count switches as whichBehavior does,
+    'timestamps' - fit the blink frequency to the capture timestamps (estimate_blink),
+    which settles within 1 - 2 s
+'''
+class StreamingBehaviorAnalyzer:
+    def __init__(self, night, off, classifier='switches'):
+        if classifier not in BLINK_CLASSIFIERS: raise ValueError('Unknown classifier ' + classifier)
+        self.night=night
+        self.off=off
+        self.classifier=classifier
+        self.timestamps=[]
+        self.start_time=None
+        self.last_time=None
+        self.fractions=[]
+        self.colors=[]
+        self.a_means=[]
+        self.b_means=[]
+        self.switches=0
+        self.settled_at=None
+
+    '''
+    Adds a frame
+    Args:
+    frame: a frame of size MxNx3
+    timestamp: capture time in seconds (time.time() if not given)
+    Returns:
+    True if the classification is settled and the capture can be stopped
+    '''
+    def feed(self, frame, timestamp=None):
+        timestamp=time.time() if timestamp is None else timestamp
+        stats=frame_stack_statistics(frame[np.newaxis], self.night, self.off)
+        color=int(stats['colors'][0])
+        if self.start_time is None:
+            self.start_time=timestamp
+        #the last fed frame is not analyzed (same as whichBehavior), so a switch is
+        #only counted once the frame before the new one is known
+        if len(self.colors) > 1 and self.colors[-1] != self.colors[-2]:
+            self.switches+=1
+        self.last_time=timestamp
+        self.timestamps.append(timestamp)
+        self.fractions.append(stats['fractions'][0])
+        self.colors.append(color)
+        self.a_means.append(stats['a_means'][0])
+        self.b_means.append(stats['b_means'][0])
+        if self.settled_at is None and self.is_settled():
+            self.settled_at=timestamp
+        return self.settled_at is not None
+
+    def statistics(self):
+        return {'fractions': np.array(self.fractions[:-1]),
+                'colors': np.array(self.colors[:-1], dtype=np.uint8),
+                'a_means': np.array(self.a_means[:-1]),
+                'b_means': np.array(self.b_means[:-1])}
+
+    def _is_color_settled(self, colors):
+        on=colors == 1
+        if np.count_nonzero(on) <= 3:
+            return False
+        a_avg=np.mean(np.array(self.a_means[:-1])[on])
+        b_avg=np.mean(np.array(self.b_means[:-1])[on])
+        if abs(a_avg - 128) < COLOR_SETTLE_MARGIN:
+            return False
+        return a_avg < 128 or abs(abs(b_avg - a_avg) - red_orange_a_b_diff_thr(self.night)) >= COLOR_SETTLE_MARGIN
+
+    '''
+    Checks whether more frames can still change the classification
+    Returns:
+    True if the LED has been in one state for CONSTANT_SETTLE_TIME (and its color is clear),
+    or it has switched often enough to be FLASH_FAST
+    '''
+    def is_settled(self):
+        colors=np.array(self.colors[:-1], dtype=np.uint8)
+        if colors.size == 0:
+            return False
+        if self.classifier == 'timestamps':
+            blink=estimate_blink(colors, self.timestamps[:-1])
+            if blink['confidence'] < BLINK_CONFIDENCE_THR:
+                return False
+            return (blink['switches'] == 0 and colors[0] == 0) or self._is_color_settled(colors)
+        if self.switches == 0 and self.last_time - self.start_time >= CONSTANT_SETTLE_TIME:
+            #constant off needs no color, constant on needs a clear color
+            return colors[0] == 0 or self._is_color_settled(colors)
+        if self.switches + 1 >= FLASH_FAST_SWITCHES:
+            return self._is_color_settled(colors)
+        return False
+
+    '''
+    Returns:
+    (color, behavior) over the frames fed so far, as whichBehavior does
+    '''
+    def result(self):
+        if self.settled_at is not None:
+            logging.debug('behavior settled after {0:.2f} s, {1} frames'.format(self.settled_at - self.start_time, len(self.colors)))
+        if self.classifier == 'timestamps':
+            return classify_statistics_timed(self.statistics(), self.timestamps[:-1], self.night)[:2]
+        return classify_statistics(self.statistics(), self.night)
@@ -0,0 +1,141 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+
+import numpy as np
+
+import timing
+from lazy_import import LazyModule
+cv2=LazyModule('cv2')
+
+FRAME_FORMATS=['jpg', 'npz', 'video']
+#frame rate written into videos of failed captures
+VIDEO_FPS=30
+
+'''
+Writes test artifacts (images and frames of failed checks) on worker threads,
+so that encoding and disk I/O don't delay the test.
+Pending writes are bounded: when the queue is full, the test waits for the disk
+instead of growing the memory without limit.
+Args:
+log_dir: folder of the artifacts
+frame_format: how frames of a failed check are stored:
+    'jpg' - one JPEG per frame (<prefix>_f_<i>.jpg),
+    'npz' - one compressed <prefix>.npz with 'frames' (T,h,w,3) and 'timestamps',
+    'video' - one MJPG <prefix>.avi and <prefix>_timestamps.txt
+workers: number of writer threads
+max_pending: maximum number of queued writes
+'''
+class ArtifactWriter:
+    def __init__(self, log_dir, frame_format='jpg', workers=2, max_pending=16):
+        if frame_format not in FRAME_FORMATS: raise ValueError('Unknown frame format ' + frame_format)
+        self.log_dir=log_dir
+        self.frame_format=frame_format
+        self.queue=queue.Queue(max_pending)
+        self.errors=0
+        self.closed=False
+        self.threads=[threading.Thread(target=self._work, name='artifact-writer', daemon=True) for _ in range(workers)]
+        for thread in self.threads: thread.start()
+        #pending artifacts are still written when the test exits early
+        atexit.register(self.close)
+
+    def _work(self):
+        while True:
+            job=self.queue.get()
+            try:
+                if job is None: return
+                function, args = job
+                with timing.span('artifacts.write'):
+                    function(*args)
+            except Exception as e:
+                self.errors+=1
+                logging.error('Failed to write an artifact: {0!r}'.format(e))
+            finally:
+                self.queue.task_done()
+
+    def _submit(self, function, *args):
+        if self.closed: raise RuntimeError('ArtifactWriter is closed')
+        self.queue.put((function, args))
+
+    '''Writes an image, the image is copied so the caller can keep drawing on it'''
+    def write_image(self, name, img):
+        self._submit(cv2.imwrite, os.path.join(self.log_dir, name), img.copy())
+
+    '''
+    Writes the frames of a failed check, the frames must not be modified afterwards
+    Args:
+    prefix: file name prefix
+    frames: list of equally sized BGR frames
+    timestamps: optional capture times of the frames
+    '''
+    def write_frames(self, prefix, frames, timestamps=None):
+        if len(frames) == 0: return
+        self._submit(write_frames, os.path.join(self.log_dir, prefix), frames, self.frame_format, timestamps)
+
+    '''Waits until everything submitted so far is written'''
+    def flush(self):
+        self.queue.join()
+
+    '''Writes the pending artifacts and stops the workers'''
+    def close(self):
+        if self.closed: return
+        self.closed=True
+        atexit.unregister(self.close)
+        for _ in self.threads: self.queue.put(None)
+        for thread in self.threads: thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+'''
+Writes the frames of a failed check in one of FRAME_FORMATS (see ArtifactWriter)
+Args:
+path: file path without extension
+'''
+def write_frames(path, frames, frame_format='jpg', timestamps=None):
+    if frame_format == 'jpg':
+        write_jpgs(path, frames)
+    elif frame_format == 'npz':
+        write_npz(path, frames, timestamps)
+    else:
+        write_video(path, frames, timestamps)
+
+def write_jpgs(path, frames):
+    for i in range(0, len(frames)):
+        cv2.imwrite(path + '_f_' + str(i) + '.jpg', frames[i])
+
+def write_npz(path, frames, timestamps=None):
+    timestamps=np.asarray(timestamps if timestamps is not None else [], dtype=np.float64)
+    np.savez_compressed(path + '.npz', frames=np.stack(frames), timestamps=timestamps)
+
+def write_video(path, frames, timestamps=None):
+    h, w = frames[0].shape[:2]
+    writer=cv2.VideoWriter(path + '.avi', cv2.VideoWriter_fourcc(*'MJPG'), VIDEO_FPS, (w, h))
+    try:
+        for frame in frames:
+            writer.write(frame)
+    finally:
+        writer.release()
+    if timestamps is not None:
+        np.savetxt(path + '_timestamps.txt', np.asarray(timestamps), fmt='%.6f')
+
+'''Reads frames stored by ArtifactWriter in any format, returns (frames, timestamps)'''
+def read_frames(path):
+    if path.endswith('.npz'):
+        with np.load(path) as stored:
+            return list(stored['frames']), list(stored['timestamps'])
+    capture=cv2.VideoCapture(path)
+    frames=[]
+    while True:
+        ok, frame = capture.read()
+        if not ok: break
+        frames.append(frame)
+    capture.release()
+    timestamps_path=path[:-len('.avi')] + '_timestamps.txt'
+    timestamps=list(np.loadtxt(timestamps_path, ndmin=1)) if os.path.exists(timestamps_path) else []
+    return frames, timestamps
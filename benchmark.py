@@ -0,0 +1,174 @@
+import argparse
+import json
+import logging
+import statistics
+import sys
+import time
+
+import numpy as np
+
+import analysis_util as au
+import gateway_util as gu
+import led_testing as lt
+import models
+import synthetic as sy
+
+CONFIG_SIZES=[25, 50, 100, 200, 400, 800]
+
+'''Runs function repeat times and returns the median duration in seconds and the last result'''
+def timed(function, repeat):
+    durations=[]
+    for _ in range(repeat):
+        start=time.perf_counter()
+        result=function()
+        durations.append(time.perf_counter()-start)
+    return statistics.median(durations), result
+
+'''
+Generates the synthetic LED clips
+Returns:
+list of (name, frames, off, timestamps, night, expected)
+'''
+def behavior_clips(seeds=2, roi=(45, 45)):
+    clips=[]
+    for night in (0, 1):
+        for color in [None] + sy.COLORS:
+            for behavior, frequency in sy.BEHAVIOR_FREQUENCIES.items():
+                if color is None and frequency: continue
+                for seed in range(seeds):
+                    frames, off, timestamps = sy.led_clip(color, frequency, roi=roi, night=night, phase=seed*0.2, seed=seed)
+                    name='{0}_{1}_{2}_{3}'.format('night' if night else 'day', color or 'off', behavior, seed)
+                    clips.append((name, frames, off, timestamps, night, sy.expected_behavior(color, frequency)))
+    return clips
+
+'''
+Measures whichBehavior and the streaming analyzer on synthetic clips
+Returns:
+dict with frames/s, ms per LED, accuracy and the frames the streaming analyzer needed
+with both blink classifiers
+'''
+def bench_behavior(repeat, seeds=2, roi=(45, 45)):
+    clips=behavior_clips(seeds, roi)
+    frames_count=sum(len(clip[1]) for clip in clips)
+
+    def run_batch():
+        return [lt.whichBehavior(frames, night, off, name) for name, frames, off, _, night, _ in clips]
+    batch_time, batch_results = timed(run_batch, repeat)
+
+    wrong=[clip[0] for clip, result in zip(clips, batch_results) if result != clip[-1]]
+    report={'clips': len(clips), 'roi': list(roi), 'frames': frames_count,
+        'batch_frames_per_s': frames_count/batch_time, 'batch_ms_per_led': batch_time/len(clips)*1000,
+        'batch_accuracy': 1-len(wrong)/len(clips), 'batch_wrong': wrong}
+
+    for classifier, prefix in (('switches', 'streaming'), ('timestamps', 'timestamps')):
+        def run_streaming():
+            results=[]
+            for name, frames, off, timestamps, night, _ in clips:
+                analyzer=au.StreamingBehaviorAnalyzer(night, off, classifier)
+                fed=0
+                for frame, timestamp in zip(frames, timestamps):
+                    fed+=1
+                    if analyzer.feed(frame, timestamp): break
+                results.append((analyzer.result(), fed))
+            return results
+        streaming_time, streaming_results = timed(run_streaming, repeat)
+        streaming_wrong=[clip[0] for clip, (result, _) in zip(clips, streaming_results) if result != clip[-1]]
+        report[prefix + '_ms_per_led']=streaming_time/len(clips)*1000
+        report[prefix + '_frames_fraction']=sum(fed for _, fed in streaming_results)/frames_count
+        report[prefix + '_accuracy']=1-len(streaming_wrong)/len(clips)
+        report[prefix + '_wrong']=streaming_wrong
+    return report
+
+'''Measures sort_leds and box rescaling on synthetic detections of horizontal and vertical displays'''
+def bench_sort_leds(repeat, count=200):
+    cases=[sy.led_detections(vertical=i % 2 == 1, seed=i) for i in range(count)]
+    def run():
+        return [models.sort_leds(detections).rescaled(640, 640).classes.tolist() for detections, _ in cases]
+    duration, results = timed(run, repeat)
+    correct=sum(list(result) == list(order) for result, (_, order) in zip(results, cases))
+    return {'calls': count, 'us_per_call': duration/count*1e6, 'accuracy': correct/count}
+
+'''Measures the hw config parser on configs of growing size'''
+def bench_config(repeat, sizes=CONFIG_SIZES):
+    results=[]
+    for size in sizes:
+        config, expected = sy.hw_config(size, seed=size)
+        duration, mapping = timed(lambda: gu.get_mapping_and_uci_command_to_change_config(config)[0], repeat)
+        got=list(zip(mapping['objects'], mapping['states'], mapping['LED'], mapping['LED_color'], mapping['LED_behavior']))
+        results.append({'functions': size, 'lines': len(config), 'ms': duration*1000,
+            'correct': got == [tuple(record) for record in expected]})
+    #exponent of the parse time over the config size, 1 is linear
+    exponent=float(np.polyfit(np.log([r['functions'] for r in results]), np.log([r['ms'] for r in results]), 1)[0])
+    return {'sizes': results, 'scaling_exponent': exponent, 'accuracy': float(np.mean([r['correct'] for r in results]))}
+
+#timing metrics compared with a baseline, lower is better
+TIMING_METRICS=[('behavior', 'batch_ms_per_led'), ('behavior', 'streaming_ms_per_led'), ('behavior', 'timestamps_ms_per_led'),
+    ('sort_leds', 'us_per_call'), ('config', 'scaling_exponent')]
+ACCURACY_METRICS=[('behavior', 'batch_accuracy'), ('behavior', 'streaming_accuracy'), ('behavior', 'timestamps_accuracy'),
+    ('sort_leds', 'accuracy'), ('config', 'accuracy')]
+
+'''
+Compares a report with a baseline report
+Args:
+tolerance: allowed relative slowdown
+Returns:
+list of regression descriptions, empty if there are none
+'''
+def find_regressions(report, baseline, tolerance):
+    regressions=[]
+    for suite, metric in ACCURACY_METRICS:
+        if suite in report and report[suite][metric] < 1.0:
+            regressions.append('{0}.{1} is {2:.3f}'.format(suite, metric, report[suite][metric]))
+    for suite, metric in TIMING_METRICS:
+        if metric not in report.get(suite, {}) or metric not in baseline.get(suite, {}): continue
+        value, reference = report[suite][metric], baseline[suite][metric]
+        if value > reference*(1+tolerance):
+            regressions.append('{0}.{1}: {2:.3f} vs baseline {3:.3f}'.format(suite, metric, value, reference))
+    return regressions
+
+def main(argv):
+    arg_parser=argparse.ArgumentParser(description='benchmark the LED analysis on synthetic data, no hardware needed')
+    arg_parser.add_argument('-s', '--suite', action='append', choices=['behavior','sort_leds','config'], help='suites to run (default all)')
+    arg_parser.add_argument('-r', '--repeat', type=int, default=3, help='repetitions, the median is reported (default 3)')
+    arg_parser.add_argument('--seeds', type=int, default=2, help='clips per color, behavior and day/night (default 2)')
+    arg_parser.add_argument('--roi', type=int, nargs=2, default=[45, 45], metavar=('H','W'), help='clip size (default 45 45)')
+    arg_parser.add_argument('-o', '--output', help='write the report as JSON')
+    arg_parser.add_argument('-b', '--baseline', help='JSON report to compare with, exits with 1 on a regression')
+    arg_parser.add_argument('-t', '--tolerance', type=float, default=0.2, help='allowed relative slowdown (default 0.2)')
+    args=arg_parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    suites=args.suite or ['behavior', 'sort_leds', 'config']
+    report={}
+    if 'behavior' in suites:
+        report['behavior']=r=bench_behavior(args.repeat, args.seeds, tuple(args.roi))
+        logging.info('behavior: {0} clips, whichBehavior {1:.0f} frames/s, {2:.1f} ms per LED, accuracy {3:.1%}'.format(
+            r['clips'], r['batch_frames_per_s'], r['batch_ms_per_led'], r['batch_accuracy']))
+        logging.info('          streaming {0:.1f} ms per LED using {1:.0%} of the frames, accuracy {2:.1%}'.format(
+            r['streaming_ms_per_led'], r['streaming_frames_fraction'], r['streaming_accuracy']))
+        logging.info('          timestamps {0:.1f} ms per LED using {1:.0%} of the frames, accuracy {2:.1%}'.format(
+            r['timestamps_ms_per_led'], r['timestamps_frames_fraction'], r['timestamps_accuracy']))
+    if 'sort_leds' in suites:
+        report['sort_leds']=r=bench_sort_leds(args.repeat)
+        logging.info('sort_leds: {0:.1f} us per call, accuracy {1:.1%}'.format(r['us_per_call'], r['accuracy']))
+    if 'config' in suites:
+        report['config']=r=bench_config(args.repeat)
+        for size in r['sizes']:
+            logging.info('config: {0:4d} functions {1:5d} lines {2:8.2f} ms {3}'.format(
+                size['functions'], size['lines'], size['ms'], 'ok' if size['correct'] else 'WRONG'))
+        logging.info('config: scaling exponent {0:.2f}'.format(r['scaling_exponent']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    baseline={}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline=json.load(f)
+    regressions=find_regressions(report, baseline, args.tolerance)
+    for regression in regressions:
+        logging.error('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,101 @@
+import json
+import os
+import re
+
+import numpy as np
+
+import models
+import paths
+from lazy_import import LazyModule
+cv2=LazyModule('cv2')
+
+#Minimum correlation between the reference and the current image of the fixture
+MIN_SIMILARITY=0.9
+#Maximum shift in pixels between the reference and the current image of the fixture
+MAX_SHIFT=2.0
+
+'''
+Compares the current image of the fixture with its reference image
+Args:
+reference: reference image (BGR)
+img: current image of the same size (BGR)
+Returns:
+(similarity, shift): correlation of the blurred grayscale images (1 - identical)
+and the shift between them in pixels
+'''
+def image_similarity(reference, img):
+    if reference.shape != img.shape:
+        return 0.0, float('inf')
+    def prepare(image):
+        gray=cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        return cv2.GaussianBlur(gray, (5,5), 0)
+    reference, img = prepare(reference), prepare(img)
+    (dx, dy), _ = cv2.phaseCorrelate(reference, img, cv2.createHanningWindow(reference.shape[::-1], cv2.CV_32F))
+    a=reference-reference.mean()
+    b=img-img.mean()
+    denominator=np.sqrt((a*a).sum()*(b*b).sum())
+    similarity=float((a*b).sum()/denominator) if denominator > 0 else 0.0
+    return similarity, float(np.hypot(dx, dy))
+
+'''
+Checks whether the fixture has not moved since the reference image was taken
+'''
+def is_fixture_unchanged(reference, img, min_similarity=MIN_SIMILARITY, max_shift=MAX_SHIFT):
+    similarity, shift = image_similarity(reference, img)
+    return similarity >= min_similarity and shift <= max_shift
+
+'''
+Stores detected LED geometry per camera and gateway model, so that
+the detectors only run when the fixture has moved
+Args:
+root: folder of the calibrations
+'''
+class CalibrationStore:
+    def __init__(self, root=os.path.join(paths.CACHE_DIR, 'calibration')):
+        self.root=root
+
+    def _path(self, camera_hostname, gateway_model):
+        key=re.sub(r'[^A-Za-z0-9_.-]', '_', camera_hostname + '_' + gateway_model)
+        return os.path.join(self.root, key)
+
+    def has(self, camera_hostname, gateway_model):
+        return os.path.exists(self._path(camera_hostname, gateway_model) + '.json')
+
+    '''
+    Returns:
+    dict with 'leds' (same format as DisplayLedsSchemeModel.detect), 'isOrderReversed'
+    and 'reference' image, or None if there is no calibration
+    '''
+    def load(self, camera_hostname, gateway_model):
+        path=self._path(camera_hostname, gateway_model)
+        if not os.path.exists(path + '.json'):
+            return None
+        with open(path + '.json') as f:
+            stored=json.load(f)
+        reference=cv2.imread(path + '.png')
+        if reference is None:
+            return None
+        return {'leds': models.LedDetections.from_list(stored['leds']), 'isOrderReversed': stored['isOrderReversed'], 'reference': reference}
+
+    def save(self, camera_hostname, gateway_model, leds, isOrderReversed, reference):
+        os.makedirs(self.root, exist_ok=True)
+        path=self._path(camera_hostname, gateway_model)
+        cv2.imwrite(path + '.png', reference)
+        stored={'camera': camera_hostname, 'gateway_model': gateway_model, 'isOrderReversed': bool(isOrderReversed),
+            'leds': [{'class': int(led['class']), 'box': [float(c) for c in led['box']], 'score': float(led['score'])} for led in leds]}
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump(stored, f, indent=2)
+        os.replace(path + '.json.tmp', path + '.json')
+
+    '''
+    Returns the stored calibration if the fixture didn't move
+    Args:
+    img: current image of the fixture
+    Returns:
+    (leds, isOrderReversed) or None when there is no calibration or the fixture has drifted
+    '''
+    def validate(self, camera_hostname, gateway_model, img):
+        stored=self.load(camera_hostname, gateway_model)
+        if stored is None or not is_fixture_unchanged(stored['reference'], img):
+            return None
+        return stored['leds'], stored['isOrderReversed']
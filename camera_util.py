@@ -1,11 +1,23 @@
 import requests
 from requests.auth import HTTPBasicAuth  
-import cv2
+from requests.adapters import HTTPAdapter
+import os
 import time
+import threading
+import collections
+import logging
+import concurrent.futures
+
+import numpy as np
+
+import timing
+from lazy_import import LazyModule
+cv2=LazyModule('cv2')
 
 def get_camera_img_url(camera_hostname):
     return 'http://'+camera_hostname+'/img/snapshot.cgi?size=4'
 
+@timing.timed('camera.connect')
 def isConnected(camera_hostname):
     url=get_camera_img_url(camera_hostname)
     cap=cv2.VideoCapture(url)
@@ -18,22 +30,129 @@ tuple (ok, filter): ok: request status, filter: filter value (0 - filter is off,
 '''
 def isInfraredOn(camera_hostname):
     URL='http://'+camera_hostname+'/io/query_filter.cgi'
-    r = requests.get(url = URL, auth=HTTPBasicAuth('administrator', ''))
+    try:
+        r = get_control_client(camera_hostname).session.get(url = URL, timeout=5)
+    except requests.RequestException:
+        return (False, None)
     return (r.ok, r.text[-3])
  
+#Video stream URL, {0} is the camera host. LED_CAMERA_VIDEO_URL replaces it,
+#e.g. with 'http://{0}/img/video.mjpg' for the camera of simulators.py
+VIDEO_URL_FORMAT=os.environ.get('LED_CAMERA_VIDEO_URL', 'rtsp://{0}/img/video.sav')
+
 def get_camera_video_url(camera_hostname):
-    return 'rtsp://'+camera_hostname+'/img/video.sav'
+    return VIDEO_URL_FORMAT.format(camera_hostname)
 
 def change_camera_settings(hostname, group, property, value):
-    URL = 'http://'+hostname+'/adm/set_group.cgi'
-    PARAMS = {'group': group , property: value}        
-    # sending get request and saving the response as response object
-    r = requests.get(url = URL, params = PARAMS,auth=HTTPBasicAuth('administrator', ''))
-    return r.ok
+    ok, _ = get_control_client(hostname).set_properties({group: {property: value}})
+    return ok
 
 def reset_to_default(camera_hostname):
-    URL='http://'+camera_hostname+'/adm/reset_to_default.cgi'
-    r=requests.get(url=URL,auth=HTTPBasicAuth('administrator', ''))
+    get_control_client(camera_hostname).reset_to_default()
+
+#drops the settings the control client knows, for a camera that may have been changed outside it
+def forget_known_settings(camera_hostname):
+    get_control_client(camera_hostname).forget()
+
+'''
+Camera control client with a pooled keep-alive HTTP session.
+Properties of one group are set with one set_group.cgi call, groups are set concurrently,
+and properties that already have the requested value are skipped. Current values are read
+back with get_group.cgi before every set; cameras without it are trusted to hold the values
+that were set, until forget (e.g. at the start of a test run, the camera may have been changed
+outside the client).
+Args:
+camera_hostname: camera IP address
+max_workers: maximum number of concurrent requests
+'''
+class CameraControlClient:
+    def __init__(self, camera_hostname, max_workers=4):
+        self.base_url='http://'+camera_hostname
+        self.session=requests.Session()
+        self.session.auth=HTTPBasicAuth('administrator', '')
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+        self.executor=concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='camera-control')
+        #last known values: group -> {property: str value}
+        self.known={}
+        #cleared once get_group.cgi fails, the known values then only come from set responses
+        self.can_read_back=True
+        self.lock=threading.Lock()
+
+    '''
+    Reads back the values of a group
+    Returns:
+    dict property -> str value, empty if the camera doesn't answer
+    '''
+    def get_group(self, group):
+        try:
+            r=self.session.get(self.base_url + '/adm/get_group.cgi', params={'group': group}, timeout=5)
+        except requests.RequestException as e:
+            r=None
+            error=repr(e)
+        if r is None or not r.ok:
+            if self.can_read_back:
+                logging.info('{0}: reading back camera settings failed ({1}), trusting the set responses'.format(
+                    self.base_url, error if r is None else r.status_code))
+            self.can_read_back=False
+            return {}
+        values={}
+        for line in r.text.splitlines():
+            key, sep, value = line.partition('=')
+            if sep: values[key.strip()]=value.strip()
+        return values
+
+    @timing.timed('camera.http')
+    def _set_group(self, group, properties, read_back):
+        #the values read back decide, the known values only stand in for them
+        values=self.get_group(group) if read_back and self.can_read_back else {}
+        with self.lock:
+            self.known.setdefault(group, {}).update(values)
+            known=dict(self.known[group])
+        pending={p: v for p, v in properties.items() if known.get(p) != str(v)}
+        if not pending:
+            return True, 0
+        params={'group': group}
+        params.update(pending)
+        try:
+            r=self.session.get(self.base_url + '/adm/set_group.cgi', params=params, timeout=10)
+        except requests.RequestException:
+            return False, 0
+        if r.ok:
+            with self.lock:
+                self.known.setdefault(group, {}).update({p: str(v) for p, v in pending.items()})
+        return r.ok, len(pending)
+
+    '''
+    Sets camera properties
+    Args:
+    settings: dict group -> {property: value}
+    read_back: read the current values of a group before setting it
+    Returns:
+    (ok, changed): ok: all requests succeeded, changed: number of properties that were actually changed
+    '''
+    def set_properties(self, settings, read_back=True):
+        futures=[self.executor.submit(self._set_group, group, properties, read_back) for group, properties in settings.items()]
+        results=[future.result() for future in futures]
+        return all(ok for ok, _ in results), sum(changed for _, changed in results)
+
+    #drops the known values, they are read back or set again
+    def forget(self):
+        with self.lock:
+            self.known.clear()
+
+    def reset_to_default(self):
+        self.forget()
+        return self.session.get(self.base_url + '/adm/reset_to_default.cgi').ok
+
+_control_clients={}
+_control_clients_lock=threading.Lock()
+
+'''Returns the shared control client of a camera'''
+def get_control_client(camera_hostname):
+    with _control_clients_lock:
+        if camera_hostname not in _control_clients:
+            _control_clients[camera_hostname]=CameraControlClient(camera_hostname)
+        return _control_clients[camera_hostname]
 
 '''
 Shots a central part of fov
@@ -44,6 +163,7 @@ crop_height: height of a central part of fov
 Returns:
 frame of size (crop_height, crop_width, 3)
 '''
+@timing.timed('camera.shoot')
 def shoot(camera_hostname, crop_width, crop_height):
     url=get_camera_img_url(camera_hostname)
     cap=cv2.VideoCapture(url)
@@ -67,26 +187,424 @@ x_UL: x coordinate of upper left corner of the LED on the central part of fov ((
 y_BR: y coordinate of bottom right corner of the LED on the central part of fov ((0,0) - upper left corner of the central part of the image)
 x_BR: x coordinate of bottom right corner of the LED on the central part of fov ((0,0) - upper left corner of the central part of the image)
 time_span: time in seconds, for which video should be taken
+on_frame: optional callable on_frame(frame, timestamp) called for every captured frame,
+    the capture stops early when it returns True
+Returns:
+array of frames of size Tx(y_BR - y_UL)x(x_BR-x_UL)x3 that were provided by the camera during time_span seconds
+'''
+def video (camera_hostname, crop_width, crop_height, y_UL, x_UL, y_BR, x_BR, time_span, on_frame=None):
+    rois=video_rois(camera_hostname, crop_width, crop_height, [(y_UL, x_UL, y_BR, x_BR)], time_span,
+        on_frame=None if on_frame is None else lambda crops, timestamp: on_frame(crops[0], timestamp))
+    return None if rois is None else rois[0]
+
+'''
+Keeps the crops of a capture in one contiguous (T, h, w, 3) array per box, so that a
+capture holds only the LED boxes instead of every decoded frame the crop views point into.
+The crop geometry is fixed on the first frame, the arrays grow by chunk frames when full.
+Args:
+boxes: list of LED boxes (y_UL, x_UL, y_BR, x_BR) on the central part of fov
+crop_width: width of a central part of fov, None if the frames are already the central part
+crop_height: height of a central part of fov, None if the frames are already the central part
+chunk: number of frames the arrays grow by
+'''
+class RoiStore:
+    def __init__(self, boxes, crop_width=None, crop_height=None, chunk=64):
+        self.boxes=boxes
+        self.crop_width=crop_width
+        self.crop_height=crop_height
+        self.chunk=chunk
+        self.slices=None
+        self.arrays=None
+        self.count=0
+
+    #same pxls as frame[central part][y_UL:y_BR, x_UL:x_BR], as one slice of the decoded frame
+    def _fix_geometry(self, frame):
+        height,width=frame.shape[:2]
+        rows,columns=range(height),range(width)
+        if self.crop_height is not None:
+            h_offset=(height-self.crop_height)//2
+            w_offset=(width-self.crop_width)//2
+            rows=rows[h_offset:(h_offset+self.crop_height)]
+            columns=columns[w_offset:(w_offset+self.crop_width)]
+        self.slices=[]
+        self.arrays=[]
+        for (y_UL, x_UL, y_BR, x_BR) in self.boxes:
+            box_rows=rows[int(y_UL):int(y_BR)]
+            box_columns=columns[int(x_UL):int(x_BR)]
+            self.slices.append((slice(box_rows.start, box_rows.start+len(box_rows)),
+                slice(box_columns.start, box_columns.start+len(box_columns))))
+            self.arrays.append(np.empty((self.chunk, len(box_rows), len(box_columns))+frame.shape[2:], dtype=frame.dtype))
+
+    def _grow(self):
+        for i,array in enumerate(self.arrays):
+            grown=np.empty((len(array)+self.chunk,)+array.shape[1:], dtype=array.dtype)
+            grown[:self.count]=array[:self.count]
+            self.arrays[i]=grown
+
+    '''
+    Copies the boxes of a frame into the store
+    Returns:
+    list of the stored crops, one per box
+    '''
+    def append(self, frame):
+        if self.slices is None: self._fix_geometry(frame)
+        if self.count == len(self.arrays[0]): self._grow()
+        crops=[]
+        for array,(rows,columns) in zip(self.arrays, self.slices):
+            array[self.count]=frame[rows, columns]
+            crops.append(array[self.count])
+        self.count+=1
+        return crops
+
+    def __len__(self):
+        return self.count
+
+    '''
+    Returns:
+    list with one contiguous array of size TxMxNx3 per box
+    '''
+    def rois(self):
+        if self.arrays is None:
+            return [np.zeros((0, max(0, y_BR-y_UL), max(0, x_BR-x_UL), 3), dtype=np.uint8) for (y_UL, x_UL, y_BR, x_BR) in self.boxes]
+        return [array[:self.count] for array in self.arrays]
+
+    #bytes held by the store
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays or [])
+
+'''
+Films several LEDs at once under certain time
+Args:
+camera_hostname: camera IP address 
+crop_width: width of a central part of fov
+crop_height: height of a central part of fov
+boxes: list of LED boxes (y_UL, x_UL, y_BR, x_BR) on the central part of fov
+time_span: time in seconds, for which video should be taken
+on_frame: optional callable on_frame(crops, timestamp) called with the list of box crops of every frame,
+    the capture stops early when it returns True
 Returns:
-list of frames of size (y_BR - y_UL, x_BR-x_UL, 3) that were provided by the camera during time_span seconds
+list with one array of frames (TxMxNx3, see RoiStore) per box, or None if the stream could not be opened
 '''
-def video (camera_hostname, crop_width, crop_height, y_UL, x_UL, y_BR, x_BR, time_span):
+@timing.timed('camera.capture')
+def video_rois(camera_hostname, crop_width, crop_height, boxes, time_span, on_frame=None):
     url=get_camera_video_url(camera_hostname)
-    cap=cv2.VideoCapture(url)
+    with timing.span('camera.rtsp_open'):
+        cap=cv2.VideoCapture(url)
     if cap is None or not cap.isOpened():
         return None
-    frames=[]
+    store=RoiStore(boxes, crop_width, crop_height)
     t=time.time()
     while(cap.isOpened() and time.time()-t < time_span):
         ret,frame=cap.read()
         if ret==True:
-            width=int(cap.get(3))
-            height=int(cap.get(4))
-            w_offset=(width-crop_width)//2
-            h_offset=(height-crop_height)//2        
-            frame=frame[h_offset:(h_offset+crop_height),w_offset:(w_offset+crop_width)]                        
-            frames.append(frame[y_UL:y_BR, x_UL:x_BR])
-    return frames
+            crops=store.append(frame)
+            if on_frame is not None and on_frame(crops, time.time()):
+                break
+    cap.release()
+    return store.rois()
+
+#length in seconds of one LED capture
+CAPTURE_SECONDS=5
+#bytes of frames a CameraSession keeps: captures copy their boxes as the frames arrive,
+#so the buffer only covers a slow reader, about 0.8 s of 640x640 frames
+SESSION_BUFFER_BYTES=32*2**20
+
+'''
+Keeps one RTSP stream open and drains it in a background thread into a bounded
+ring buffer of (timestamp, frame) pairs, so that shooting and filming do not pay
+for RTSP handshake and keyframe wait every time.
+Frames are stored as copies of the central part of fov.
+Args:
+camera_hostname: camera IP address
+crop_width: width of a central part of fov
+crop_height: height of a central part of fov
+buffer_size: maximum number of frames kept in the ring buffer,
+    None for as many as fit in SESSION_BUFFER_BYTES (from the size of the first frame)
+'''
+class CameraSession:
+    def __init__(self, camera_hostname, crop_width, crop_height, buffer_size=None):
+        self.url=get_camera_video_url(camera_hostname)
+        self.crop_width=crop_width
+        self.crop_height=crop_height
+        self.buffer_size=buffer_size
+        self.buffer=collections.deque(maxlen=buffer_size or 2)
+        self.condition=threading.Condition()
+        self.cap=None
+        self.thread=None
+        self.running=False
+
+    '''
+    Opens the stream and starts the grabber thread
+    Args:
+    timeout: time in seconds to wait for the first frame
+    Returns:
+    True if the first frame arrived in time
+    '''
+    @timing.timed('camera.rtsp_open')
+    def open(self, timeout=10):
+        self.cap=cv2.VideoCapture(self.url)
+        if self.cap is None or not self.cap.isOpened():
+            return False
+        self.running=True
+        self.thread=threading.Thread(target=self._grab, name='camera-grabber', daemon=True)
+        self.thread.start()
+        return self.latest_frame(timeout=timeout, fresh=False) is not None
+
+    def close(self):
+        self.running=False
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        if self.cap is not None:
+            self.cap.release()
+        with self.condition:
+            self.condition.notify_all()
+
+    def __enter__(self):
+        if not self.open():
+            raise ConnectionError('Failed to open ' + self.url)
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _grab(self):
+        offsets=None
+        while self.running:
+            ret,frame=self.cap.read()
+            timestamp=time.time()
+            if not ret:
+                logging.debug('Lost camera stream, reconnecting...')
+                self.cap.release()
+                time.sleep(0.5)
+                self.cap=cv2.VideoCapture(self.url)
+                offsets=None
+                continue
+            resize=offsets is None
+            if resize:
+                height,width=frame.shape[:2]
+                offsets=((height-self.crop_height)//2, (width-self.crop_width)//2)
+            h_offset,w_offset=offsets
+            frame=frame[h_offset:(h_offset+self.crop_height),w_offset:(w_offset+self.crop_width)].copy()
+            with self.condition:
+                if resize and self.buffer_size is None:
+                    #the frame size is only known from the stream
+                    self.buffer=collections.deque(self.buffer, maxlen=max(2, SESSION_BUFFER_BYTES//frame.nbytes))
+                self.buffer.append((timestamp,frame))
+                self.condition.notify_all()
+
+    #Returns buffered (timestamp, frame) pairs captured after t, oldest first
+    def _newer_than(self, t):
+        newer=[]
+        for item in reversed(self.buffer):
+            if item[0] <= t:
+                break
+            newer.append(item)
+        newer.reverse()
+        return newer
+
+    '''
+    Waits for frames captured after t
+    Returns:
+    list of (timestamp, frame) pairs, empty on timeout or when the session is closed
+    '''
+    def wait_newer_than(self, t, timeout=5):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.running or self._newer_than(t), timeout=timeout)
+            return self._newer_than(t)
+
+    '''
+    Replaces shoot
+    Args:
+    timeout: time in seconds to wait for a frame
+    fresh: if True, only a frame captured after the call is returned
+    Returns:
+    frame of size (crop_height, crop_width, 3) or None
+    '''
+    def latest_frame(self, timeout=5, fresh=True):
+        newer=self.wait_newer_than(time.time() if fresh else 0, timeout)
+        return newer[-1][1] if newer else None
+
+    '''
+    Replaces video: films LED under certain time from the open stream
+    Args: same as video, without camera_hostname and crop size
+    Returns:
+    array of frames of size Tx(y_BR - y_UL)x(x_BR-x_UL)x3 or None if no frames arrive
+    '''
+    def video(self, y_UL, x_UL, y_BR, x_BR, time_span, on_frame=None):
+        rois=self.video_rois([(y_UL, x_UL, y_BR, x_BR)], time_span,
+            on_frame=None if on_frame is None else lambda crops, timestamp: on_frame(crops[0], timestamp))
+        return None if rois is None else rois[0]
+
+    '''
+    Replaces video_rois: films several LEDs at once from the open stream
+    Args: same as video_rois, without camera_hostname and crop size
+    Returns:
+    list with one array of frames (TxMxNx3, see RoiStore) per box, or None if no frames arrive
+    '''
+    @timing.timed('camera.capture')
+    def video_rois(self, boxes, time_span, on_frame=None):
+        #crops are copied, so the ring buffer frames are not kept alive by the capture
+        store=RoiStore(boxes)
+        t=time.time()
+        cursor=t
+        while self.running:
+            newer=self.wait_newer_than(cursor)
+            if not newer:
+                break
+            for timestamp,frame in newer:
+                if timestamp-t >= time_span:
+                    return store.rois()
+                cursor=timestamp
+                crops=store.append(frame)
+                if on_frame is not None and on_frame(crops, timestamp):
+                    return store.rois()
+        return store.rois() if len(store) else None
+
+#settle detection: pictures are compared as thumbnails of THUMBNAIL_SIZE x THUMBNAIL_SIZE cells
+THUMBNAIL_SIZE=32
+#maximum mean change of a thumbnail pxl over the stable time of a settled camera
+SETTLE_DIFF_THR=1.5
+#minimum change of a LED box mean (or of a thumbnail cell) that shows a new LED state
+LED_CHANGE_THR=10
+
+def thumbnail(frame):
+    return cv2.resize(frame, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+#mean color of every box, or the thumbnail if boxes is None
+def box_means(frame, boxes=None):
+    if boxes is None: return thumbnail(frame)
+    return np.array([frame[y_UL:y_BR, x_UL:x_BR].reshape(-1, 3).mean(axis=0) for y_UL, x_UL, y_BR, x_BR in boxes])
+
+'''
+Waits until the camera picture settles after a settings change (exposure, white balance,
+day mode): the pictures differ by less than diff_thr from the first one of the last
+stable_seconds, so a slow drift is not taken for a settled picture however often frames arrive.
+Small changes such as blinking LEDs are averaged out by the thumbnails.
+Args:
+grab: callable returning a new frame, or None if no frame arrives
+timeout: maximum wait in seconds
+min_wait: time for the camera to start applying the change
+stable_seconds: how long the picture must stay unchanged
+diff_thr: see SETTLE_DIFF_THR
+Returns:
+(True if the picture settled, False on timeout, seconds waited)
+'''
+def wait_until_stable(grab, timeout, min_wait=0.3, stable_seconds=0.5, diff_thr=SETTLE_DIFF_THR):
+    start=time.perf_counter()
+    time.sleep(min_wait)
+    #first picture of the current stable stretch
+    anchor=None
+    while time.perf_counter()-start < timeout:
+        frame=grab()
+        now=time.perf_counter()
+        if frame is None:
+            #no pictures to judge, wait as long as allowed
+            time.sleep(max(0, timeout-(now-start)))
+            break
+        current=thumbnail(frame)
+        if anchor is None or np.abs(current-anchor).mean() >= diff_thr:
+            anchor, anchor_time = current, now
+        elif now-anchor_time >= stable_seconds:
+            return True, now-start
+    return False, time.perf_counter()-start
+
+#consecutive frames that must show the same new picture (or LED state) before it counts as settled
+LED_STEADY_FRAMES=3
+
+'''
+Waits until the picture (or some boxes of it) reaches a new steady state after gateway
+commands: the last steady frames all differ from the baseline and not from each other.
+Used where the new picture is not known beforehand, e.g. all LEDs going off after a config change.
+Args:
+grab: callable returning a new frame, or None if no frame arrives
+baseline: frame from before the commands
+boxes: LED boxes (y_UL, x_UL, y_BR, x_BR) to watch, None for the whole picture (thumbnail cells)
+timeout: maximum wait in seconds
+change_thr: see LED_CHANGE_THR
+steady: see LED_STEADY_FRAMES
+Returns:
+(True if a new steady picture was seen, seconds waited)
+'''
+def wait_for_change(grab, baseline, boxes, timeout, change_thr=LED_CHANGE_THR, steady=LED_STEADY_FRAMES):
+    start=time.perf_counter()
+    reference=box_means(baseline, boxes)
+    recent=collections.deque(maxlen=steady)
+    while time.perf_counter()-start < timeout:
+        frame=grab()
+        if frame is None:
+            time.sleep(max(0, timeout-(time.perf_counter()-start)))
+            break
+        current=box_means(frame, boxes)
+        if np.abs(current-reference).max() < change_thr: recent.clear()
+        else: recent.append(current)
+        if len(recent) == steady and np.ptp(np.stack(recent), axis=0).max() < change_thr:
+            return True, time.perf_counter()-start
+    return False, time.perf_counter()-start
+
+'''
+Tells from the mean colors of one LED box since a command whether the LED shows its new state:
+off or steadily lit for LED_STEADY_FRAMES frames, or blinking: lit in another color than
+before the command, or switching between lit and off since the picture before the command.
+A LED that was lit before has to show another color to be steadily lit in its new state.
+After a blinking (or unknown) state the LED looks lit or off for up to half the blink period,
+so a state that could still be the old one only counts once it held for hold seconds.
+Args:
+means: mean color of the box in every frame since the command
+times: time of every frame
+before: mean color of the box before the command
+off: mean color of the box with the LED off
+behavior: expected behavior, 'OFF', 'ON' or 'FLASH'
+hold: longest time the previous state of the LED stays lit or off, 0 if it was not blinking
+Returns:
+True if the LED settled
+'''
+def led_settled(means, times, before, off, behavior, hold, change_thr=LED_CHANGE_THR, steady=LED_STEADY_FRAMES):
+    lit=[np.abs(m-off).max() >= change_thr for m in means]
+    was_lit=np.abs(before-off).max() >= change_thr
+    recolored=[l and was_lit and np.abs(m-before).max() >= change_thr for m, l in zip(means, lit)]
+    if behavior == 'FLASH':
+        switched=any(a != b for a, b in zip([was_lit] + lit, lit))
+        return any(recolored) or (switched and times[-1]-times[0] >= hold)
+    expected=behavior == 'ON'
+    if len(means) < steady or any(l != expected for l in lit[-steady:]): return False
+    if expected and np.ptp(np.stack(means[-steady:]), axis=0).max() >= change_thr: return False
+    if expected and all(recolored[-steady:]): return True
+    #without a blinking state before, only another color shows that a lit LED took its new state
+    if expected and was_lit and not hold: return False
+    #start of the current stretch of the expected state
+    stretch=len(lit)-next((i for i, l in enumerate(reversed(lit)) if l != expected), len(lit))
+    return times[-1]-times[stretch] >= hold
+
+'''
+Waits until the commanded LEDs show their new state after a gateway command (see led_settled).
+Only the boxes of the commanded LEDs are watched, so LEDs switched off by the same command,
+neighbors inside enlarged boxes and LEDs still blinking from earlier commands don't end the wait.
+Args:
+grab: callable returning a new frame, or None if no frame arrives
+baseline: frame from before the command
+leds: list of (box, crop of the box with all LEDs off, expected behavior 'OFF', 'ON' or 'FLASH', hold of led_settled)
+timeout: maximum wait in seconds
+Returns:
+(True if every LED settled, seconds waited)
+'''
+def wait_for_led_states(grab, baseline, leds, timeout, change_thr=LED_CHANGE_THR, steady=LED_STEADY_FRAMES):
+    start=time.perf_counter()
+    boxes=[box for box, _, _, _ in leds]
+    befores=box_means(baseline, boxes)
+    offs=[crop.reshape(-1, 3).mean(axis=0) for _, crop, _, _ in leds]
+    means, times = [], []
+    while time.perf_counter()-start < timeout:
+        frame=grab()
+        if frame is None:
+            time.sleep(max(0, timeout-(time.perf_counter()-start)))
+            break
+        means.append(box_means(frame, boxes))
+        times.append(time.perf_counter())
+        if all(led_settled([m[i] for m in means], times, befores[i], offs[i], behavior, hold, change_thr, steady)
+                for i, (_, _, behavior, hold) in enumerate(leds)):
+            return True, time.perf_counter()-start
+    return False, time.perf_counter()-start
 
 def switch_to_day_mode(camera_hostname):
     return change_camera_settings(camera_hostname,'VIDEO','dn_sch', 2)
@@ -130,3 +648,13 @@ def switch_to_default_exposure(camera_hostname):
 def switch_to_default_contrast(camera_hostname):
     return change_camera_settings(camera_hostname,'VIDEO','contrast', 4) 
 
+#Default picture settings and auto day/night mode
+DEFAULT_SETTINGS={'VIDEO': {'saturation': 4, 'sharpness': 7, 'exposure': 4, 'contrast': 4, 'dn_sch': 1}}
+
+'''
+Switches saturation, sharpness, exposure, contrast and day/night mode to defaults in one request
+Returns:
+(ok, changed): ok: request status, changed: number of properties that were not at default
+'''
+def switch_to_defaults(camera_hostname):
+    return get_control_client(camera_hostname).set_properties(DEFAULT_SETTINGS)
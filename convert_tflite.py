@@ -0,0 +1,138 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+import models
+import paths
+
+SAVED_MODEL_PATHS=[paths.LEDS_SCHEME_MODEL_PATH, paths.DISPLAY_MODEL_PATH, paths.LEDS_MODEL_PATH]
+
+def list_images(image_dir):
+    return sorted(os.path.join(image_dir, f) for f in os.listdir(image_dir)
+        if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+
+'''
+Converts a SavedModel to a quantized TFLite model next to it
+Args:
+saved_model_path: one of the model paths in paths.py
+quantization: 'float16' or 'int8'
+calibration_images: list of images for full int8 calibration, fitted to the model input
+    (models.INPUT_SIZE) as at inference; if empty, int8 only quantizes the weights (dynamic range)
+Returns:
+path of the written .tflite file
+'''
+def convert(saved_model_path, quantization, calibration_images=()):
+    converter=tf.lite.TFLiteConverter.from_saved_model(saved_model_path)
+    converter.optimizations=[tf.lite.Optimize.DEFAULT]
+    #Faster R-CNN postprocessing needs TF ops that have no TFLite builtin
+    converter.target_spec.supported_ops=[tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    if quantization == 'float16':
+        converter.target_spec.supported_types=[tf.float16]
+    elif calibration_images:
+        def representative_dataset():
+            for img in calibration_images:
+                fitted, _ = models.fit_image(img, models.INPUT_SIZE)
+                yield [np.expand_dims(fitted, 0).astype(np.uint8)]
+        converter.representative_dataset=representative_dataset
+    tflite_model=converter.convert()
+    path=models.tflite_model_path(saved_model_path, quantization)
+    with open(path, 'wb') as f:
+        f.write(tflite_model)
+    return path
+
+def box_iou(box_a, box_b):
+    y_UL, x_UL = max(box_a[0], box_b[0]), max(box_a[1], box_b[1])
+    y_BR, x_BR = min(box_a[2], box_b[2]), min(box_a[3], box_b[3])
+    intersection=max(0, y_BR-y_UL)*max(0, x_BR-x_UL)
+    union=(box_a[2]-box_a[0])*(box_a[3]-box_a[1]) + (box_b[2]-box_b[0])*(box_b[3]-box_b[1]) - intersection
+    return intersection/union if union > 0 else 0.0
+
+def timed_detect(model, img):
+    start=time.perf_counter()
+    leds=model.detect(img)
+    return leds, time.perf_counter()-start
+
+'''
+Compares a backend against the SavedModels on recorded images
+Args:
+images: list of (name, image)
+backend: one of models.BACKENDS
+model_name: 'display_leds' or 'leds_scheme'
+Returns:
+dict report with class order agreement, box IoU and latency of both backends
+'''
+def compare(images, backend, model_name='display_leds'):
+    model_class=models.DisplayLedsSchemeModel if model_name == 'display_leds' else models.LedsSchemeModel
+    reference=model_class('savedmodel')
+    candidate=model_class(backend)
+
+    latencies={'savedmodel': [], backend: []}
+    order_agreement, ious, disagreements = [], [], []
+    for name, img in images:
+        reference_leds, t = timed_detect(reference, img)
+        latencies['savedmodel'].append(t)
+        candidate_leds, t = timed_detect(candidate, img)
+        latencies[backend].append(t)
+
+        same_order=[led['class'] for led in reference_leds] == [led['class'] for led in candidate_leds]
+        order_agreement.append(same_order)
+        if not same_order: disagreements.append(name)
+        ious+=[box_iou(a['box'], b['box']) for a, b in zip(reference_leds, candidate_leds)]
+
+    #the first call includes graph warmup, report it separately
+    report={'images': len(images), 'model': model_name, 'backend': backend,
+        'class_order_agreement': float(np.mean(order_agreement)),
+        'box_iou_mean': float(np.mean(ious)), 'box_iou_min': float(np.min(ious)),
+        'disagreements': disagreements, 'latency_ms': {}}
+    for name, values in latencies.items():
+        steady=np.array(values[1:] or values)*1000
+        report['latency_ms'][name]={'first': values[0]*1000, 'mean': float(np.mean(steady)),
+            'p50': float(np.percentile(steady, 50)), 'p95': float(np.percentile(steady, 95))}
+    return report
+
+def main(argv):
+    arg_parser=argparse.ArgumentParser(description='convert LED detectors to TFLite and validate them')
+    subparsers=arg_parser.add_subparsers(dest='mode', required=True)
+    convert_parser=subparsers.add_parser('convert', help='convert the SavedModels in paths.py')
+    convert_parser.add_argument('-q', '--quantization', choices=['float16','int8'], default='float16', help='(default float16, int8 is experimental, see models.EXPERIMENTAL_BACKENDS)')
+    convert_parser.add_argument('-c', '--calibration-dir', help='images for full int8 calibration (weights-only int8 without it)')
+    compare_parser=subparsers.add_parser('compare', help='compare a TFLite backend with the SavedModels')
+    compare_parser.add_argument('image_dir', help='directory with recorded images (e.g. original.jpg from test logs)')
+    compare_parser.add_argument('-b', '--backend', choices=models.BACKENDS[1:] + models.EXPERIMENTAL_BACKENDS, default='tflite-float16', help='(default tflite-float16)')
+    compare_parser.add_argument('-m', '--model', choices=['display_leds','leds_scheme'], default='display_leds', help='(default display_leds)')
+    compare_parser.add_argument('-o', '--output', help='write the report as JSON')
+    args=arg_parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("tensorflow").setLevel(logging.ERROR)
+
+    if args.mode == 'convert':
+        calibration_images=[]
+        if args.calibration_dir:
+            calibration_images=[cv2.imread(path) for path in list_images(args.calibration_dir)]
+        for saved_model_path in SAVED_MODEL_PATHS:
+            #the LED model sees display crops, full images are used for its calibration too
+            logging.info('Converting {0} to {1}...'.format(saved_model_path, args.quantization))
+            logging.info('Written ' + convert(saved_model_path, args.quantization, calibration_images))
+        return
+
+    images=[(os.path.basename(path), cv2.imread(path)) for path in list_images(args.image_dir)]
+    if not images: sys.exit('No images in ' + args.image_dir)
+    report=compare(images, args.backend, args.model)
+    logging.info('class order agreement: {0:.1%} ({1} disagreements)'.format(report['class_order_agreement'], len(report['disagreements'])))
+    logging.info('box IoU mean: {0:.3f} min: {1:.3f}'.format(report['box_iou_mean'], report['box_iou_min']))
+    for name, latency in report['latency_ms'].items():
+        logging.info('{0}: first {1:.0f} ms, mean {2:.0f} ms, p95 {3:.0f} ms'.format(name, latency['first'], latency['mean'], latency['p95']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main(sys.argv)
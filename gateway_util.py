@@ -1,15 +1,171 @@
 import paramiko
 import re
+import os
+import json
+import collections
+import select
+import threading
+import time
+import uuid
+import hashlib
+import logging
 
+import paths
+import timing
+
+@timing.timed('gateway.connect')
 def get_ssh(modem_hostname, modem_port, modem_username, modem_password):
     ssh=paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     ssh.connect(hostname=modem_hostname, port=modem_port, username=modem_username, password=modem_password)
     return ssh
 
-def read_and_copy_config(ssh,file):
-    _, stdout, _ = ssh.exec_command('cat /lib/db/config/hw')
+'''
+Result of a command: exit status, stdout lines and stderr lines (as returned by readlines())
+'''
+CommandResult=collections.namedtuple('CommandResult', ['status', 'stdout', 'stderr'])
+
+'''
+Runs commands in one persistent shell on the gateway instead of a new channel
+and process per command. Every command is followed by sentinels with its exit status
+on stdout and stderr, so several commands can be sent at once and their
+results read back one by one.
+Args:
+ssh: connected paramiko.SSHClient
+'''
+class GatewaySession:
+    def __init__(self, ssh):
+        self.ssh=ssh
+        self.channel=None
+        self.lock=threading.Lock()
+        self.prefix='__gw_' + uuid.uuid4().hex[:8]
+        self.counter=0
+
+    def _shell(self):
+        if self.channel is None or self.channel.closed or self.channel.exit_status_ready():
+            self.channel=self.ssh.get_transport().open_session()
+            self.channel.exec_command('sh')
+            self.stdout=b''
+            self.stderr=b''
+        return self.channel
+
+    def is_active(self):
+        transport=self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    #Reads available output, waiting for it until the deadline
+    def _receive(self, channel, deadline):
+        if channel.recv_ready():
+            self.stdout+=channel.recv(65536)
+        elif channel.recv_stderr_ready():
+            self.stderr+=channel.recv_stderr(65536)
+        elif channel.exit_status_ready():
+            raise EOFError('Gateway shell exited')
+        else:
+            remaining=deadline-time.time()
+            if remaining <= 0:
+                raise TimeoutError('Gateway command timed out')
+            select.select([channel], [], [], remaining)
+
+    def _read_result(self, channel, token, deadline):
+        status_line=re.compile(b'\n' + token.encode() + b' (-?[0-9]+)\n')
+        stderr_marker=('\n' + token + '\n').encode()
+        while True:
+            match=status_line.search(self.stdout)
+            if match and stderr_marker in self.stderr:
+                break
+            self._receive(channel, deadline)
+        output, self.stdout = self.stdout[:match.start()], self.stdout[match.end():]
+        errors, self.stderr = self.stderr.split(stderr_marker, 1)
+        return CommandResult(int(match.group(1)),
+            output.decode(errors='replace').splitlines(keepends=True),
+            errors.decode(errors='replace').splitlines(keepends=True))
+
+    '''
+    Runs several commands with one write to the shell
+    Args:
+    commands: list of shell commands, each runs in its own subshell with stdin from /dev/null
+    timeout: time in seconds for the whole batch
+    Returns:
+    list of CommandResult, one per command
+    '''
+    def run_batch(self, commands, timeout=60):
+        with self.lock:
+            channel=self._shell()
+            tokens, script = [], ''
+            for command in commands:
+                self.counter+=1
+                token=self.prefix + '_' + str(self.counter)
+                tokens.append(token)
+                script+='( ' + (command.strip() or ':') + ' ) </dev/null\nprintf "\\n' + token + ' %d\\n" $?\nprintf "\\n' + token + '\\n" >&2\n'
+            deadline=time.time()+timeout
+            try:
+                channel.sendall(script.encode())
+                return [self._read_result(channel, token, deadline) for token in tokens]
+            except Exception:
+                #the shell output is out of sync, start a new shell next time
+                channel.close()
+                raise
+
+    def run(self, command, timeout=60):
+        return self.run_batch([command], timeout)[0]
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+        self.ssh.close()
+
+_sessions={}
+_sessions_lock=threading.Lock()
+
+'''
+Returns a gateway session, reusing a live connection to the same host and user
+'''
+def get_session(modem_hostname, modem_port, modem_username, modem_password):
+    key=(modem_hostname, modem_port, modem_username)
+    with _sessions_lock:
+        session=_sessions.get(key)
+        if session is None or not session.is_active():
+            session=GatewaySession(get_ssh(modem_hostname, modem_port, modem_username, modem_password))
+            _sessions[key]=session
+        return session
+
+'''
+Runs a command on an SSHClient or a GatewaySession
+Returns:
+CommandResult
+'''
+@timing.timed('gateway.command')
+def execute(ssh, command):
+    if isinstance(ssh, GatewaySession):
+        return ssh.run(command)
+    _, stdout, stderr = ssh.exec_command(command)
     output=stdout.readlines()
+    errors=stderr.readlines()
+    return CommandResult(stdout.channel.recv_exit_status(), output, errors)
+
+'''
+Runs several commands on an SSHClient or a GatewaySession (pipelined on a session)
+Returns:
+list of CommandResult
+'''
+@timing.timed('gateway.batch')
+def execute_batch(ssh, commands):
+    if isinstance(ssh, GatewaySession):
+        return ssh.run_batch(commands)
+    return [execute(ssh, command) for command in commands]
+
+'''
+Returns:
+model name of the gateway, used to tell fixtures of different gateways apart
+'''
+def get_gateway_model(ssh):
+    result=execute(ssh, 'db -q get hw.board.hardware || cat /proc/device-tree/model || uname -n')
+    model=''.join(result.stdout).strip().strip('\x00')
+    return model or 'unknown'
+
+def read_and_copy_config(ssh,file):
+    output=execute(ssh, 'cat /lib/db/config/hw').stdout
     f = open(file, "a")
     for line in output:
         f.write(line)
@@ -17,29 +173,74 @@ def read_and_copy_config(ssh,file):
     return output
 
 def reset_to_default(ssh):
+    if isinstance(ssh, GatewaySession):
+        #the gateway resets, the shell won't answer anymore
+        with _sessions_lock:
+            for key, session in list(_sessions.items()):
+                if session is ssh: del _sessions[key]
+        ssh=ssh.ssh
     _,_,_ = ssh.exec_command('defaultreset')
 
-#Parse config
-def get_mapping_and_uci_command_to_change_config(config):
-    mapping={}
-    mapping['objects']=[]
-    mapping['states']=[]
-    mapping['LED']=[]
-    mapping['LED_color']=[]
-    mapping['LED_behavior']=[]
-
-    command=''
+UCI='uci -c /lib/db/config/ '
+
+'''
+One expected LED state: the objects and their states that trigger it and the LED response
+'''
+LedRecord=collections.namedtuple('LedRecord', ['objects', 'states', 'LED', 'color', 'behavior'])
+
+'''
+Parsed hw config: LED records indexed by (function, state) and the uci commands
+that rename the tested functions
+'''
+class HwConfigMapping:
+    def __init__(self):
+        self.records=[]
+        #(function_test, state) -> indices of single-object records
+        self.index={}
+        self.deleted=set()
+        self.commands=[]
+
+    def add(self, record):
+        if len(record.objects) == 1:
+            self.index.setdefault((record.objects[0], record.states[0]), []).append(len(self.records))
+        self.records.append(record)
+
+    '''Returns the mapping dict of parallel lists (objects, states, LED, LED_color, LED_behavior)'''
+    def to_mapping(self):
+        mapping={'objects': [], 'states': [], 'LED': [], 'LED_color': [], 'LED_behavior': []}
+        for idx, record in enumerate(self.records):
+            if idx in self.deleted: continue
+            mapping['objects'].append(record.objects)
+            mapping['states'].append(record.states)
+            mapping['LED'].append(record.LED)
+            mapping['LED_color'].append(record.color)
+            mapping['LED_behavior'].append(record.behavior)
+        return mapping
+
+    def uci_command(self):
+        return ''.join(command + ' && ' for command in self.commands) + UCI + 'commit && /etc/init.d/peripheral_manager restart'
+
+'''
+Parses the hw config in one pass
+Args:
+config: lines of /lib/db/config/hw
+Returns:
+HwConfigMapping
+'''
+def parse_hw_config(config):
+    parsed=HwConfigMapping()
     current_func=''
-    records_to_delete=[]
+    #LED response of the last parsed record, used by super functions without a matching record
+    LED=color=behavior=None
 
     for line in config:
         #add test functions and remap existing ones
         if 'functions' in line:
             word_list=line.split()
             func=word_list[-1][1:-1]
-            command+='uci -c /lib/db/config/ rename hw.led_' + func + '=led_' + func + '_test && '
-            command+='uci -c /lib/db/config/ del_list hw.led_map.functions=' + func + ' && '
-            command+='uci -c /lib/db/config/ add_list hw.led_map.functions=' + func + '_test && '
+            parsed.commands.append(UCI + 'rename hw.led_' + func + '=led_' + func + '_test')
+            parsed.commands.append(UCI + 'del_list hw.led_map.functions=' + func)
+            parsed.commands.append(UCI + 'add_list hw.led_map.functions=' + func + '_test')
             continue
 
         if 'config led_map' in line:
@@ -48,55 +249,82 @@ def get_mapping_and_uci_command_to_change_config(config):
             continue
 
         #Collect mapping data
-        if 'led_action' in line and current_func.capitalize:            
-            mapping['objects'].append([current_func + '_test'])
+        if 'led_action' in line:
             word_list=line.split()
             behavior=word_list[-1][:-1]
             color=word_list[-3].split('_')[-1]
             LED=word_list[-3].split('_')[0][1:]
             state=word_list[1].split('_')[-1]
-            mapping['states'].append([state])
-            mapping['LED'].append(LED)
-            mapping['LED_color'].append(color)
-            mapping['LED_behavior'].append(behavior)
+            parsed.add(LedRecord([current_func + '_test'], [state], LED, color, behavior))
             continue
 
-        #if there are super functions
-        if 'super' in line:            
+        #if there are super functions, they replace the record of the function state
+        if 'super' in line:
             word_list=line.split(' \'')
             super_state=word_list[0].split('_')[-1]
             objects_and_states=word_list[-1][:-2].split(', ')
-            objects,states=[],[]
-            for o_a_s in objects_and_states:
-                objects.append(o_a_s.split('_')[0]+'_test')
-                states.append(o_a_s.split('_')[1])
-            for idx,(o,s) in enumerate(zip(mapping['objects'],mapping['states'])):
-                if o==[current_func+'_test'] and s==[super_state]:
-                    LED=mapping['LED'][idx]
-                    color=mapping['LED_color'][idx]
-                    behavior=mapping['LED_behavior'][idx]
-                    if idx not in records_to_delete:
-                        records_to_delete.append(idx)
-            mapping['objects'].append(objects)
-            mapping['states'].append(states)
-            mapping['LED'].append(LED)
-            mapping['LED_color'].append(color)
-            mapping['LED_behavior'].append(behavior)
-            val='\''
-            for (o,s) in zip(objects,states):
-                val += o + '_' + s + ', '
-            val=val[:-2]+'\''
-            command+='uci -c /lib/db/config/ add_list hw.led_' + current_func + '_test.super_' + super_state + '=' + val + ' && '
-    
-    for i,r in enumerate(records_to_delete):
-        del mapping['objects'][r-i]
-        del mapping['states'][r-i]
-        del mapping['LED'][r-i]
-        del mapping['LED_color'][r-i]
-        del mapping['LED_behavior'][r-i]
-           
-    command += 'uci -c /lib/db/config/ commit && /etc/init.d/peripheral_manager restart'
-    return (mapping, command)
+            objects=[o_a_s.split('_')[0]+'_test' for o_a_s in objects_and_states]
+            states=[o_a_s.split('_')[1] for o_a_s in objects_and_states]
+            matches=parsed.index.get((current_func + '_test', super_state), [])
+            if matches:
+                record=parsed.records[matches[-1]]
+                LED, color, behavior = record.LED, record.color, record.behavior
+                parsed.deleted.update(matches)
+            parsed.add(LedRecord(objects, states, LED, color, behavior))
+            val='\'' + ', '.join(o + '_' + s for (o,s) in zip(objects,states)) + '\''
+            parsed.commands.append(UCI + 'add_list hw.led_' + current_func + '_test.super_' + super_state + '=' + val)
+    return parsed
+
+#Parse config
+def get_mapping_and_uci_command_to_change_config(config):
+    parsed=parse_hw_config(config)
+    return (parsed.to_mapping(), parsed.uci_command())
+
+#version of parse_hw_config and of the mapping format in the cache file names,
+#to be increased with every change of them so that old cache files are not used
+HW_CONFIG_CACHE_VERSION=2
+
+'''
+Reads and parses the hw config, reusing the cached parse result
+when the checksum of /lib/db/config/hw on the gateway didn't change.
+A cache file is only used if the config in it has the same checksum
+Args:
+ssh: SSHClient or GatewaySession
+file: local file to copy the config to
+cache_dir: folder with cached parse results
+Returns:
+(config, mapping, command): config lines, and the result of get_mapping_and_uci_command_to_change_config
+'''
+@timing.timed('gateway.config')
+def read_config_and_mapping(ssh, file, cache_dir=paths.CACHE_DIR):
+    result=execute(ssh, 'md5sum /lib/db/config/hw')
+    cache_file=checksum=None
+    if result.status == 0 and result.stdout:
+        checksum=result.stdout[0].split()[0]
+        cache_file=os.path.join(cache_dir, 'hw_config_v{0}_{1}.json'.format(HW_CONFIG_CACHE_VERSION, checksum))
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                cached=json.load(f)
+            valid=hashlib.md5(''.join(cached['config']).encode()).hexdigest() == checksum
+            cached=(cached['config'], cached['mapping'], cached['command'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            valid=False
+            logging.debug('Unreadable hw config cache {0}: {1!r}'.format(cache_file, e))
+        if valid:
+            with open(file, 'a') as f:
+                f.writelines(cached[0])
+            return cached
+        logging.info('Ignoring hw config cache {0}, parsing the config again'.format(cache_file))
+
+    config=read_and_copy_config(ssh, file)
+    (mapping, command)=get_mapping_and_uci_command_to_change_config(config)
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump({'config': config, 'mapping': mapping, 'command': command}, f)
+        os.replace(cache_file + '.tmp', cache_file)
+    return (config, mapping, command)
 
 def get_command_and_expected_behavior_dict(mapping,functions):
     commands_behavior_dict={}
@@ -113,9 +341,7 @@ def get_command_and_expected_behavior_dict(mapping,functions):
     return commands_behavior_dict
 
 def revert(ssh):
-    stdin, stdout, stderr =ssh.exec_command('uci -c /lib/db/config/ revert hw')
-    return stderr.readlines()==[]
+    return execute(ssh, 'uci -c /lib/db/config/ revert hw').stderr==[]
     
 def run_uci_command(ssh, command):
-    stdin, stdout, stderr =ssh.exec_command(command)
-    return stderr.readlines()==[]
\ No newline at end of file
+    return execute(ssh, command).stderr==[]
\ No newline at end of file
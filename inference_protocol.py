@@ -0,0 +1,53 @@
+import json
+import struct
+
+import numpy as np
+
+#Message framing: 4-byte big-endian header length, JSON header, raw payload of header['payload'] bytes.
+#Images travel as raw bytes with their shape and dtype in the header (no pickle).
+HEADER_LENGTH=struct.Struct('>I')
+
+def _recv_exactly(sock, size):
+    chunks=[]
+    while size:
+        chunk=sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        size-=len(chunk)
+    return b''.join(chunks)
+
+'''
+Sends a message
+Args:
+sock: connected socket
+header: JSON serializable dict
+image: optional numpy array sent as payload
+'''
+def send_message(sock, header, image=None):
+    header=dict(header)
+    payload=b''
+    if image is not None:
+        image=np.ascontiguousarray(image)
+        header['shape']=list(image.shape)
+        header['dtype']=str(image.dtype)
+        payload=image.tobytes()
+    header['payload']=len(payload)
+    encoded=json.dumps(header).encode()
+    sock.sendall(HEADER_LENGTH.pack(len(encoded)) + encoded + payload)
+
+'''
+Receives a message
+Args:
+sock: connected socket
+Returns:
+(header, image): image is None if the message has no payload
+'''
+def recv_message(sock):
+    (length,)=HEADER_LENGTH.unpack(_recv_exactly(sock, HEADER_LENGTH.size))
+    header=json.loads(_recv_exactly(sock, length))
+    image=None
+    if header.get('payload'):
+        payload=_recv_exactly(sock, header['payload'])
+        image=np.frombuffer(payload, dtype=header['dtype']).reshape(header['shape'])
+    return header, image
@@ -0,0 +1,74 @@
+import argparse
+import logging
+import os
+import socketserver
+import sys
+import threading
+
+import paths
+from inference_protocol import send_message, recv_message
+
+def leds_to_json(leds):
+    return [{'class': led_class, 'box': box, 'score': score}
+        for box, led_class, score in zip(leds.boxes.tolist(), leds.classes.tolist(), leds.scores.tolist())]
+
+class InferenceHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                header, image = recv_message(self.request)
+            except (EOFError, ConnectionError):
+                return
+            try:
+                model=self.server.models[header.get('model', 'display_leds')]
+                #one inference at a time, the models are shared by all clients
+                with self.server.lock:
+                    leds=model.detect(image)
+                send_message(self.request, {'leds': leds_to_json(leds)})
+            except Exception as e:
+                logging.exception('Detection failed')
+                send_message(self.request, {'error': repr(e)})
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads=True
+
+    def __init__(self, socket_path, models):
+        self.models=models
+        self.lock=threading.Lock()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, InferenceHandler)
+
+'''Loads the detectors once and serves detect requests over a Unix socket'''
+def main(argv):
+    import models
+    arg_parser=argparse.ArgumentParser(description='serve LED detectors over a Unix socket')
+    arg_parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
+    arg_parser.add_argument('-s', '--socket', default=paths.INFERENCE_SOCKET_PATH, help='socket path (default {0})'.format(paths.INFERENCE_SOCKET_PATH))
+    arg_parser.add_argument('--backend', choices=models.BACKENDS, default='savedmodel', help='detector backend (default savedmodel)')
+    arg_parser.add_argument('--leds-scheme', action='store_true', help='also serve the single-stage LedsSchemeModel')
+    models.add_model_arguments(arg_parser)
+    args=arg_parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    logging.getLogger("tensorflow").setLevel(logging.ERROR)
+
+    models.configure_threads(args.tf_intra_threads, args.tf_inter_threads)
+    model_args=(args.backend, models.model_input_size(args), args.fit_mode, args.xla)
+    logging.info('Loading models...')
+    served={'display_leds': models.DisplayLedsSchemeModel(*model_args)}
+    if args.leds_scheme:
+        served['leds_scheme']=models.LedsSchemeModel(*model_args)
+
+    server=InferenceServer(args.socket, served)
+    logging.info('Serving {0} on {1}'.format(', '.join(served), args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,24 @@
+import importlib
+import threading
+
+'''
+Module proxy that imports the module on first attribute access,
+so that heavy modules (tensorflow, cv2) don't slow down startup.
+Safe to use from several threads.
+Args:
+name: module name, e.g. 'tensorflow'
+'''
+class LazyModule:
+    def __init__(self, name):
+        self._name=name
+        self._module=None
+        self._lock=threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                self._module=importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
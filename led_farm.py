@@ -0,0 +1,191 @@
+import argparse
+import atexit
+import concurrent.futures
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import gateway_util as gu
+
+LED_TESTING=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'led_testing.py')
+#Time given to an interrupted test to run its own atexit recovery
+INTERRUPT_GRACE_TIME=30
+
+'''
+Reads the inventory of gateway/camera pairs
+Args:
+path: JSON file with a list of devices:
+    {"name": "rack1-slot3", "gateway_ip": "...", "port": 22, "gateway_user": "...",
+     "password_env": "RACK1_PWD" or "password": "...", "camera_ip": "..."}
+Returns:
+list of device dicts with 'name' and 'port' filled in
+'''
+def read_inventory(path):
+    with open(path) as f:
+        devices=json.load(f)
+    for device in devices:
+        for key in ('gateway_ip', 'gateway_user', 'camera_ip'):
+            if key not in device: raise ValueError('Device {0} has no {1}'.format(device, key))
+        device.setdefault('port', 22)
+        device.setdefault('name', device['gateway_ip'])
+    names=[device['name'] for device in devices]
+    if len(set(names)) != len(names): raise ValueError('Device names in the inventory must be unique')
+    return devices
+
+'''
+Limits the number of runs that use the same gateway or camera at a time
+Args:
+limit: maximum number of concurrent runs per device host
+'''
+class DeviceLimiter:
+    def __init__(self, limit):
+        self.limit=limit
+        self.semaphores={}
+        self.lock=threading.Lock()
+
+    def _semaphores(self, device):
+        #gateways behind one address (port forwarding, simulators) differ by their ssh port
+        hosts=sorted({'gateway:{0}:{1}'.format(device['gateway_ip'], device['port']), 'camera:' + device['camera_ip']})
+        with self.lock:
+            return [self.semaphores.setdefault(host, threading.BoundedSemaphore(self.limit)) for host in hosts]
+
+    def acquire(self, device):
+        #always in sorted order, so two runs sharing both hosts can't deadlock
+        semaphores=self._semaphores(device)
+        for semaphore in semaphores:
+            semaphore.acquire()
+        return semaphores
+
+    def release(self, semaphores):
+        for semaphore in reversed(semaphores):
+            semaphore.release()
+
+'''Brings a gateway back to defaults when its test could not do it itself'''
+def recover_device(device):
+    logging.warning('{0}: running defaultreset'.format(device['name']))
+    try:
+        ssh=gu.get_ssh(device['gateway_ip'], device['port'], device['gateway_user'], device_password(device))
+        gu.reset_to_default(ssh)
+    except Exception as e:
+        logging.error('{0}: recovery failed: {1!r}'.format(device['name'], e))
+
+def device_password(device):
+    if 'password_env' in device:
+        return os.environ.get(device['password_env'], '')
+    return device.get('password', '')
+
+'''
+Runs led_testing.py for every device of the inventory
+Args:
+devices: devices from read_inventory
+log_root: folder for the per-device log folders and the summary
+workers: number of concurrent test runs
+per_device_limit: maximum number of concurrent runs per gateway or camera host
+test_args: extra led_testing.py arguments
+timeout: maximum duration of one run in seconds
+Returns:
+summary dict
+'''
+def run_farm(devices, log_root, workers, per_device_limit=1, test_args=(), timeout=None):
+    limiter=DeviceLimiter(per_device_limit)
+    running={}
+    running_lock=threading.Lock()
+
+    #if the farm exits, interrupt the running tests so that their atexit handlers restore the gateways
+    def stop_running():
+        with running_lock:
+            processes=list(running.items())
+        for name, (device, process) in processes:
+            interrupt(device, process)
+    atexit.register(stop_running)
+
+    def interrupt(device, process):
+        if process.poll() is not None: return
+        process.send_signal(signal.SIGINT)
+        try: process.wait(INTERRUPT_GRACE_TIME)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            recover_device(device)
+
+    def run(device):
+        log_dir=os.path.join(log_root, device['name'])
+        os.makedirs(log_dir, exist_ok=True)
+        env=dict(os.environ)
+        env['LED_FARM_PASSWORD']=device_password(device)
+        command=[sys.executable, LED_TESTING, device['gateway_ip'], device['gateway_user'], device['camera_ip'],
+            '-p', str(device['port']), '--password-env', 'LED_FARM_PASSWORD', '--log-dir', log_dir] + list(test_args)
+
+        semaphores=limiter.acquire(device)
+        try:
+            start=time.time()
+            with open(os.path.join(log_dir, 'output.txt'), 'w') as output:
+                process=subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT, env=env)
+                with running_lock: running[device['name']]=(device, process)
+                try:
+                    returncode=process.wait(timeout)
+                except subprocess.TimeoutExpired:
+                    logging.error('{0}: timed out after {1} s'.format(device['name'], timeout))
+                    interrupt(device, process)
+                    returncode=None
+                finally:
+                    with running_lock: running.pop(device['name'], None)
+            duration=time.time()-start
+        finally:
+            limiter.release(semaphores)
+
+        status={0: 'passed', 2: 'failed'}.get(returncode, 'error')
+        logging.info('{0}: {1} in {2:.1f} s'.format(device['name'], status, duration))
+        return {'name': device['name'], 'gateway_ip': device['gateway_ip'], 'camera_ip': device['camera_ip'],
+            'status': status, 'returncode': returncode, 'duration': duration, 'log_dir': log_dir}
+
+    start=time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='farm') as executor:
+        results=list(executor.map(run, devices))
+    atexit.unregister(stop_running)
+
+    durations=[result['duration'] for result in results]
+    return {'devices': len(results), 'workers': workers,
+        'passed': sum(result['status'] == 'passed' for result in results),
+        'failed': sum(result['status'] == 'failed' for result in results),
+        'errors': sum(result['status'] == 'error' for result in results),
+        'wall_time': time.time()-start, 'device_time': sum(durations),
+        'max_duration': max(durations, default=0), 'results': results}
+
+def main(argv):
+    #led_testing.py options follow --
+    test_args=[]
+    if '--' in argv:
+        test_args=argv[argv.index('--')+1:]
+        argv=argv[:argv.index('--')]
+    arg_parser=argparse.ArgumentParser(description='test LEDs of many gateways in parallel, non-interactively',
+        epilog='led_testing.py options can be given after --, e.g. -- -g -s -i /tmp/led-inference.sock')
+    arg_parser.add_argument('inventory', help='JSON inventory of gateway/camera pairs')
+    arg_parser.add_argument('-w', '--workers', type=int, default=4, help='concurrent test runs (default 4)')
+    arg_parser.add_argument('-l', '--per-device-limit', type=int, default=1, help='concurrent runs per gateway or camera (default 1)')
+    arg_parser.add_argument('-t', '--timeout', type=float, help='maximum duration of one run in seconds')
+    arg_parser.add_argument('-o', '--log-root', default='./led_farm_log_' + '_'.join(str(t) for t in time.localtime()[:6]), help='log folder')
+    args=arg_parser.parse_args(argv[1:])
+
+    os.makedirs(args.log_root, exist_ok=True)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)-5.5s]  %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+
+    devices=read_inventory(args.inventory)
+    summary=run_farm(devices, args.log_root, args.workers, args.per_device_limit, test_args, args.timeout)
+    with open(os.path.join(args.log_root, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    for result in summary['results']:
+        logging.info('{0:<24} {1:<7} {2:7.1f} s  {3}'.format(result['name'], result['status'], result['duration'], result['log_dir']))
+    logging.info('{0} devices: {1} passed, {2} failed, {3} errors. wall time {4:.1f} s, sum of device times {5:.1f} s'.format(
+        summary['devices'], summary['passed'], summary['failed'], summary['errors'], summary['wall_time'], summary['device_time']))
+    return 0 if summary['passed'] == summary['devices'] else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
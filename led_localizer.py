@@ -0,0 +1,123 @@
+import numpy as np
+
+import models
+from lazy_import import LazyModule
+cv2=LazyModule('cv2')
+
+#LED localizers of led_testing: CNN models only, or this module with the CNN models as fallback
+LOCALIZERS=['cnn', 'cascade']
+
+#minimum change of a pxl (largest over the BGR channels) between the lit and the off frame
+DIFF_THR=40
+#minimum area of a LED blob in pxls
+MIN_AREA=6
+#maximum ratio between the largest and the smallest LED area
+MAX_AREA_RATIO=4.0
+#maximum coefficient of variation of the gaps between neighboring LEDs
+MAX_GAP_CV=0.25
+#maximum distance of a LED center from the row, in LED sizes
+MAX_ROW_DEVIATION=0.5
+#minimum ratio between the change of the status LED and the next largest change
+MIN_STATUS_CONTRAST=2.0
+#pxls added around the blob bounding box
+BOX_PADDING=2
+
+#largest value over the channels of every pxl, much faster than img.max(axis=2)
+def channel_max(img):
+    b, g, r = cv2.split(img)
+    return cv2.max(cv2.max(b, g), r)
+
+'''
+Finds blobs of pxls lit between two frames
+Args:
+lit: frame with the LEDs on
+off: frame of the same size with the LEDs off
+Returns:
+(areas, boxes (y_UL, x_UL, y_BR, x_BR), centers (y, x)) as arrays, largest blob first
+'''
+def find_blobs(lit, off):
+    diff=channel_max(cv2.absdiff(lit, off))
+    mask=cv2.morphologyEx((diff >= DIFF_THR).astype(np.uint8), cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+    _, _, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    #label 0 is the background
+    stats, centroids = stats[1:], centroids[1:]
+    keep=stats[:, cv2.CC_STAT_AREA] >= MIN_AREA
+    stats, centroids = stats[keep], centroids[keep]
+    order=np.argsort(-stats[:, cv2.CC_STAT_AREA], kind='stable')
+    stats, centroids = stats[order], centroids[order]
+    x, y, w, h = (stats[:, i] for i in (cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP, cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT))
+    boxes=np.stack([y, x, y+h, x+w], axis=1).reshape(-1, 4)
+    return stats[:, cv2.CC_STAT_AREA], boxes, centroids[:, ::-1]
+
+'''
+Checks that blobs form one evenly spaced row of LEDs
+Args:
+areas, boxes, centers: output of find_blobs
+count: expected number of LEDs
+Returns:
+(boxes sorted along the row, None) or (None, reason of the failure)
+'''
+def check_row(areas, boxes, centers, count=models.LEDS_COUNT):
+    if len(areas) != count:
+        return None, 'found {0} blobs instead of {1}'.format(len(areas), count)
+    if areas.max() > MAX_AREA_RATIO*areas.min():
+        return None, 'LED sizes differ {0:.1f} times'.format(areas.max()/areas.min())
+    spread=centers.max(axis=0)-centers.min(axis=0)
+    axis=0 if spread[0] > spread[1] else 1
+    order=np.argsort(centers[:, axis], kind='stable')
+    boxes, centers = boxes[order], centers[order]
+    gaps=np.diff(centers[:, axis])
+    size=np.median(np.maximum(boxes[:, 2]-boxes[:, 0], boxes[:, 3]-boxes[:, 1]))
+    if gaps.min() < size:
+        return None, 'LEDs overlap'
+    if gaps.std() > MAX_GAP_CV*gaps.mean():
+        return None, 'uneven LED spacing'
+    #distance from the line through the first and the last LED
+    line=centers[-1]-centers[0]
+    offsets=centers-centers[0]
+    deviation=np.abs(line[0]*offsets[:, 1]-line[1]*offsets[:, 0])/np.linalg.norm(line)
+    if deviation.max() > MAX_ROW_DEVIATION*size:
+        return None, 'LEDs are not in one row'
+    return boxes, None
+
+'''
+Finds which end of the row is the status LED
+Args:
+lit: frame with the LEDs on
+status_off: frame with the LEDs on except the status LED
+boxes: LED boxes sorted along the row
+Returns:
+(index of the status LED, None) or (None, reason of the failure)
+'''
+def find_status_led(lit, status_off, boxes):
+    diff=channel_max(cv2.absdiff(lit, status_off))
+    changes=np.array([diff[y_UL:y_BR, x_UL:x_BR].mean() for y_UL, x_UL, y_BR, x_BR in boxes])
+    status=int(np.argmax(changes))
+    if status not in (0, len(boxes)-1):
+        return None, 'the status LED is not at the end of the row'
+    if changes[status] < MIN_STATUS_CONTRAST*np.delete(changes, status).max():
+        return None, 'the status LED did not switch off'
+    return status, None
+
+'''
+Localizes the LEDs of a display without the CNN models
+Args:
+lit: frame with all LEDs on
+off: frame with all LEDs off
+status_off: frame with all LEDs on except the status LED, for the LED order
+count: expected number of LEDs
+Returns:
+(models.LedDetections sorted along the display as DisplayLedsSchemeModel.detect returns them, None)
+or (None, reason of the failure)
+'''
+def locate_leds(lit, off, status_off, count=models.LEDS_COUNT):
+    boxes, reason = check_row(*find_blobs(lit, off), count=count)
+    if boxes is None: return None, reason
+    status, reason = find_status_led(lit, status_off, boxes)
+    if status is None: return None, reason
+    #class 0 is the status LED, reversed displays show the classes as 4,3,2,1,0
+    classes=np.arange(count) if status == 0 else np.arange(count)[::-1]
+    height, width = lit.shape[:2]
+    padded=boxes+np.array([-BOX_PADDING, -BOX_PADDING, BOX_PADDING, BOX_PADDING])
+    padded=np.clip(padded, 0, [height, width, height, width])
+    return models.LedDetections(padded, classes, np.ones(count)), None
@@ -1,3 +1,7 @@
+import time
+#startup report: time spent importing this module
+IMPORT_START=time.perf_counter()
+
 import getpass
 import logging
 import argparse
@@ -5,15 +9,27 @@ import argparse
 import os
 import sys
 import atexit
-import time
+import re
+import concurrent.futures
 
-import cv2
 import numpy as np
-from matplotlib import pyplot as plt
+
+from lazy_import import LazyModule
+#OpenCV and TensorFlow (through models) are imported on first use
+cv2=LazyModule('cv2')
 
 import gateway_util as gu
 import camera_util as cu
 import models
+import analysis_util as au
+import calibration
+import artifact_writer as aw
+import recordings
+import pipeline as pl
+import led_localizer as ll
+import timing
+
+IMPORT_TIME=time.perf_counter()-IMPORT_START
 
 # Colors to draw detected boxes for LEDs
 COLORS=[(255,0,0),(0,255,0),(0,0,255),(255,255,255),(128,128,128)]
@@ -29,8 +45,19 @@ datetime='_'.join(str(t) for t in time.localtime()[:6])
 #Logging setup
 LOG_FILE = 'pure-ed500_led_test_'+datetime+'.log'
 CONFIG_BEFORE_TEST = 'config.txt'
+TIMINGS_FILE = 'timings.json'
 LOG_DIR='./pure-ed500_led_test_log_'+ datetime
-os.mkdir(LOG_DIR)
+#Exit code when the test ran, but some LEDs did not work as expected (errors exit with 1)
+EXIT_LEDS_FAILED=2
+#fixed waits for the camera picture after a settings change and for the LEDs after a command
+CAMERA_SETTLE_SECONDS=3
+LED_SETTLE_SECONDS=0.3
+#longest wait for the LEDs to take their new state (LedSettle)
+LED_SETTLE_TIMEOUT=2.0
+#how long a blinking LED stays lit or off, per behavior
+BLINK_HALF_PERIODS={'FLASH_SLOW': au.FLASH_SLOW_HALF_PERIOD, 'FLASH_FAST': 1/au.FLASH_FAST_FREQUENCY/2}
+#longest wait for the camera picture to settle (settle_camera)
+CAMERA_SETTLE_TIMEOUT=6
 
 """Maps router LED name on the detected LED index
 Args:
@@ -62,27 +89,7 @@ Returns:
 eucledean distance (matrix of size MxNx1) in HSV space between frame and off-frame
 """
 def hsv_distance_between_pxls(off_hsv, led_hsv):
-    off_h, off_s, off_v =cv2.split(off_hsv)
-    off_h=np.float32(off_h) /255.0  
-    off_s=np.float32(off_s) /255.0  
-    off_v=np.float32(off_v) /255.0
-    
-    led_h, led_s, led_v =cv2.split(led_hsv)
-    led_h=np.float32(led_h) /255.0  
-    led_s=np.float32(led_s) /255.0  
-    led_v=np.float32(led_v) /255.0
-    euc_dist=np.zeros_like(led_v)
-    
-    for i in range(off_h.shape[0]):
-        for j in range(off_h.shape[1]):
-            x=off_v[i,j]*off_s[i,j]*np.cos(2*np.pi*off_h[i,j])
-            x_prim=led_v[i,j]*led_s[i,j]*np.cos(2*np.pi*led_h[i,j])
-            y=off_v[i,j]*off_s[i,j]*np.sin(2*np.pi*off_h[i,j])
-            y_prim=led_v[i,j]*led_s[i,j]*np.sin(2*np.pi*led_h[i,j])
-            z=off_v[i,j]
-            z_prim=led_v[i,j]
-            euc_dist[i,j]=np.sqrt((x-x_prim)**2 + (y-y_prim)**2 + (z-z_prim)**2)
-    return euc_dist        
+    return au.hsv_distance(off_hsv, led_hsv)
 
 """Analazes frames and returns LED behavior and color
 Args:
@@ -91,27 +98,14 @@ frames: the list of frames of size MxNx3 acquired during 5 seconds.
 night: 1 or 0. Information about environment 
     (if lights in the lab are off, should be 1, otherwise 0).
 off: a frame of size MxNx3 (same as size of each frame in frames argument)
+timestamps: capture times of the frames. If given, the blink frequency is fitted
+    to the timestamps (au.estimate_blink) instead of counting switches in 5 seconds
 
 Returns:
 (color, behavior): color is the str 'green', 'orange', 'off' or 'red'
 behavior: str 'CONSTANT', 'FLASH_FAST' or 'FLASH_SLOW'
 """
-def whichBehavior(frames,night,off,LED):
-    #THRESHOLDS
-    #Saturation threshold to filter out too white areas in the dark conditions.
-    SAT_THR=15    
-    #HSV eucledean distance threshold to filter out pxls that changed color
-    HSV_DIST_THR=0.2
-    #Fraction of changed pxls in order 
-    # to consider that the LED color is different from off state.
-    CHANGED_COLOR_FRACTION_THR = 0.013
-    #The difference between 'a' and 'b' channels in L*a*b* space 
-    # is lower for orange and higher for red.  
-    RED_ORANGE_a_b_diff_THR = 24 if night else 35
-
-    color='off'
-    behavior=''
-    colors=[]  
+def whichBehavior(frames,night,off,LED,timestamps=None):
     off_hsv=cv2.cvtColor(off,cv2.COLOR_BGR2HSV)
     off_Lab=cv2.cvtColor(off,cv2.COLOR_BGR2LAB)
     off_L,off_a,off_b=cv2.split(off_Lab)
@@ -123,162 +117,509 @@ def whichBehavior(frames,night,off,LED):
     logging.debug('mean off s: ' + str(np.mean(off_s)))
     logging.debug('mean off v: ' + str(np.mean(off_v)))
     logging.debug('frames: ' + str(len(frames)))
-    logging.debug('hsv dist thr: ' + str(HSV_DIST_THR))
-    logging.debug('fraction thr: ' + str(CHANGED_COLOR_FRACTION_THR))
-    
-    #colored_fraction is for debugging
-    colored_fractions =[] 
-    #lists of means over 'a' channel, and means over 'b' channel
-    a_means, b_means =[],[]   
-    for i in range(len(frames)-1):
-        led=frames[i].copy()              
-        #hsv_dist:
-        led_hsv=cv2.cvtColor(led,cv2.COLOR_BGR2HSV)
-        hsv_dist=hsv_distance_between_pxls(off_hsv,led_hsv)
-        #mask to filter pxls that changed color
-        mask= (hsv_dist >= HSV_DIST_THR).astype(np.uint8)*255               
-        #mask to filter out "too white" pxls
-        if night:
-            _,led_s,_ = cv2.split(led_hsv)
-            mask_sat = (led_s > SAT_THR).astype(np.uint8)*255
-            #combined mask
-            mask=cv2.bitwise_and(mask,mask_sat)
-            
-        #Apply mask to filter color pxls    
-        led_thr=cv2.bitwise_and(led,led, mask=mask)   
+    logging.debug('hsv dist thr: ' + str(au.HSV_DIST_THR))
+    logging.debug('fraction thr: ' + str(au.CHANGED_COLOR_FRACTION_THR))
 
-        #Reshape to list of pxls
-        led_thr_reshaped=np.squeeze(led_thr.reshape(1,-1,3))
-        
-        #extract color pxls
-        changed_pxls=np.delete(led_thr_reshaped, np.where(led_thr_reshaped==[0,0,0]),axis=0) 
+    #the last frame is not analyzed
+    stats=au.frame_stack_statistics(frames[:-1],night,off)
+    if timestamps is not None:
+        return au.classify_statistics_timed(stats,timestamps[:len(frames)-1],night)[:2]
+    return au.classify_statistics(stats,night)
 
-        #count fraction of pxls that changed color 
-        colored_fractions.append(changed_pxls.shape[0]/(led.shape[0]*led.shape[1]))
-                
-        #if less than certain fraction threshold - 
-        # consider color didn't change, do not analyze it.
-        if colored_fractions[-1] <= CHANGED_COLOR_FRACTION_THR:
-            colors.append(0)
-            continue  
-
-        #analize the color if it was changed
-        colors.append(1)
-
-        #find 'a' channel mean and 'b' channel mean
-        #Assumption: when LED responds to object state change, 
-        #it doesn't change the base color (only one LED respond, and that LED has only one color)   
-        changed_Lab=cv2.cvtColor(np.expand_dims(changed_pxls,axis=0),cv2.COLOR_BGR2Lab)
-        changed_a=changed_Lab[:,:,1].flatten()
-        changed_b=changed_Lab[:,:,2].flatten()
-
-        changed_a_mean=np.mean(changed_a)
-        changed_b_mean=np.mean(changed_b)
-
-        a_means.append(changed_a_mean)
-        b_means.append(changed_b_mean)
-
-    logging.debug('max fraction: ' + str(np.max(colored_fractions)) + ' min fraction: ' + str(np.min(colored_fractions)))
-
-    #number of frames that didn't change the color
-    non_off_frames = np.count_nonzero(colors)
-    logging.debug('color frames: ' + str(non_off_frames))
-    #reduce the list from form 11110000111110000111 to form 10101. 
-    colors=[value for idx, value in enumerate(colors) if idx==0 or value!=colors[idx-1]]
-    #the number of times the color changed during the test time
-    number_of_switches = len(colors)
-        
-    #find channel average over all ON frames
-    if non_off_frames > 3:
-        a_means_avg=np.mean(a_means)
-        b_means_avg=np.mean(b_means)
-
-        logging.debug('a_means avg: ' + str(a_means_avg)) 
-        logging.debug('b_means avg: ' + str(b_means_avg)) 
-
-        #green is usually closer to green on the scale green-red,
-        #since the middle is 128, if the 'a' channel is lower than 128,
-        # the LED is green 
-        if a_means_avg < 128:
-            color='green'    
-        #The red and orange are too close to each other, 
-        # but orange has less difference between 'a' and 'b' channel:    
-        elif abs(b_means_avg - a_means_avg) < RED_ORANGE_a_b_diff_THR:
-            color='orange'
-        elif abs(b_means_avg - a_means_avg) >= RED_ORANGE_a_b_diff_THR:
-            color='red'
-       
-    #constant behavior is either on or off
-    if number_of_switches < 4 or color == 'off':
-        behavior='CONSTANT'
-
-    #during 5 seconds with 30 fps we get approx 150 frames (in reality 166-168)
-    #When FLASH_SLOW there are approx 6 - 7 changes, 
-    #when FLASH_FAST - around 22 - 23 changes.  
-    elif number_of_switches < 13:
-        behavior='FLASH_SLOW'
-    else:
-        behavior='FLASH_FAST'
-           
-    logging.debug('switches under 5s: ' + str(number_of_switches))
-  
-    return(color,behavior)
+"""Checks whether an expected state means that the LED is off
+Args:
+LED_color, LED_behavior: expected color and behavior from the config
+Returns:
+True if the LED is expected to be off
+"""
+def is_off_state(LED_color, LED_behavior):
+    return LED_behavior == 'OFF' or (LED_color == 'off' and LED_behavior == 'ON')
+
+"""Returns the state a LED settles to for the wait after its command: 'OFF', 'ON' or 'FLASH'"""
+def settle_behavior(LED_color, LED_behavior):
+    if is_off_state(LED_color, LED_behavior): return 'OFF'
+    return 'ON' if LED_behavior == 'ON' else 'FLASH'
+
+"""Compares expected and detected LED state
+Returns:
+True if the detected color and behavior match the expected ones
+"""
+def is_behavior_correct(LED_color, LED_behavior, detected_color, detected_behavior):
+    if (LED_color=='off' or LED_behavior=='OFF') and detected_color == 'off' and detected_behavior == 'CONSTANT':
+        return True
+    return LED_color==detected_color and \
+        (LED_behavior == detected_behavior or (LED_behavior=='ON' and detected_behavior=='CONSTANT'))
+
+"""Returns the box of the detected LED with index led_idx as integers (y_UL, x_UL, y_BR, x_BR)"""
+def led_box(leds, led_idx):
+    return tuple(leds.int_boxes()[led_idx].tolist())
+
+"""Enlarges LED box by its width and height on every side, within the CNN input
+Args:
+box: (y_UL, x_UL, y_BR, x_BR)
+Returns:
+enlarged box (y_UL, x_UL, y_BR, x_BR)
+"""
+def enlarged_box(box):
+    y_UL, x_UL, y_BR, x_BR = box
+    w, h = x_BR - x_UL, y_BR - y_UL
+    return (max(0,y_UL-h), max(0,x_UL-w), min(CNN_INPUT_H,y_BR+h), min(CNN_INPUT_W,x_BR+w))
+
+"""Returns indices of detected LEDs adjacent to the LED with index led_idx"""
+def neighbor_leds(led_idx, leds_count=5):
+    return [idx for idx in (led_idx-1, led_idx+1) if 0 <= idx < leds_count]
+
+"""Returns the set of led objects changed by a ubus command"""
+def command_objects(command):
+    return set(re.findall(r'led\.(\S+) set', command))
+
+"""Finds every LED a command drives: the LEDs of all mapping records whose object states
+the command sets, e.g. 'internet_test notice && broadband_test ok' also drives uplink
+Args:
+command: ubus command from get_command_and_expected_behavior_dict
+mapping: mapping from gateway_util.read_config_and_mapping
+isOrderReversed: 1 or 0
+Returns:
+dict detected LED index -> True if the command may light it
+"""
+def command_leds(command, mapping, isOrderReversed):
+    set_states=dict(re.findall(r'led\.(\S+) set "\{\\"state\\" : \\"([^\\]*)\\"\}"', command))
+    driven={}
+    for objects, states, LED, LED_color, LED_behavior in zip(mapping['objects'], mapping['states'],
+            mapping['LED'], mapping['LED_color'], mapping['LED_behavior']):
+        led_idx=map_to_visible_led(LED, isOrderReversed)
+        if led_idx is None or not all(set_states.get(o) == s for o, s in zip(objects, states)): continue
+        driven[led_idx]=driven.get(led_idx, False) or not is_off_state(LED_color, LED_behavior)
+    return driven
+
+"""Splits command - behavior pairs into groups of LEDs that can be tested at the same time.
+Within a group each LED is tested once, no two LEDs driven by different commands
+(the tested LED and the other LEDs of the command, see command_leds) are adjacent
+and no two commands change the same object.
+Args:
+command_behavior_dict: dict command -> (LED, LED_color, LED_behavior)
+isOrderReversed: 1 or 0
+driven: dict command -> command_leds of the command, None if commands only drive the tested LED
+Returns:
+list of groups, each group is a list of (command, (LED, LED_color, LED_behavior), led_idx)
+"""
+def schedule_led_groups(command_behavior_dict, isOrderReversed, driven=None):
+    driven=driven or {}
+    def occupied(command, led_idx):
+        return {led_idx} | set(driven.get(command, {}))
+    groups=[]
+    for command, expected in command_behavior_dict.items():
+        led_idx=map_to_visible_led(expected[0], isOrderReversed)
+        objects=command_objects(command)
+        used=occupied(command, led_idx)
+        for group in groups:
+            if all(abs(a-b) > 1 for c,_,idx in group for a in used for b in occupied(c, idx)) and \
+                    not any(objects & command_objects(c) for c,_,_ in group):
+                group.append((command, expected, led_idx))
+                break
+        else:
+            groups.append([(command, expected, led_idx)])
+    return groups
+
+"""Tests groups of non-adjacent LEDs from one capture per group.
+Every tested LED is checked in its enlarged box, and its untested neighbors,
+that are known to be off and not driven by the group commands, are checked to stay off in their detected box.
+Args:
+ssh: connection to the rgw
+groups: groups returned by schedule_led_groups
+leds: detected leds (models.LedDetections)
+img_day_mode: image where all LEDs are off
+night: 1 or 0
+capture_rois: callable capture_rois(boxes, on_frame) returning an array of frames per box
+early_stop: analyze frames while capturing and stop once all decisions are settled
+writer: ArtifactWriter for frames of failed checks
+blink_classifier: one of au.BLINK_CLASSIFIERS
+recorder: recordings.SessionRecorder that records every capture, or None
+analysis: pipeline.AnalysisPipeline for full captures, or None to analyze in this process.
+    Its results are not included in the return value, see AnalysisPipeline.close
+led_settle: LedSettle for the wait after the commands, None for the fixed wait
+driven: dict command -> command_leds of the command, None if commands only drive the tested LED
+Returns:
+True if some LED did not work as expected
+"""
+def test_led_groups(ssh, groups, leds, img_day_mode, night, capture_rois, early_stop, writer, blink_classifier='switches', recorder=None, analysis=None, led_settle=None, driven=None):
+    led_settle=led_settle or LedSettle()
+    driven=driven or {}
+    test_failed=False
+    #commands to switch a LED off, per detected LED index
+    off_commands={}
+    for group in groups:
+        for command, (LED, LED_color, LED_behavior), led_idx in group:
+            if is_off_state(LED_color, LED_behavior): off_commands.setdefault(led_idx, command)
+    #LEDs that may be on after the previous group
+    lit=set()
+
+    for group_idx, group in enumerate(groups):
+        tested=[led_idx for _,_,led_idx in group]
+        #other LEDs the group commands drive, e.g. uplink with a super state of internet
+        others={led_idx for command,_,_ in group for led_idx in driven.get(command, {})} - set(tested)
+        logging.info('group {0}: leds {1}'.format(group_idx, tested))
+
+        #switch off LEDs lit by the previous group so that their light doesn't 'leak',
+        #then switch the group on, all in one batch
+        to_switch_off=[led_idx for led_idx in sorted(lit - set(tested)) if led_idx in off_commands]
+        commands=[off_commands[led_idx] for led_idx in to_switch_off]
+        commands.append(' && '.join(c for c,_,_ in group))
+        logging.debug('Switching off leds {0}'.format(to_switch_off))
+        logging.info('command: {0}'.format(commands[-1]))
+        baseline=led_settle.before()
+        for command, result in zip(commands, gu.execute_batch(ssh, commands)):
+            if result.stderr != []: sys.exit('Could not execute command ' + command)
+        lit-=set(to_switch_off)
+        led_settle.expect([led_box(leds, led_idx) for led_idx in to_switch_off], 'off', 'OFF')
+
+        #tested LEDs in enlarged boxes, neighbors that should stay off in their own boxes
+        neighbors=sorted({n for led_idx in tested for n in neighbor_leds(led_idx, len(leds))} - set(tested) - lit - others)
+        boxes=[enlarged_box(led_box(leds, led_idx)) for led_idx in tested]
+        boxes+=[led_box(leds, led_idx) for led_idx in neighbors]
+        #only the tested LEDs show when the group took its state
+        tested_boxes=[led_box(leds, led_idx) for led_idx in tested]
+        led_settle.wait_for_leds(baseline, [((y_UL, x_UL, y_BR, x_BR), img_day_mode[y_UL:y_BR, x_UL:x_BR], LED_color, LED_behavior)
+            for (y_UL, x_UL, y_BR, x_BR), (_,(LED, LED_color, LED_behavior),_) in zip(tested_boxes, group)])
+        offs=[img_day_mode[y_UL:y_BR, x_UL:x_BR] for (y_UL, x_UL, y_BR, x_BR) in boxes]
+
+        analyzers=[au.StreamingBehaviorAnalyzer(night, off, blink_classifier) for off in offs] if early_stop else None
+        timestamps=[]
+        def on_frame(crops, timestamp):
+            timestamps.append(timestamp)
+            if not early_stop: return False
+            with timing.span('analysis.feed'):
+                settled=[analyzer.feed(crop, timestamp) for analyzer, crop in zip(analyzers, crops)]
+            return all(settled)
+        t_capture=time.time()
+        rois=capture_rois(boxes, on_frame)
+        if rois is None: sys.exit('Failed to acquire frames')
+        logging.debug('capture took {0:.2f} s for {1} frames'.format(time.time()-t_capture, len(rois[0])))
+
+        expectations=[(LED, LED_color, LED_behavior) for _,(LED, LED_color, LED_behavior),_ in group]
+        expectations+=[('neighbor' + str(led_idx), 'off', 'OFF') for led_idx in neighbors]
+        if analysis is not None and not early_stop:
+            #analyzed while the next group is captured
+            for i, (LED, LED_color, LED_behavior) in enumerate(expectations):
+                analysis.submit(LED, LED_color, LED_behavior, commands[-1], night, offs[i], rois[i], timestamps)
+            analysis.report()
+            expectations=[]
+        for i, (LED, LED_color, LED_behavior) in enumerate(expectations):
+            with timing.span('analysis'):
+                if early_stop: (detected_color, detected_behavior) = analyzers[i].result()
+                else: (detected_color, detected_behavior) = whichBehavior(rois[i], night, offs[i], LED,
+                    timestamps if blink_classifier == 'timestamps' else None)
+            logging.info('led: {0} expected color: {1} behavior: {2} detected color: {3} behavior: {4}'.format(
+                LED, LED_color, LED_behavior, detected_color, detected_behavior))
+            if recorder is not None:
+                recorder.record(LED, commands[-1], LED_color, LED_behavior, night, offs[i], rois[i], timestamps, (detected_color, detected_behavior))
+            if is_behavior_correct(LED_color, LED_behavior, detected_color, detected_behavior):
+                logging.info('CORRECT')
+            else:
+                test_failed=True
+                writer.write_frames(LED + '_' + LED_color + '_' + LED_behavior, rois[i], timestamps)
+                logging.error('WRONG')
+
+        for command,_,_ in group:
+            for led_idx, may_be_lit in driven.get(command, {}).items():
+                if led_idx not in others: continue
+                #the state of a LED driven along with another one is not known exactly
+                if may_be_lit:
+                    lit.add(led_idx)
+                    led_settle.expect([led_box(leds, led_idx)])
+                else:
+                    lit.discard(led_idx)
+                    led_settle.expect([led_box(leds, led_idx)], 'off', 'OFF')
+        for _,(LED, LED_color, LED_behavior),led_idx in group:
+            if is_off_state(LED_color, LED_behavior): lit.discard(led_idx)
+            else: lit.add(led_idx)
+    return test_failed
+
+"""Lights the LEDs and localizes them without the CNN models (led_localizer), from a frame
+with all LEDs on, one with all LEDs but the status LED on and one with all LEDs off.
+The LEDs are off afterwards
+Args:
+ssh: connection to the rgw
+shoot: callable returning a frame of the central part of fov
+command_behavior_dict: commands and expected behaviors from the config
+led_settle: LedSettle for the wait after the commands, None for the fixed wait
+Returns:
+(leds, isOrderReversed, frame with all LEDs on) or None if the LEDs could not be localized
+"""
+def localize_lit_leds(ssh, shoot, command_behavior_dict, led_settle=None):
+    led_settle=led_settle or LedSettle()
+    #one command per LED that lights it constantly and one that switches it off
+    on_commands, off_commands = {}, {}
+    for command, (LED, LED_color, LED_behavior) in command_behavior_dict.items():
+        led_idx=map_to_visible_led(LED, 0)
+        if led_idx is None: continue
+        if is_off_state(LED_color, LED_behavior): off_commands.setdefault(led_idx, command)
+        elif LED_behavior == 'ON': on_commands.setdefault(led_idx, command)
+    if len(on_commands) < models.LEDS_COUNT or len(off_commands) < models.LEDS_COUNT:
+        logging.info('LED localization: not every LED has a constant and an off state, using the CNN models')
+        return None
+
+    def run_and_shoot(commands):
+        baseline=led_settle.before()
+        for command, result in zip(commands, gu.execute_batch(ssh, commands)):
+            if result.stderr != []: sys.exit('Could not execute command ' + command)
+        led_settle.wait(baseline)
+        img=shoot()
+        if img is None: sys.exit('Failed to acquire an image')
+        return img
+    t=time.perf_counter()
+    lit=run_and_shoot([on_commands[led_idx] for led_idx in sorted(on_commands)])
+    #the status LED is 0 in both orders
+    status_off=run_and_shoot([off_commands[0]])
+    off=run_and_shoot([off_commands[led_idx] for led_idx in sorted(off_commands)])
+    lighting_time=time.perf_counter()-t
+
+    t=time.perf_counter()
+    with timing.span('localizer.classical'):
+        leds, reason = ll.locate_leds(lit, off, status_off)
+    if leds is None:
+        logging.info('LED localization: classical failed ({0}) in {1:.1f} ms, using the CNN models'.format(reason, (time.perf_counter()-t)*1000))
+        return None
+    logging.info('LED localization: classical in {0:.1f} ms (lighting the LEDs {1:.2f} s)'.format((time.perf_counter()-t)*1000, lighting_time))
+    return leds, leds.classes.tolist() == [4,3,2,1,0], lit
+
+"""Draws the detected LEDs and their classes on img"""
+def draw_leds(img, leds):
+    for (y_UL, x_UL, y_BR, x_BR), led_class in zip(leds.int_boxes().tolist(), leds.classes.tolist()):
+        img=cv2.rectangle(img, (x_UL,y_UL),(x_BR,y_BR),COLORS[led_class],1)
+        img=cv2.putText(img,str(CLASSES[led_class]), (x_UL,y_UL-4), cv2.FONT_HERSHEY_SIMPLEX, 0.5, COLORS[led_class])
+    return img
+
+"""Loads the LED detector
+Args:
+inference_socket: socket of a running inference_server or None
+backend: one of models.BACKENDS
+model_options: dict of input_size, fit_mode, xla for models.DisplayLedsSchemeModel, or None for the defaults
+Returns:
+model with detect(img)
+"""
+def load_model(inference_socket=None, backend='savedmodel', model_options=None):
+    if inference_socket:
+        try: return models.RemoteDisplayLedsSchemeModel(inference_socket)
+        except OSError: logging.warning('Inference server on {0} is not available, loading model locally'.format(inference_socket))
+    return models.DisplayLedsSchemeModel(backend, **(model_options or {}))
+
+"""Waits for the camera picture or the LEDs to settle, the wait is timed as stage"""
+def settle(seconds, stage):
+    with timing.span(stage):
+        time.sleep(seconds)
+
+"""Waits for the camera picture to settle after a settings change, timed as camera.settle
+Args:
+grab: callable returning a new frame to wait until the picture is stable, None for the fixed wait
+"""
+def settle_camera(grab=None):
+    if grab is None: return settle(CAMERA_SETTLE_SECONDS, 'camera.settle')
+    with timing.span('camera.settle'):
+        settled, seconds = cu.wait_until_stable(grab, CAMERA_SETTLE_TIMEOUT)
+    if settled: logging.debug('camera picture settled in {0:.2f} s'.format(seconds))
+    else: logging.warning('camera picture did not settle in {0:.2f} s'.format(seconds))
+
+"""Waits for the LEDs to take their new state after gateway commands, timed as gateway.led_settle.
+With an open camera stream the wait ends once the watched LEDs reached a new steady state,
+at most after LED_SETTLE_TIMEOUT; without a stream it always takes LED_SETTLE_SECONDS.
+The last expected state of every LED box is kept, so that only LEDs that were blinking
+(or in an unknown state) have to hold their new state for half of their blink period.
+Args:
+session: open camera_util.CameraSession or None
+"""
+class LedSettle:
+    def __init__(self, session=None):
+        self.session=session
+        #LED box -> (LED_color, LED_behavior) expected since the last command, missing if unknown
+        self.states={}
+
+    """Records the expected state of LEDs changed without a wait, None if it is unknown
+    Args:
+    boxes: LED boxes
+    LED_color, LED_behavior: state of the LEDs
+    """
+    def expect(self, boxes, LED_color=None, LED_behavior=None):
+        for box in boxes:
+            if LED_behavior is None: self.states.pop(box, None)
+            else: self.states[box]=('off', 'OFF') if is_off_state(LED_color, LED_behavior) else (LED_color, LED_behavior)
+
+    """Returns the picture before the commands, None without a stream"""
+    def before(self):
+        return None if self.session is None else self.session.latest_frame(fresh=False)
+
+    """Waits after commands with an unknown outcome until the picture changed and is steady
+    (camera_util.wait_for_change)
+    Args:
+    baseline: picture returned by before
+    boxes: LED boxes to watch, None for the whole picture
+    """
+    def wait(self, baseline, boxes=None):
+        if baseline is None: return settle(LED_SETTLE_SECONDS, 'gateway.led_settle')
+        with timing.span('gateway.led_settle'):
+            changed, seconds = cu.wait_for_change(self.session.latest_frame, baseline, boxes, LED_SETTLE_TIMEOUT)
+        if changed: logging.debug('LEDs changed in {0:.2f} s'.format(seconds))
+        else: logging.warning('LEDs did not change in {0:.2f} s'.format(seconds))
+
+    """Waits after commands until the commanded LEDs show their expected state in their own box
+    (camera_util.wait_for_led_states)
+    Args:
+    baseline: picture returned by before
+    leds: list of (box, crop of the box from the image with all LEDs off, LED_color, LED_behavior)
+    """
+    def wait_for_leds(self, baseline, leds):
+        previous={box: self.states.get(box) for box, _, _, _ in leds}
+        for box, _, LED_color, LED_behavior in leds: self.expect([box], LED_color, LED_behavior)
+        if baseline is None: return settle(LED_SETTLE_SECONDS, 'gateway.led_settle')
+        #LEDs that keep their state show no change
+        states=[(box, off, settle_behavior(LED_color, LED_behavior),
+            au.FLASH_SLOW_HALF_PERIOD if previous[box] is None else BLINK_HALF_PERIODS.get(previous[box][1], 0))
+            for box, off, LED_color, LED_behavior in leds if previous[box] != self.states[box]]
+        if not states: return
+        with timing.span('gateway.led_settle'):
+            settled, seconds = cu.wait_for_led_states(self.session.latest_frame, baseline, states, LED_SETTLE_TIMEOUT)
+        if settled: logging.debug('LEDs settled in {0:.2f} s'.format(seconds))
+        else: logging.warning('LEDs did not settle in {0:.2f} s'.format(seconds))
+
+"""Logs how long each startup step took
+Args:
+startup: list of (step, seconds)
+"""
+def log_startup_report(startup):
+    logging.info('startup: ' + ', '.join('{0} {1:.2f} s'.format(step, seconds) for step, seconds in startup))
 
 '''Test the LEDs on the Pure ed500 RGW'''
-def pure_ed500_led_test(rgw_hostname, rgw_port, rgw_username, rgw_pass,camera_hostname):
+def pure_ed500_led_test(rgw_hostname, rgw_port, rgw_username, rgw_pass,camera_hostname,early_stop=True,stream_session=False,group_leds=False,inference_socket=None,backend='savedmodel',log_dir=LOG_DIR,calibration_store=None,frame_format='jpg',blink_classifier='switches',recorder=None,analysis_workers=0,localizer='cnn',model_options=None,settle_detection=True):
     test_failed=False
+    startup=[('imports', IMPORT_TIME)]
+    t_start=time.perf_counter()
+    #images and frames of failed checks are encoded and written in the background
+    writer=aw.ArtifactWriter(log_dir, frame_format)
+    #full captures are analyzed in worker processes while the next LED is captured
+    analysis=pl.AnalysisPipeline(analysis_workers, blink_classifier, log_dir, frame_format, recorder) if analysis_workers and not early_stop else None
+
+    #load model in the background while connecting to the rgw and the camera
+    def timed_load_model():
+        t=time.perf_counter()
+        model=load_model(inference_socket, backend, model_options)
+        return model, time.perf_counter()-t
+    model_future=None
+    def start_model_load():
+        nonlocal model_future
+        if model_future is not None: return
+        logging.debug('Loading model...')
+        model_loader=concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='model-loader')
+        model_future=model_loader.submit(timed_load_model)
+        model_loader.shutdown(wait=False)
+    #with a stored calibration or the classical localizer the model is most likely not needed
+    if calibration_store is None and localizer == 'cnn': start_model_load()
+
     #connect to the rgw
     logging.debug('Connecting to RGW...')    
-    try: ssh=gu.get_ssh(rgw_hostname, rgw_port, rgw_username, rgw_pass)
+    try: ssh=gu.get_session(rgw_hostname, rgw_port, rgw_username, rgw_pass)
     except Exception: sys.exit('Failed to connect to the RGW')
+    startup.append(('ssh', time.perf_counter()-t_start))
+
+    if calibration_store is not None:
+        gateway_model=gu.get_gateway_model(ssh)
+        if not calibration_store.has(camera_hostname, gateway_model): start_model_load()
 
     #connect to IP camera
     logging.debug('Connecting to IP camera...')
+    t=time.perf_counter()
     if not cu.isConnected(camera_hostname): sys.exit('Failed to connect to IP camera')
+    startup.append(('camera', time.perf_counter()-t))
+
+    #keep one camera stream open for the whole test if requested
+    session=None
+    if stream_session:
+        logging.debug('Opening camera stream...')
+        session=cu.CameraSession(camera_hostname,CNN_INPUT_W,CNN_INPUT_H)
+        if not session.open(): sys.exit('Failed to open camera stream')
 
-    #load model 
-    logging.debug('Loading model...')
-    try: model=models.DisplayLedsSchemeModel()
-    except Exception: sys.exit('Failed to load model')
+    def shoot():
+        if session is not None: return session.latest_frame()
+        return cu.shoot(camera_hostname,CNN_INPUT_W,CNN_INPUT_H)
+
+    def capture_rois(boxes, on_frame=None):
+        if session is not None: return session.video_rois(boxes,cu.CAPTURE_SECONDS,on_frame=on_frame)
+        return cu.video_rois(camera_hostname,CNN_INPUT_W,CNN_INPUT_H,boxes,cu.CAPTURE_SECONDS,on_frame=on_frame)
+
+    #wait for the picture instead of fixed times, LED changes are only watched on a stream
+    camera_grab=shoot if settle_detection else None
+    led_settle=LedSettle(session if settle_detection else None)
 
     #switch camera to defaults
     logging.debug('Switching camera to defaults...')
-    r_sat=cu.switch_to_default_saturation(camera_hostname) 
-    r_sha=cu.switch_to_default_sharpness(camera_hostname)
-    r_exp=cu.switch_to_default_exposure(camera_hostname)
-    r_con=cu.switch_to_default_contrast(camera_hostname)
-    r_auto=cu.switch_to_auto_mode(camera_hostname)
-    if r_sat and r_sha and r_exp and r_con and r_auto: time.sleep(3)
-    else: sys.exit('Failed to switch to defaults')
+    t=time.perf_counter()
+    cu.forget_known_settings(camera_hostname)
+    r_defaults, changed = cu.switch_to_defaults(camera_hostname)
+    if not r_defaults: sys.exit('Failed to switch to defaults')
+    #the picture only needs time to settle if something was changed
+    if changed: settle_camera(camera_grab)
+    startup.append(('camera defaults', time.perf_counter()-t))
 
     night=0
-    #Take a picture and detect leds, twice if needed
-    for i in range(0,2):
+    calibrated=None
+    if calibration_store is not None:
         logging.debug('Shooting...')
-        img=cu.shoot(camera_hostname,CNN_INPUT_W,CNN_INPUT_H)
-        if img is not None: cv2.imwrite(os.path.join(LOG_DIR,'original.jpg'), img)
-        else: sys.exit('Failed to acquire an image')
-        
-        #Detect leds
-        logging.debug('Detecting leds...')
-        leds=model.detect(img)
-        logging.debug('Postprocessing detection...')
-        order=[led['class'] for led in leds]
-        isOrderReversed=(order==[4,3,2,1,0])
-        isOrderCorrect = (order== [0,1,2,3,4] or isOrderReversed)
-        if isOrderCorrect: break
-        elif i : sys.exit('Failed to correctly detect leds')
-
-    #Saving an image with detected leds
-    logging.debug('Saving detected.jpg...')
-    for led in leds:
-        y_UL=int(led['box'][0])
-        x_UL=int(led['box'][1])
-        y_BR=int(led['box'][2])
-        x_BR=int(led['box'][3])
-        img=cv2.rectangle(img, (x_UL,y_UL),(x_BR,y_BR),COLORS[led['class']],1)
-        img=cv2.putText(img,str(CLASSES[led['class']]), (x_UL,y_UL-4), cv2.FONT_HERSHEY_SIMPLEX, 0.5, COLORS[led['class']])
-    cv2.imwrite(os.path.join(LOG_DIR,'detected.jpg'), img)
+        img=shoot()
+        if img is None: sys.exit('Failed to acquire an image')
+        writer.write_image('original.jpg', img)
+        #reuse the stored geometry if the fixture hasn't moved
+        with timing.span('calibration.validate'):
+            calibrated=calibration_store.validate(camera_hostname, gateway_model, img)
+        if calibrated is not None:
+            logging.info('Using the stored LED calibration for {0} / {1}'.format(camera_hostname, gateway_model))
+            leds, isOrderReversed = calibrated
+            startup.append(('time to first detection (calibration)', time.perf_counter()-t_start))
+            log_startup_report(startup)
+        else:
+            logging.info('No valid LED calibration for {0} / {1}, detecting LEDs'.format(camera_hostname, gateway_model))
+            if localizer == 'cnn': start_model_load()
+
+    def detect_with_model():
+        start_model_load()
+        #wait for the model loaded in the background
+        t=time.perf_counter()
+        try: model, model_load_time = model_future.result()
+        except Exception: sys.exit('Failed to load model')
+        startup.append(('model load (background)', model_load_time))
+        startup.append(('waiting for model', time.perf_counter()-t))
+
+        #Take a picture and detect leds, twice if needed
+        for i in range(0,2):
+            logging.debug('Shooting...')
+            img=shoot()
+            if img is not None: writer.write_image('original.jpg', img)
+            else: sys.exit('Failed to acquire an image')
+            
+            #Detect leds
+            logging.debug('Detecting leds...')
+            leds=model.detect(img)
+            if i == 0:
+                startup.append(('time to first detection', time.perf_counter()-t_start))
+                log_startup_report(startup)
+            logging.debug('Postprocessing detection...')
+            order=leds.classes.tolist()
+            isOrderReversed=(order==[4,3,2,1,0])
+            isOrderCorrect = (order== [0,1,2,3,4] or isOrderReversed)
+            if isOrderCorrect: break
+            elif i : sys.exit('Failed to correctly detect leds')
+        return leds, isOrderReversed, img
+
+    def save_detection(leds, isOrderReversed, img, reference=None):
+        if calibration_store is not None and calibrated is None:
+            calibration_store.save(camera_hostname, gateway_model, leds, isOrderReversed, img if reference is None else reference)
+        #Saving an image with detected leds
+        logging.debug('Saving detected.jpg...')
+        writer.write_image('detected.jpg', draw_leds(img, leds))
+
+    #the cascade localizes the LEDs once the config allows to light them
+    if calibrated is None and localizer == 'cnn':
+        leds, isOrderReversed, img = detect_with_model()
+    if calibrated is not None or localizer == 'cnn':
+        save_detection(leds, isOrderReversed, img)
 
     #Get the infrared filter state
     logging.debug('Getting IR filter state...')
@@ -289,21 +630,25 @@ def pure_ed500_led_test(rgw_hostname, rgw_port, rgw_username, rgw_pass,camera_ho
     #Switch camera to daylight mode
     logging.debug('Switching camera to daylight mode...')
     resp=cu.switch_to_day_mode(camera_hostname)
-    if resp: time.sleep(3)
+    if resp: settle_camera(camera_grab)
     else: sys.exit('Failed to switch to daylight mode')
 
     #Read and copy the config   
     logging.debug('Getting gateway configs...') 
-    try: config = gu.read_and_copy_config(ssh, os.path.join(LOG_DIR,CONFIG_BEFORE_TEST))
-    except Exception: sys.exit('Failed to read and copy config file')
-
     #Get mapping, command to change config, and command to change config back
-    (mapping, uci_c)=gu.get_mapping_and_uci_command_to_change_config(config)
+    #(parsed results are cached by the config checksum)
+    try: (config, mapping, uci_c) = gu.read_config_and_mapping(ssh, os.path.join(log_dir,CONFIG_BEFORE_TEST))
+    except Exception: sys.exit('Failed to read and copy config file')
 
     #Change config
     logging.debug('Changing gateway configs...') 
+    baseline=led_settle.before()
     if not gu.run_uci_command(ssh,uci_c) and not (gu.revert(ssh)):
         sys.exit('Failed to execute uci command and revert staged. See original config in log folder')
+    #the LEDs go off with the test config, before the image where all LEDs are off is taken.
+    #The cascade localizer switches them off itself
+    if calibrated is not None or localizer == 'cnn':
+        led_settle.wait(baseline, [led_box(leds, led_idx) for led_idx in range(len(leds))])
 
     #If something goes wrong, change config back.
     def exit_handler():
@@ -313,18 +658,40 @@ def pure_ed500_led_test(rgw_hostname, rgw_port, rgw_username, rgw_pass,camera_ho
 
     #Get command - behavior dictionary
     command_behavior_dict = gu.get_command_and_expected_behavior_dict(mapping,FUNCTIONS_TO_TEST)
+
+    if calibrated is None and localizer == 'cascade':
+        #the calibration is validated against the first picture of a run
+        reference=img if calibration_store is not None else None
+        located=localize_lit_leds(ssh, shoot, command_behavior_dict, led_settle)
+        if located is not None:
+            leds, isOrderReversed, img = located
+            startup.append(('time to first detection (classical)', time.perf_counter()-t_start))
+            log_startup_report(startup)
+        else:
+            leds, isOrderReversed, img = detect_with_model()
+        save_detection(leds, isOrderReversed, img, reference)
     
     #If not dark, set high saturation
     logging.debug('Switching to high saturation...')
     if not night:
         r_sat = cu.switch_to_high_saturation(camera_hostname)
-        if r_sat: time.sleep(3)  
+        if r_sat: settle_camera(camera_grab)
         else: sys.exit('Failed to switch to high saturation')
         
     #Take an image where all LEDs are off
     logging.debug('Take all OFF image...')
-    img_day_mode=cu.shoot(camera_hostname,CNN_INPUT_W,CNN_INPUT_H)
+    img_day_mode=shoot()
     if img_day_mode is None: sys.exit('Failed to acquire an image')
+    led_settle.expect([led_box(leds, led_idx) for led_idx in range(len(leds))], 'off', 'OFF')
+
+    #Test non-adjacent LEDs together, one capture per group
+    if group_leds:
+        driven = {command: command_leds(command, mapping, isOrderReversed) for command in command_behavior_dict}
+        groups = schedule_led_groups(command_behavior_dict, isOrderReversed, driven)
+        logging.info('{0} checks in {1} groups'.format(len(command_behavior_dict), len(groups)))
+        test_failed = test_led_groups(ssh, groups, leds, img_day_mode, night, capture_rois, early_stop, writer, blink_classifier, recorder, analysis, led_settle, driven)
+        #nothing is left to test one by one
+        command_behavior_dict = {}
 
     #Vars to keep which led is being tested to switch off after the test
     current_led_to_check_idx = None
@@ -335,68 +702,104 @@ def pure_ed500_led_test(rgw_hostname, rgw_port, rgw_username, rgw_pass,camera_ho
                 
         #find led box
         led_to_check_idx = map_to_visible_led(LED, isOrderReversed)
-        
-        y_UL=int(leds[led_to_check_idx]['box'][0])
-        x_UL=int(leds[led_to_check_idx]['box'][1])
-        y_BR=int(leds[led_to_check_idx]['box'][2])
-        x_BR=int(leds[led_to_check_idx]['box'][3])        
-        w, h = x_BR - x_UL, y_BR - y_UL
         logging.info('command: {0}'.format(command))
         logging.info('led: {0}'.format(LED))
         
+        baseline=led_settle.before()
         #if next LED is tested, switch off the current one so that the light from it 
         #doens't 'leak' to neighboring LEDs 
         if current_led_to_check_idx is not None and current_led_to_check_idx != led_to_check_idx:
             logging.debug('Switching off current ')
-            _, _,stderr = ssh.exec_command(command_to_switch_off_current_led)
-            err=stderr.readlines()
+            err=gu.execute(ssh, command_to_switch_off_current_led).stderr
             if err !=[]: sys.exit('Could not execute command ' + command_to_switch_off_current_led)  
+            led_settle.expect([led_box(leds, current_led_to_check_idx)], 'off', 'OFF')
         
         current_led_to_check_idx = led_to_check_idx
 
         #memorize command to switch off the led
-        if LED_behavior == 'OFF' or (LED_color == 'off' and LED_behavior == 'ON'):
+        if is_off_state(LED_color, LED_behavior):
             command_to_switch_off_current_led = command
 
-        _, _, stderr = ssh.exec_command(command)
-        err=stderr.readlines()
+        err=gu.execute(ssh, command).stderr
         if err !=[]: sys.exit('Could not execute command ' + command)
+        #other LEDs of a super state take a state that is not known exactly
+        led_settle.expect([led_box(leds, led_idx) for led_idx in command_leds(command, mapping, isOrderReversed) if led_idx != led_to_check_idx])
         
-        time.sleep(0.3)            
+        #only the tested LED shows when the command took effect
+        y_UL, x_UL, y_BR, x_BR = led_box(leds, led_to_check_idx)
+        led_settle.wait_for_leds(baseline, [((y_UL, x_UL, y_BR, x_BR), img_day_mode[y_UL:y_BR, x_UL:x_BR], LED_color, LED_behavior)])
         #enlarge detected box
-        frames_y_UL = max(0,y_UL-h)
-        frames_x_UL = max(0,x_UL-w)
-        frames_y_BR = min(CNN_INPUT_H,y_BR+h)
-        frames_x_BR = min(CNN_INPUT_W,x_BR+w)
+        frames_y_UL, frames_x_UL, frames_y_BR, frames_x_BR = enlarged_box(led_box(leds, led_to_check_idx))
         #cut the corresponding area from off image
         off = img_day_mode[frames_y_UL:frames_y_BR,frames_x_UL:frames_x_BR]
-        #get frames 
-        frames = cu.video(camera_hostname,CNN_INPUT_W,CNN_INPUT_H,frames_y_UL,frames_x_UL,frames_y_BR,frames_x_BR,5)    
+        #get frames, analyzing them while capturing if early stop is enabled
+        analyzer = au.StreamingBehaviorAnalyzer(night,off,blink_classifier) if early_stop else None
+        timestamps=[]
+        def on_frame(frame, timestamp):
+            timestamps.append(timestamp)
+            if not early_stop: return False
+            with timing.span('analysis.feed'):
+                return analyzer.feed(frame, timestamp)
+        t_capture=time.time()
+        if session is not None:
+            frames = session.video(frames_y_UL,frames_x_UL,frames_y_BR,frames_x_BR,cu.CAPTURE_SECONDS,on_frame=on_frame)
+        else:
+            frames = cu.video(camera_hostname,CNN_INPUT_W,CNN_INPUT_H,frames_y_UL,frames_x_UL,frames_y_BR,frames_x_BR,cu.CAPTURE_SECONDS,on_frame=on_frame)
         if frames is None: sys.exit('Failed to acquire frames')    
+        logging.debug('capture took {0:.2f} s for {1} frames'.format(time.time()-t_capture, len(frames)))
+        if analysis is not None:
+            analysis.submit(LED, LED_color, LED_behavior, command, night, off, frames, timestamps)
+            analysis.report()
+            continue
         logging.debug('Detecting behavior...')
-        (detected_color, detected_behavior) = whichBehavior(frames,night,off,LED)
+        t_analysis=time.time()
+        with timing.span('analysis'):
+            if early_stop: (detected_color, detected_behavior) = analyzer.result()
+            else: (detected_color, detected_behavior) = whichBehavior(frames,night,off,LED,timestamps if blink_classifier == 'timestamps' else None)
+        logging.debug('behavior analysis took {0:.3f} s for {1} frames'.format(time.time()-t_analysis, len(frames)))
         
         logging.info('expected color: {0} behavior: {1}'.format(LED_color, LED_behavior))    
         logging.info('detected color: {0} behavior: {1}'.format(detected_color, detected_behavior))
+        if recorder is not None:
+            recorder.record(LED, command, LED_color, LED_behavior, night, off, frames, timestamps, (detected_color, detected_behavior))
 
-        if (LED_color=='off' or LED_behavior=='OFF') and detected_color == 'off' and detected_behavior == 'CONSTANT':
-            logging.info('CORRECT')
-        elif LED_color==detected_color and \
-            (LED_behavior == detected_behavior or (LED_behavior=='ON' and detected_behavior=='CONSTANT')):
+        if is_behavior_correct(LED_color, LED_behavior, detected_color, detected_behavior):
             logging.info('CORRECT')
         else:
             test_failed=True
             #save the frames:
-            for i in range(0, len(frames)):
-                file_name=LED + '_' + LED_color + '_' + LED_behavior + '_f_' + str(i) + '.jpg'
-                cv2.imwrite(os.path.join(LOG_DIR, file_name), frames[i])
+            writer.write_frames(LED + '_' + LED_color + '_' + LED_behavior, frames, timestamps)
             logging.error('WRONG') 
 
+    if analysis is not None:
+        test_failed = analysis.close() or test_failed
     atexit.unregister(exit_handler)
+    writer.close()
+    if session is not None: session.close()
     cu.reset_to_default(camera_hostname)
     gu.reset_to_default(ssh)
     return test_failed
 
+"""Writes the stage timings of the run to the log folder (timings.json, timings.prom)
+and to the Prometheus textfile if requested
+Args:
+args: parsed arguments of main
+failed: result of pure_ed500_led_test, None if the run was aborted
+"""
+def write_timings(args, failed):
+    result={None: 'aborted', True: 'failed', False: 'passed'}[failed]
+    labels={'gateway': args.gateway_ip, 'camera': args.camera_ip}
+    try:
+        timing.TIMINGS.write_json(os.path.join(args.log_dir, TIMINGS_FILE), dict(labels, result=result))
+        timing.TIMINGS.write_prometheus(os.path.join(args.log_dir, 'timings.prom'), labels)
+        if args.metrics_textfile: timing.TIMINGS.write_prometheus(args.metrics_textfile, labels)
+        if args.profile_analysis and timing.TIMINGS.dump_profile(os.path.join(args.log_dir, 'analysis.prof')):
+            logging.info('analysis profile written to ' + os.path.join(args.log_dir, 'analysis.prof'))
+    except OSError as e:
+        logging.error('Failed to write timings: {0!r}'.format(e))
+    for stage, s in timing.TIMINGS.summary().items():
+        logging.debug('{0:<24} {1:4d} x  total {2:8.3f} s  p50 {3:8.4f} s  p95 {4:8.4f} s'.format(stage, s['count'], s['total'], s['p50'], s['p95']))
+
 def main(argv):
     arg_parser=argparse.ArgumentParser(description='test LEDs. Run defaultreset before')
     arg_parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
@@ -404,28 +807,72 @@ def main(argv):
     arg_parser.add_argument('-p', '--port', type=int, default=22, help= 'gateway ssh port (default 22)')
     arg_parser.add_argument('gateway_user', help='gateway user')
     arg_parser.add_argument('camera_ip', help='camera IP address')
-
-    args=arg_parser.parse_args()
-    gateway_pwd = getpass.getpass(prompt='Enter password for {0} {1}: '.format(args.gateway_ip,args.gateway_user))
+    arg_parser.add_argument('-s', '--stream-session', action='store_true', help='keep one camera stream open for the whole test')
+    arg_parser.add_argument('-g', '--group-leds', action='store_true', help='test non-adjacent LEDs at the same time')
+    arg_parser.add_argument('-i', '--inference-socket', help='use the detectors of a running inference_server on this socket')
+    arg_parser.add_argument('-b', '--backend', choices=models.BACKENDS, default='savedmodel', help='detector backend (default savedmodel)')
+    arg_parser.add_argument('-f', '--full-capture', action='store_true', help='always capture 5 s per LED (no early stop)')
+    arg_parser.add_argument('--password-env', help='read the gateway password from this environment variable instead of prompting')
+    arg_parser.add_argument('-c', '--calibration', action='store_true', help='reuse the LED positions of earlier runs while the fixture stays in place')
+    arg_parser.add_argument('--frame-format', choices=aw.FRAME_FORMATS, default='jpg',
+        help='frames of failed checks as JPEGs, one compressed npz or one video per check (default jpg)')
+    arg_parser.add_argument('--blink-classifier', choices=au.BLINK_CLASSIFIERS, default='switches',
+        help='count switches in 5 s, or fit the blink frequency to frame timestamps, which settles in 1-2 s with early stop (default switches)')
+    arg_parser.add_argument('--metrics-textfile', help='also write the stage timings to this Prometheus textfile (e.g. in the node_exporter textfile directory)')
+    arg_parser.add_argument('--profile-analysis', action='store_true', help='run the behavior analysis under cProfile, written to analysis.prof in the log folder')
+    arg_parser.add_argument('--localizer', choices=ll.LOCALIZERS, default='cnn',
+        help='find the LEDs with the CNN models, or light them and find them with OpenCV, falling back to the CNN models (default cnn)')
+    arg_parser.add_argument('-w', '--analysis-workers', type=int, default=0,
+        help='with -f, analyze each capture in this many worker processes while the next LED is captured (default 0, no workers)')
+    arg_parser.add_argument('--record', metavar='DIR',
+        help='record every capture into DIR for replays with recordings.py, use with -f to keep the full 5 s')
+    arg_parser.add_argument('--fixed-settle', action='store_true',
+        help='wait fixed times after camera settings changes and LED commands instead of watching the picture settle')
+    models.add_model_arguments(arg_parser)
+    arg_parser.add_argument('--log-dir', default=LOG_DIR, help='log folder (default ./pure-ed500_led_test_log_<date>)')
+
+    args=arg_parser.parse_args(argv[1:])
+    if args.password_env:
+        gateway_pwd = os.environ.get(args.password_env)
+        if gateway_pwd is None: sys.exit('Environment variable {0} is not set'.format(args.password_env))
+    else:
+        gateway_pwd = getpass.getpass(prompt='Enter password for {0} {1}: '.format(args.gateway_ip,args.gateway_user))
     
     #logging configuration
     
     logging_level=logging.DEBUG if args.verbose else logging.INFO
     logging.getLogger("tensorflow").setLevel(logging.ERROR)
     logging.getLogger("paramiko").setLevel(logging.WARNING)
-    logging.getLogger("matplotlib").setLevel(logging.ERROR)
     logging.basicConfig(level=logging_level)
     logFormatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s", "%Y-%m-%d %H:%M:%S")
     rootLogger = logging.getLogger()
 
-    fileHandler = logging.FileHandler(os.path.join(LOG_DIR , LOG_FILE))
+    os.makedirs(args.log_dir, exist_ok=True)
+    fileHandler = logging.FileHandler(os.path.join(args.log_dir , LOG_FILE))
     fileHandler.setFormatter(logFormatter)
     rootLogger.addHandler(fileHandler)
 
-    failed = pure_ed500_led_test(args.gateway_ip, args.port, args.gateway_user,gateway_pwd, args.camera_ip)
+    if args.profile_analysis: timing.TIMINGS.profile_stages(['analysis', 'analysis.feed'])
+    timing.TIMINGS.add('imports', IMPORT_TIME)
+    models.configure_threads(args.tf_intra_threads, args.tf_inter_threads)
+    failed=None
+    recorder=recordings.SessionRecorder(args.record, {'gateway': args.gateway_ip, 'camera': args.camera_ip}) if args.record else None
+    try:
+        with timing.span('total'):
+            failed = pure_ed500_led_test(args.gateway_ip, args.port, args.gateway_user,gateway_pwd, args.camera_ip, early_stop=not args.full_capture, stream_session=args.stream_session, group_leds=args.group_leds,
+                inference_socket=args.inference_socket, backend=args.backend, log_dir=args.log_dir,
+                calibration_store=calibration.CalibrationStore() if args.calibration else None, frame_format=args.frame_format,
+                blink_classifier=args.blink_classifier, recorder=recorder, analysis_workers=args.analysis_workers,
+                localizer=args.localizer, model_options={'input_size': models.model_input_size(args), 'fit_mode': args.fit_mode, 'xla': args.xla},
+                settle_detection=not args.fixed_settle)
+    finally:
+        if recorder is not None: recorder.close()
+        #timings are written for failed and aborted runs too
+        write_timings(args, failed)
     if not failed: logging.info('all LEDs work as expected')
     else: logging.info('Some LEDs do not work as expected, see the log file: ' + LOG_FILE)
+    return EXIT_LEDS_FAILED if failed else 0
 
 if __name__ == "__main__":
-    main(sys.argv)
+    sys.exit(main(sys.argv))
     
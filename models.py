@@ -1,11 +1,202 @@
-from json.encoder import INFINITY
-import tensorflow as tf
 import paths
+import timing
+import inference_protocol
 import numpy as np
-import cv2
 import os
+import socket
+import sys
+import time
+import queue
+import argparse
+import logging
+import threading
+import weakref
+
+from lazy_import import LazyModule
+#TensorFlow and OpenCV are imported on first use
+tf=LazyModule('tensorflow')
+cv2=LazyModule('cv2')
 #os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
+#Detector backends: the shipped SavedModels or their TFLite conversions (see convert_tflite.py)
+BACKENDS=['savedmodel','tflite-float16']
+#conversions that convert_tflite.py can write and compare, but that were not validated against the SavedModels
+EXPERIMENTAL_BACKENDS=['tflite-int8']
+#fixed input size (height, width) of the detection functions, see FixedSizeDetectionFn
+INPUT_SIZE=(640, 640)
+FIT_MODES=['resize','pad']
+#TensorFlow thread pools, None keeps the TensorFlow default (see configure_threads)
+TF_THREADS={'intra': None, 'inter': None}
+_threads_applied=False
+
+'''
+Sets the TensorFlow thread pools of the models. TensorFlow only accepts them before its
+runtime starts, so they are applied when the first model is loaded
+Args:
+intra: threads used inside one operation (e.g. a convolution)
+inter: threads running independent operations in parallel
+'''
+def configure_threads(intra=None, inter=None):
+    TF_THREADS['intra']=intra
+    TF_THREADS['inter']=inter
+
+def _apply_threads():
+    global _threads_applied
+    if _threads_applied: return
+    _threads_applied=True
+    try:
+        if TF_THREADS['intra'] is not None: tf.config.threading.set_intra_op_parallelism_threads(TF_THREADS['intra'])
+        if TF_THREADS['inter'] is not None: tf.config.threading.set_inter_op_parallelism_threads(TF_THREADS['inter'])
+    except RuntimeError as e:
+        logging.warning('TensorFlow threads can only be set before TensorFlow starts: {0}'.format(e))
+
+'''
+Returns the path of the TFLite conversion of a SavedModel
+Args:
+saved_model_path: one of the model paths in paths.py
+quantization: 'float16' or 'int8'
+'''
+def tflite_model_path(saved_model_path, quantization):
+    return os.path.join(os.path.dirname(os.path.normpath(saved_model_path)), 'model_' + quantization + '.tflite')
+
+'''
+Runs a TFLite detector with the same call contract as a loaded SavedModel:
+takes a uint8 tensor of size 1xHxWx3, returns a dict of tensors
+(num_detections, detection_boxes, detection_classes, detection_scores, ...)
+The converted models usually have a fixed batch dimension, see batch_size.
+'''
+class TFLiteDetectionFn:
+    def __init__(self, model_path, num_threads=None):
+        self.interpreter=tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.runner=self.interpreter.get_signature_runner()
+        self.input_name, details = next(iter(self.runner.get_input_details().items()))
+        #images per call, None if the batch dimension is dynamic
+        batch=int(details.get('shape_signature', details['shape'])[0])
+        self.batch_size=None if batch < 0 else batch
+        #one interpreter can't run concurrent invocations
+        self.lock=threading.Lock()
+
+    def __call__(self, input_tensor):
+        with self.lock:
+            outputs=self.runner(**{self.input_name: np.asarray(input_tensor)})
+        return {key: tf.convert_to_tensor(value) for key, value in outputs.items()}
+
+'''
+Fits an image into a fixed size: scaled keeping the aspect ratio ('resize', or 'pad' that
+only scales images down) and padded with zeros on the bottom and the right
+Args:
+img: image of size HxWx3
+size: (height, width)
+mode: one of FIT_MODES
+Returns:
+(image of size height x width x 3, (height, width) of the scaled image inside it)
+'''
+def fit_image(img, size=INPUT_SIZE, mode='resize'):
+    height, width = size
+    h, w = img.shape[:2]
+    scale=min(height/h, width/w)
+    if mode == 'pad': scale=min(scale, 1.0)
+    if scale != 1.0:
+        img=cv2.resize(img, (min(width, max(1, round(w*scale))), min(height, max(1, round(h*scale)))),
+            interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    fitted=np.zeros((height, width) + img.shape[2:], dtype=img.dtype)
+    fitted[:img.shape[0], :img.shape[1]]=img
+    return fitted, img.shape[:2]
+
+'''
+Calls a detection function with inputs of one fixed size, so that it is traced and
+compiled once instead of for every display crop size. Images are fitted into the size
+(fit_image) and the boxes are mapped back to the input images: same call contract as the
+wrapped function. A SavedModel is called through a tf.function with a fixed input signature,
+optionally compiled with XLA; TFLite interpreters are called directly and keep their tensors.
+Args:
+detection_fn: loaded SavedModel or TFLiteDetectionFn
+size: (height, width) of the input
+mode: one of FIT_MODES
+compile: call detection_fn through a tf.function
+xla: compile the tf.function with XLA
+'''
+class FixedSizeDetectionFn:
+    def __init__(self, detection_fn, size=INPUT_SIZE, mode='resize', compile=True, xla=False):
+        self.detection_fn=detection_fn
+        self.size=tuple(size)
+        self.mode=mode
+        self.compiled=compile
+        self.call=self._compile(None, xla) if compile else detection_fn
+        self.first_call_seconds=None
+
+    def _compile(self, batch, xla):
+        signature=[tf.TensorSpec([batch, self.size[0], self.size[1], 3], tf.uint8)]
+        return tf.function(lambda images: self.detection_fn(images), input_signature=signature, jit_compile=xla)
+
+    def __call__(self, input_tensor):
+        return self.detect_fitted([self.fit(img) for img in np.asarray(input_tensor)])
+
+    #fits one image into the input, see fit_image
+    def fit(self, img):
+        return fit_image(np.asarray(img), self.size, self.mode)
+
+    '''
+    Runs detection on images fitted with fit, boxes are relative to the images before fitting
+    Args:
+    fitted: list of (fitted image, (height, width) of the scaled image inside it)
+    '''
+    def detect_fitted(self, fitted):
+        detections=dict(self.call(tf.convert_to_tensor(np.stack([img for img,_ in fitted]), dtype=tf.uint8)))
+        #boxes relative to the fitted input -> relative to the input images
+        factors=np.array([[self.size[0]/h, self.size[1]/w]*2 for _,(h, w) in fitted], dtype=np.float32)
+        detections['detection_boxes']=tf.convert_to_tensor(detections['detection_boxes'].numpy()*factors[:, None, :])
+        return detections
+
+    '''
+    Runs the function once on a blank input, so that tracing and compilation
+    don't slow down the first detection
+    Returns:
+    duration of the first call in seconds
+    '''
+    def warmup(self):
+        blank=np.zeros((1,) + self.size + (3,), dtype=np.uint8)
+        start=time.perf_counter()
+        try:
+            self(blank)
+        except Exception as e:
+            if not self.compiled: raise
+            #exported signatures with a fixed batch of one, or ops XLA can't compile
+            logging.warning('Compiled detection failed ({0!r}), compiling for a batch of one without XLA'.format(e))
+            self.call=self._compile(1, False)
+            _single_image_fns.add(self)
+            self(blank)
+        self.first_call_seconds=time.perf_counter()-start
+        return self.first_call_seconds
+
+'''
+Loads a detection model with the chosen backend
+Args:
+saved_model_path: one of the model paths in paths.py
+backend: one of BACKENDS or EXPERIMENTAL_BACKENDS
+input_size: (height, width) of the fixed input (FixedSizeDetectionFn, warmed up here), None to call the model with any size
+fit_mode: one of FIT_MODES
+xla: compile the SavedModel call with XLA
+Returns:
+callable detection function
+'''
+@timing.timed('model.load')
+def load_detection_fn(saved_model_path, backend='savedmodel', input_size=INPUT_SIZE, fit_mode='resize', xla=False):
+    _apply_threads()
+    if backend == 'savedmodel':
+        detection_fn=tf.saved_model.load(saved_model_path)
+    elif backend in BACKENDS + EXPERIMENTAL_BACKENDS:
+        detection_fn=TFLiteDetectionFn(tflite_model_path(saved_model_path, backend.split('-')[1]))
+    else:
+        raise ValueError('Unknown backend ' + backend)
+    if input_size is None:
+        return detection_fn
+    detection_fn=FixedSizeDetectionFn(detection_fn, input_size, fit_mode, compile=backend == 'savedmodel', xla=xla)
+    with timing.span('model.warmup'):
+        seconds=detection_fn.warmup()
+    logging.debug('{0}: first call {1:.2f} s'.format(os.path.basename(os.path.normpath(saved_model_path)), seconds))
+    return detection_fn
+
 def get_detections(img,detection_fn):
     image_np = np.array(img)
     input_tensor=tf.convert_to_tensor (np.expand_dims(image_np,0),  dtype=tf.uint8)
@@ -17,67 +208,325 @@ def get_detections(img,detection_fn):
     detections['detection_classes'] = detections['detection_classes'].astype(np.int64) -1   
     return detections
 
-def sort_leds(leds_detections):
-    #find leds with highest scores and different classes
-    leds=[]
-    min_y=INFINITY
-    min_x=INFINITY
-    max_y=-INFINITY
-    max_x=-INFINITY
-    for idx in range(5):
-        led={}
-        led['class']=leds_detections['detection_classes'][idx]
-        led['box']=leds_detections['detection_boxes'][idx]
-        led['score']=leds_detections['detection_scores'][idx]
-        leds.append(led)
-        min_y=min(min_y,leds_detections['detection_boxes'][idx][0])
-        min_x=min(min_x,leds_detections['detection_boxes'][idx][1])
-        max_y=max(max_y,leds_detections['detection_boxes'][idx][2])
-        max_x=max(max_x,leds_detections['detection_boxes'][idx][3])
-        
-    #define display orientation and sort the list of leds by box position
-    vertical=max_y-min_y>max_x-min_x
-    if vertical:            
-        leds.sort(key= lambda x: x['box'][0])                                
-    else:            
-        leds.sort(key= lambda x: x['box'][1])
-    return leds
-               
+#detection functions whose signature only accepts a batch of one image
+_single_image_fns=weakref.WeakSet()
+
+#number of images detection_fn takes in one call, None if it is not known before calling it
+def _batch_size(detection_fn):
+    if isinstance(detection_fn, FixedSizeDetectionFn): detection_fn=detection_fn.detection_fn
+    return getattr(detection_fn, 'batch_size', None)
+
+'''
+Runs detection on several images, batching images of the same input size in one call.
+Images for a FixedSizeDetectionFn are fitted to its input first, so that crops of
+different sizes share a batch.
+Args:
+images: list of images
+detection_fn: loaded detection model
+max_batch_size: maximum number of images in one call
+Returns:
+list of detections in the same order as images (same format as get_detections)
+'''
+def get_detections_many(images, detection_fn, max_batch_size=8):
+    if isinstance(detection_fn, FixedSizeDetectionFn):
+        inputs=[detection_fn.fit(img) for img in images]
+        call=detection_fn.detect_fitted
+    else:
+        inputs=[(np.asarray(img), None) for img in images]
+        call=lambda batch: detection_fn(tf.convert_to_tensor(np.stack([img for img,_ in batch]), dtype=tf.uint8))
+    #TFLite interpreters with a fixed batch dimension can't resize it
+    max_batch_size=min(max_batch_size, _batch_size(detection_fn) or max_batch_size)
+    results=[None]*len(images)
+    by_shape={}
+    for idx,(img,_) in enumerate(inputs):
+        by_shape.setdefault(img.shape, []).append(idx)
+    for indices in by_shape.values():
+        for start in range(0, len(indices), max_batch_size):
+            batch_indices=indices[start:start+max_batch_size]
+            if len(batch_indices) > 1 and detection_fn not in _single_image_fns:
+                try:
+                    detections=call([inputs[idx] for idx in batch_indices])
+                except (ValueError, TypeError, RuntimeError, tf.errors.InvalidArgumentError):
+                    #exported signatures with a fixed batch of one
+                    _single_image_fns.add(detection_fn)
+                else:
+                    for b,idx in enumerate(batch_indices): results[idx]=_unbatch(detections, b)
+                    continue
+            for idx in batch_indices:
+                results[idx]=_unbatch(call([inputs[idx]]), 0)
+    return results
+
+#detections of image b of a batch in the format of get_detections
+def _unbatch(detections, b):
+    detections=dict(detections)
+    n=int(np.asarray(detections.pop('num_detections'))[b])
+    result={key: value[b, : n].numpy() for key, value in detections.items()}
+    result['num_detections']=n
+    result['detection_classes']=result['detection_classes'].astype(np.int64) -1
+    return result
+
+#number of LEDs on the display
+LEDS_COUNT=5
+
+'''
+Detected LEDs as arrays: boxes Nx4 (y_UL, x_UL, y_BR, x_BR), classes N and scores N.
+Indexing with an int and iterating give one LED as a dict {'class', 'box', 'score'};
+indexing with a slice or an index array gives LedDetections.
+'''
+class LedDetections:
+    def __init__(self, boxes, classes, scores):
+        self.boxes=np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.classes=np.asarray(classes, dtype=np.int64)
+        self.scores=np.asarray(scores, dtype=np.float32)
+
+    '''Takes the output of get_detections, sorted by score'''
+    @classmethod
+    def from_detections(cls, detections):
+        return cls(detections['detection_boxes'], detections['detection_classes'], detections['detection_scores'])
+
+    '''Takes a list of LED dicts (calibration, inference_server)'''
+    @classmethod
+    def from_list(cls, leds):
+        return cls([led['box'] for led in leds], [led['class'] for led in leds], [led['score'] for led in leds])
+
+    def __len__(self):
+        return len(self.classes)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return {'class': int(self.classes[idx]), 'box': self.boxes[idx], 'score': float(self.scores[idx])}
+        return LedDetections(self.boxes[idx], self.classes[idx], self.scores[idx])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    '''
+    Keeps the k best scored detections of every class, in score order
+    '''
+    def top_k_per_class(self, k=1):
+        by_score=np.argsort(-self.scores, kind='stable')
+        order=by_score[np.argsort(self.classes[by_score], kind='stable')]
+        #rank of every detection within its class
+        classes=self.classes[order]
+        first=np.searchsorted(classes, classes)
+        keep=order[np.arange(len(order))-first < k]
+        return self[np.sort(keep)]
+
+    '''
+    Returns:
+    True if the LEDs span more vertically than horizontally
+    '''
+    def is_vertical(self):
+        if len(self) == 0: return False
+        return self.boxes[:,2].max()-self.boxes[:,0].min() > self.boxes[:,3].max()-self.boxes[:,1].min()
+
+    '''Returns the LEDs sorted along the display, top to bottom or left to right'''
+    def sorted(self):
+        return self[np.argsort(self.boxes[:,0] if self.is_vertical() else self.boxes[:,1], kind='stable')]
+
+    '''Brings relative box coordinates to pxls of an image of size height x width'''
+    def rescaled(self, height, width):
+        return LedDetections(np.round(self.boxes*np.array([height, width, height, width], dtype=np.float32)), self.classes, self.scores)
+
+    '''Moves the boxes by y, x pxls'''
+    def offset(self, y, x):
+        return LedDetections(self.boxes+np.array([y, x, y, x], dtype=np.float32), self.classes, self.scores)
+
+    '''
+    Returns:
+    int array Nx4 of the box coordinates (truncated, as led_testing.led_box)
+    '''
+    def int_boxes(self):
+        return self.boxes.astype(np.int64)
+
+'''
+Selects the LEDs from the detections and sorts them along the display
+Args:
+leds_detections: output of get_detections
+count: number of LEDs, the best scored detections are taken
+per_class: if given, at most per_class detections of every class are taken
+Returns:
+LedDetections
+'''
+def sort_leds(leds_detections, count=LEDS_COUNT, per_class=None):
+    leds=LedDetections.from_detections(leds_detections)
+    if per_class is not None: leds=leds.top_k_per_class(per_class)
+    return leds[:count].sorted()
+
 class LedsSchemeModel:
-    def __init__(self):
-            self.detect_fn=tf.saved_model.load(paths.LEDS_SCHEME_MODEL_PATH)
+    def __init__(self, backend='savedmodel', input_size=INPUT_SIZE, fit_mode='resize', xla=False):
+            self.detect_fn=load_detection_fn(paths.LEDS_SCHEME_MODEL_PATH, backend, input_size, fit_mode, xla)
     def detect(self, img):
-        detections=get_detections(img, self.detect_fn)
-        leds = sort_leds(detections)
-        #bring box coordinates to absolute values:
-        for led in leds:
-            led['box'][0]=round(led['box'][0]*img.shape[0])
-            led['box'][1]=round(led['box'][1]*img.shape[1])
-            led['box'][2]=round(led['box'][2]*img.shape[0])
-            led['box'][3]=round(led['box'][3]*img.shape[1])
-        return leds
+        return self.detect_many([img])[0]
+
+    @timing.timed('model.detect')
+    def detect_many(self, images, timings=None):
+        start=time.perf_counter()
+        results=[]
+        for img,detections in zip(images, get_detections_many(images, self.detect_fn)):
+            #bring box coordinates to absolute values
+            results.append(sort_leds(detections).rescaled(img.shape[0], img.shape[1]))
+        if timings is not None:
+            timings['leds']=timings.get('leds', 0)+time.perf_counter()-start
+        return results
 
 class DisplayLedsSchemeModel:
-    def __init__(self):
-        self.detect_display_fn=tf.saved_model.load(paths.DISPLAY_MODEL_PATH)
-        self.detect_led_fn=tf.saved_model.load(paths.LEDS_MODEL_PATH)
+    def __init__(self, backend='savedmodel', input_size=INPUT_SIZE, fit_mode='resize', xla=False):
+        self.detect_display_fn=load_detection_fn(paths.DISPLAY_MODEL_PATH, backend, input_size, fit_mode, xla)
+        #display crops have a different size every time, the fixed input spares retracing
+        self.detect_led_fn=load_detection_fn(paths.LEDS_MODEL_PATH, backend, input_size, fit_mode, xla)
 
     def detect(self, img):
-        display_detections=get_detections(img, self.detect_display_fn)
-    
-        y_UL=round(display_detections['detection_boxes'][0][0]*img.shape[0])
-        x_UL=round(display_detections['detection_boxes'][0][1]*img.shape[1])
-        y_BR=round(display_detections['detection_boxes'][0][2]*img.shape[0])
-        x_BR=round(display_detections['detection_boxes'][0][3]*img.shape[1])
-        
-        #cut display from image
-        display = img[y_UL:y_BR, x_UL:x_BR]
-        leds_detections = get_detections(display, self.detect_led_fn)
-        leds = sort_leds(leds_detections)
-        #bring box coordinates to absolute values:
-        for led in leds:
-            led['box'][0]=round(led['box'][0]*display.shape[0])+y_UL
-            led['box'][1]=round(led['box'][1]*display.shape[1])+x_UL
-            led['box'][2]=round(led['box'][2]*display.shape[0])+y_UL
-            led['box'][3]=round(led['box'][3]*display.shape[1])+x_UL    
-        return leds
\ No newline at end of file
+        return self.detect_many([img])[0]
+
+    '''
+    Detects leds on several images: one batched display pass,
+    then one batched LED pass over all display crops
+    Args:
+    images: list of images
+    timings: optional dict, seconds spent in 'display', 'crop' and 'leds' stages are added to it
+    Returns:
+    list of leds (same format as detect) per image
+    '''
+    @timing.timed('model.detect')
+    def detect_many(self, images, timings=None):
+        start=time.perf_counter()
+        displays_detections=get_detections_many(images, self.detect_display_fn)
+        display_done=time.perf_counter()
+
+        displays, offsets = [], []
+        for img,display_detections in zip(images, displays_detections):
+            y_UL, x_UL, y_BR, x_BR = LedDetections.from_detections(display_detections)[:1].rescaled(img.shape[0], img.shape[1]).int_boxes()[0]
+            #cut display from image
+            displays.append(img[y_UL:y_BR, x_UL:x_BR])
+            offsets.append((y_UL, x_UL))
+        crop_done=time.perf_counter()
+
+        results=[]
+        for display,(y_UL,x_UL),leds_detections in zip(displays, offsets, get_detections_many(displays, self.detect_led_fn)):
+            #bring box coordinates to absolute values
+            results.append(sort_leds(leds_detections).rescaled(display.shape[0], display.shape[1]).offset(y_UL, x_UL))
+        if timings is not None:
+            timings['display']=timings.get('display', 0)+display_done-start
+            timings['crop']=timings.get('crop', 0)+crop_done-display_done
+            timings['leds']=timings.get('leds', 0)+time.perf_counter()-crop_done
+        return results
+
+'''
+Client of inference_server: same detect(img) contract as the local models,
+but the models are loaded once by the server and shared by all test runs on the host.
+Args:
+socket_path: server Unix socket
+model: 'display_leds' (DisplayLedsSchemeModel) or 'leds_scheme' (LedsSchemeModel)
+'''
+class RemoteDisplayLedsSchemeModel:
+    def __init__(self, socket_path=paths.INFERENCE_SOCKET_PATH, model='display_leds', timeout=60):
+        self.model=model
+        self.sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+
+    @timing.timed('model.detect')
+    def detect(self, img):
+        inference_protocol.send_message(self.sock, {'model': self.model}, img)
+        header, _ = inference_protocol.recv_message(self.sock)
+        if 'error' in header:
+            raise RuntimeError('Remote detection failed: ' + header['error'])
+        return LedDetections.from_list(header['leds'])
+
+    def close(self):
+        self.sock.close()
+
+
+'''
+Reads images from a directory in a background thread
+Args:
+image_paths: list of image files
+prefetch: maximum number of decoded images waiting in the queue
+Returns:
+queue of (path, image, read seconds), terminated by None
+'''
+def prefetch_images(image_paths, prefetch=16):
+    images=queue.Queue(maxsize=prefetch)
+    def read():
+        for path in image_paths:
+            start=time.perf_counter()
+            img=cv2.imread(path)
+            images.put((path, img, time.perf_counter()-start))
+        images.put(None)
+    threading.Thread(target=read, name='image-prefetch', daemon=True).start()
+    return images
+
+'''Adds the model options shared by the scripts that load the models'''
+def add_model_arguments(arg_parser):
+    arg_parser.add_argument('--input-size', type=int, nargs=2, default=list(INPUT_SIZE), metavar=('HEIGHT', 'WIDTH'),
+        help='fixed detector input, 0 0 to call the detectors with any size (default {0} {1})'.format(*INPUT_SIZE))
+    arg_parser.add_argument('--fit-mode', choices=FIT_MODES, default='resize', help='how images are fitted into the input size (default resize)')
+    arg_parser.add_argument('--xla', action='store_true', help='compile the SavedModel detectors with XLA')
+    arg_parser.add_argument('--tf-intra-threads', type=int, help='TensorFlow threads inside one operation (default TensorFlow)')
+    arg_parser.add_argument('--tf-inter-threads', type=int, help='TensorFlow threads across operations (default TensorFlow)')
+
+def model_input_size(args):
+    return tuple(args.input_size) if all(args.input_size) else None
+
+'''Runs the detector over a directory of images and reports throughput and per-stage latency'''
+def main(argv):
+    arg_parser=argparse.ArgumentParser(description='benchmark LED detectors on a directory of images')
+    arg_parser.add_argument('image_dir', help='directory with .jpg/.png images')
+    arg_parser.add_argument('-m', '--model', choices=['display_leds','leds_scheme'], default='display_leds', help='detector (default display_leds)')
+    arg_parser.add_argument('--backend', choices=BACKENDS, default='savedmodel', help='detector backend (default savedmodel)')
+    arg_parser.add_argument('-b', '--batch-size', type=int, default=8, help='images per detect_many call (default 8)')
+    arg_parser.add_argument('--prefetch', type=int, default=16, help='decoded images to read ahead (default 16)')
+    add_model_arguments(arg_parser)
+    args=arg_parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("tensorflow").setLevel(logging.ERROR)
+    image_paths=sorted(os.path.join(args.image_dir, f) for f in os.listdir(args.image_dir)
+        if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    if not image_paths: sys.exit('No images in ' + args.image_dir)
+
+    configure_threads(args.tf_intra_threads, args.tf_inter_threads)
+    start=time.perf_counter()
+    model_class=DisplayLedsSchemeModel if args.model == 'display_leds' else LedsSchemeModel
+    model=model_class(args.backend, model_input_size(args), args.fit_mode, args.xla)
+    logging.info('model load: {0:.2f} s'.format(time.perf_counter()-start))
+    for fn in (getattr(model, name, None) for name in ('detect_display_fn', 'detect_led_fn', 'detect_fn')):
+        if isinstance(fn, FixedSizeDetectionFn): logging.info('warmup (first call): {0:.2f} s'.format(fn.first_call_seconds))
+
+    timings={'read': 0}
+    #seconds per image of every detect_many call
+    latencies=[]
+    count=0
+    images=prefetch_images(image_paths, args.prefetch)
+    start=time.perf_counter()
+    done=False
+    while not done:
+        batch=[]
+        while len(batch) < args.batch_size:
+            item=images.get()
+            if item is None:
+                done=True
+                break
+            path, img, read_time = item
+            timings['read']+=read_time
+            if img is None: logging.warning('Could not read ' + path)
+            else: batch.append(img)
+        if batch:
+            call_start=time.perf_counter()
+            model.detect_many(batch, timings)
+            latencies.append((time.perf_counter()-call_start)/len(batch))
+            count+=len(batch)
+    elapsed=time.perf_counter()-start
+
+    logging.info('images: {0} total: {1:.2f} s throughput: {2:.2f} images/s'.format(count, elapsed, count/elapsed))
+    if latencies:
+        #the first call pays for tracing unless the model was warmed up
+        steady=np.array(latencies[1:] or latencies)
+        logging.info('first call: {0:.1f} ms/image steady state: p50 {1:.1f} ms/image p95 {2:.1f} ms/image'.format(
+            1000*latencies[0], 1000*np.percentile(steady, 50), 1000*np.percentile(steady, 95)))
+    for stage, seconds in timings.items():
+        logging.info('{0}: {1:.1f} ms/image'.format(stage, 1000*seconds/max(count, 1)))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,4 +1,6 @@
 import os
 LEDS_SCHEME_MODEL_PATH=os.path.join('leds','saved_model')
 DISPLAY_MODEL_PATH=os.path.join('display-leds','display','saved_model')
-LEDS_MODEL_PATH=os.path.join('display-leds','leds','saved_model')
\ No newline at end of file
+LEDS_MODEL_PATH=os.path.join('display-leds','leds','saved_model')
+INFERENCE_SOCKET_PATH=os.path.join('/tmp','led-inference.sock')
+CACHE_DIR=os.path.join(os.path.expanduser('~'),'.cache','exjobb-led-testing')
@@ -0,0 +1,176 @@
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import analysis_util as au
+import artifact_writer as aw
+import timing
+from lazy_import import LazyModule
+#workers import the test for whichBehavior, the test process already has it
+lt=LazyModule('led_testing')
+
+'''
+Frames of one capture in a shared memory block, the off frame followed by the frames,
+so that worker processes read them without pickling.
+The test process owns the block and releases it once the analysis is reported.
+Args:
+off: off frame of size MxNx3
+frames: frames of size MxNx3 (list or TxMxNx3 array)
+'''
+class SharedCapture:
+    def __init__(self, off, frames):
+        frames=au.frame_stack(frames)
+        off=np.asarray(off, dtype=np.uint8)
+        self.shm=shared_memory.SharedMemory(create=True, size=max(1, off.nbytes + frames.nbytes))
+        #picklable description of the block for the workers
+        self.descriptor=(self.shm.name, off.shape, frames.shape)
+        shared_off, shared_frames = shared_views(self.shm, off.shape, frames.shape)
+        shared_off[...]=off
+        shared_frames[...]=frames
+
+    '''
+    Returns:
+    (off, frames) arrays in the block, they must be deleted before release
+    '''
+    def views(self):
+        return shared_views(self.shm, *self.descriptor[1:])
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+def shared_views(shm, off_shape, frames_shape):
+    off=np.ndarray(off_shape, dtype=np.uint8, buffer=shm.buf)
+    frames=np.ndarray(frames_shape, dtype=np.uint8, buffer=shm.buf, offset=off.nbytes)
+    return off, frames
+
+def _warm_up():
+    #import the analysis before the first capture arrives
+    lt.whichBehavior
+
+'''
+Analyzes one capture in a worker process and writes its frames if the check failed
+Args:
+descriptor: SharedCapture.descriptor
+LED, night, timestamps: as for whichBehavior
+expected: (color, behavior) from the config
+artifact: (path, frame_format, timestamps) for the frames of a failed check
+Returns:
+(detected_color, detected_behavior, correct, analysis time in seconds)
+'''
+def analyze_capture(descriptor, LED, night, timestamps, expected, artifact):
+    name, off_shape, frames_shape = descriptor
+    shm=shared_memory.SharedMemory(name=name)
+    try:
+        off, frames = shared_views(shm, off_shape, frames_shape)
+        start=time.perf_counter()
+        detected_color, detected_behavior = lt.whichBehavior(frames, night, off, LED, timestamps)
+        seconds=time.perf_counter()-start
+        correct=lt.is_behavior_correct(expected[0], expected[1], detected_color, detected_behavior)
+        if not correct and len(frames):
+            path, frame_format, artifact_timestamps = artifact
+            aw.write_frames(path, frames, frame_format, artifact_timestamps)
+        del off, frames
+    finally:
+        shm.close()
+    return detected_color, detected_behavior, correct, seconds
+
+'''
+Runs the analysis of full captures (whichBehavior) and the writing of their frames in
+worker processes, so that the analysis of one LED overlaps the capture of the next one.
+Commands and captures stay in the test process; frames are handed over in shared memory.
+Results are reported in submission order.
+Args:
+workers: number of worker processes
+blink_classifier: one of au.BLINK_CLASSIFIERS
+log_dir: folder for the frames of failed checks
+frame_format: one of aw.FRAME_FORMATS
+recorder: recordings.SessionRecorder that records every capture, or None
+'''
+class AnalysisPipeline:
+    def __init__(self, workers, blink_classifier='switches', log_dir='.', frame_format='jpg', recorder=None):
+        #spawn: the test process runs ssh and camera threads, which don't survive fork
+        self.pool=concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        self.blink_classifier=blink_classifier
+        self.log_dir=log_dir
+        self.frame_format=frame_format
+        self.recorder=recorder
+        self.pending=collections.deque()
+        self.failed=False
+        #start the workers while the test connects to the devices
+        for _ in range(workers): self.pool.submit(_warm_up)
+
+    '''
+    Hands a capture over to the workers
+    Args:
+    LED, LED_color, LED_behavior: tested LED and its expected state
+    command: gateway command that set the state
+    night: IR filter state of the camera
+    off, frames, timestamps: the capture
+    '''
+    def submit(self, LED, LED_color, LED_behavior, command, night, off, frames, timestamps):
+        capture=SharedCapture(off, frames)
+        artifact=(os.path.join(self.log_dir, LED + '_' + LED_color + '_' + LED_behavior), self.frame_format, list(timestamps))
+        future=self.pool.submit(analyze_capture, capture.descriptor, LED, night,
+            list(timestamps) if self.blink_classifier == 'timestamps' else None, (LED_color, LED_behavior), artifact)
+        self.pending.append((LED, LED_color, LED_behavior, command, night, list(timestamps), capture, future))
+
+    '''
+    Reports finished analyses in submission order
+    Args:
+    wait: wait for all pending analyses
+    Returns:
+    True if some LED did not work as expected so far
+    '''
+    def report(self, wait=False):
+        while self.pending and (wait or self.pending[0][-1].done()):
+            LED, LED_color, LED_behavior, command, night, timestamps, capture, future = self.pending.popleft()
+            try:
+                try:
+                    with timing.span('analysis.wait'):
+                        detected_color, detected_behavior, correct, seconds = future.result()
+                except Exception as e:
+                    #a failed analysis fails its check, the other captures are still reported
+                    logging.error('led: {0} command: {1} analysis failed: {2!r}'.format(LED, command, e))
+                    self.failed=True
+                    continue
+                timing.TIMINGS.add('analysis', seconds)
+                logging.info('led: {0} expected color: {1} behavior: {2} detected color: {3} behavior: {4}'.format(
+                    LED, LED_color, LED_behavior, detected_color, detected_behavior))
+                if self.recorder is not None:
+                    off, frames = capture.views()
+                    self.recorder.record(LED, command, LED_color, LED_behavior, night, off, frames, timestamps, (detected_color, detected_behavior))
+                    del off, frames
+            finally:
+                capture.release()
+            if correct:
+                logging.info('CORRECT')
+            else:
+                self.failed=True
+                logging.error('WRONG')
+        return self.failed
+
+    '''
+    Waits for the pending analyses and stops the workers
+    Returns:
+    True if some LED did not work as expected
+    '''
+    def close(self):
+        try:
+            return self.report(wait=True)
+        finally:
+            for _, _, _, _, _, _, capture, _ in self.pending: capture.release()
+            self.pending.clear()
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
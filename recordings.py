@@ -0,0 +1,249 @@
+import argparse
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import analysis_util as au
+from lazy_import import LazyModule
+#the test is only needed to judge the results, it imports the gateway and camera modules
+lt=LazyModule('led_testing')
+
+#files of a recording folder
+SESSIONS_FILE='sessions.jsonl'
+FRAMES_FILE='frames.u8'
+TIMESTAMPS_FILE='timestamps.f8'
+#analysis thresholds that can be changed for a replay
+THRESHOLDS=['HSV_DIST_THR', 'CHANGED_COLOR_FRACTION_THR', 'RED_ORANGE_a_b_diff_THR_DAY', 'RED_ORANGE_a_b_diff_THR_NIGHT',
+    'SAT_THR', 'BLINK_CONFIDENCE_THR']
+
+'''
+Records every capture of a test run, so that the analysis can be tuned on recorded
+sessions instead of live runs.
+A recording is a folder with three append-only files:
+    frames.u8 - raw uint8 pixels of the off frames and frames of all sessions,
+    timestamps.f8 - float64 capture times,
+    sessions.jsonl - one line per session with the offsets into both files and the test information.
+The raw files can be memory-mapped, so a replay reads the frames straight from the page cache.
+A session is only listed after its data is written, an aborted run leaves a readable recording.
+Args:
+root: folder of the recordings, every run gets its own subfolder
+info: dict stored with every session (e.g. gateway, camera)
+'''
+class SessionRecorder:
+    def __init__(self, root, info=None):
+        self.path=os.path.join(root, time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid()))
+        os.makedirs(self.path, exist_ok=True)
+        self.info=info or {}
+        self.lock=threading.Lock()
+        self.frames_file=open(os.path.join(self.path, FRAMES_FILE), 'ab')
+        self.timestamps_file=open(os.path.join(self.path, TIMESTAMPS_FILE), 'ab')
+        self.sessions_file=open(os.path.join(self.path, SESSIONS_FILE), 'a')
+        self.count=0
+
+    def _append(self, f, array):
+        offset=f.tell()
+        f.write(np.ascontiguousarray(array).tobytes())
+        return offset
+
+    '''
+    Records one capture
+    Args:
+    led: LED name, e.g. 'internet' or 'neighbor3'
+    command: gateway command that set the state
+    expected_color, expected_behavior: expected state from the config
+    night: IR filter state of the camera
+    off: off frame of size MxNx3
+    frames: frames of size MxNx3 (list or TxMxNx3 array)
+    timestamps: capture times of the frames
+    detected: (color, behavior) found during the run, or None
+    '''
+    def record(self, led, command, expected_color, expected_behavior, night, off, frames, timestamps, detected=None):
+        stack=au.frame_stack(frames)
+        off=np.asarray(off, dtype=np.uint8)
+        timestamps=np.asarray(timestamps[:len(stack)], dtype=np.float64)
+        with self.lock:
+            session=dict(self.info, id=self.count, led=led, command=command,
+                expected_color=expected_color, expected_behavior=expected_behavior,
+                night=night, detected=list(detected) if detected is not None else None,
+                off_offset=self._append(self.frames_file, off), off_shape=list(off.shape),
+                frames_offset=self._append(self.frames_file, stack), frames_shape=list(stack.shape),
+                timestamps_offset=self._append(self.timestamps_file, timestamps), timestamps_count=len(timestamps))
+            self.frames_file.flush()
+            self.timestamps_file.flush()
+            self.sessions_file.write(json.dumps(session) + '\n')
+            self.sessions_file.flush()
+            self.count+=1
+
+    def close(self):
+        with self.lock:
+            for f in (self.frames_file, self.timestamps_file, self.sessions_file): f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+'''
+Recorded session, frames and off are read-only views into the memory-mapped recording
+'''
+class RecordedSession:
+    def __init__(self, meta, off, frames, timestamps):
+        self.meta=meta
+        self.off=off
+        self.frames=frames
+        self.timestamps=timestamps
+
+'''
+Memory-mapped recording folder written by SessionRecorder
+'''
+class Recording:
+    def __init__(self, path):
+        self.path=path
+        with open(os.path.join(path, SESSIONS_FILE)) as f:
+            self.sessions=[json.loads(line) for line in f if line.strip()]
+        frames_path=os.path.join(path, FRAMES_FILE)
+        timestamps_path=os.path.join(path, TIMESTAMPS_FILE)
+        #np.memmap can't map empty files
+        self.pixels=np.memmap(frames_path, dtype=np.uint8, mode='r') if os.path.getsize(frames_path) else np.zeros(0, np.uint8)
+        self.times=np.memmap(timestamps_path, dtype=np.float64, mode='r') if os.path.getsize(timestamps_path) else np.zeros(0)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def _view(self, offset, shape):
+        return self.pixels[offset:offset+int(np.prod(shape))].reshape(shape)
+
+    def session(self, i):
+        meta=self.sessions[i]
+        start=meta['timestamps_offset']//8
+        return RecordedSession(meta, self._view(meta['off_offset'], meta['off_shape']),
+            self._view(meta['frames_offset'], meta['frames_shape']), self.times[start:start+meta['timestamps_count']])
+
+    def __iter__(self):
+        return (self.session(i) for i in range(len(self)))
+
+'''Finds recording folders in the given folders (recursively)'''
+def find_recordings(paths):
+    found=[]
+    for path in paths:
+        for folder, _, files in os.walk(path):
+            if SESSIONS_FILE in files: found.append(folder)
+    return sorted(set(found))
+
+'''
+Sets analysis thresholds for a replay
+Args:
+thresholds: dict name -> value, names from THRESHOLDS
+'''
+def set_thresholds(thresholds):
+    for name, value in (thresholds or {}).items():
+        if name not in THRESHOLDS: raise ValueError('Unknown threshold ' + name)
+        setattr(au, name, type(getattr(au, name))(value))
+
+'''
+Classifies one recorded session as the test does
+Args:
+mode: 'batch' - whichBehavior over all frames, 'streaming' - StreamingBehaviorAnalyzer until it settles
+classifier: one of au.BLINK_CLASSIFIERS
+Returns:
+((color, behavior), number of analyzed frames)
+'''
+def classify_session(session, mode='batch', classifier='switches'):
+    night=session.meta['night']
+    if mode == 'streaming':
+        analyzer=au.StreamingBehaviorAnalyzer(night, session.off, classifier)
+        fed=0
+        for frame, timestamp in zip(session.frames, session.timestamps):
+            fed+=1
+            if analyzer.feed(frame, timestamp): break
+        return analyzer.result(), fed
+    timestamps=session.timestamps if classifier == 'timestamps' else None
+    return lt.whichBehavior(session.frames, night, session.off, session.meta['led'], timestamps), len(session.frames)
+
+def _replay_recording(path, mode, classifier, thresholds):
+    set_thresholds(thresholds)
+    recording=Recording(path)
+    results=[]
+    for session in recording:
+        meta=session.meta
+        (color, behavior), analyzed = classify_session(session, mode, classifier)
+        results.append({'recording': path, 'id': meta['id'], 'led': meta['led'],
+            'expected': [meta['expected_color'], meta['expected_behavior']], 'detected': [color, behavior],
+            'recorded': meta['detected'], 'frames': len(session.frames), 'analyzed': analyzed,
+            'bytes': session.frames.nbytes + session.off.nbytes,
+            'correct': lt.is_behavior_correct(meta['expected_color'], meta['expected_behavior'], color, behavior)})
+    return results
+
+'''
+Re-runs the analysis over recorded sessions
+Args:
+paths: recording folders
+mode, classifier: see classify_session
+thresholds: dict of analysis thresholds to use instead of the defaults
+workers: number of processes, recordings are spread over them
+Returns:
+report dict with accuracy, throughput and the wrong sessions
+'''
+def replay(paths, mode='batch', classifier='switches', thresholds=None, workers=1):
+    start=time.perf_counter()
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            chunks=pool.map(functools.partial(_replay_recording, mode=mode, classifier=classifier, thresholds=thresholds), paths)
+            results=[result for chunk in chunks for result in chunk]
+    else:
+        results=[result for path in paths for result in _replay_recording(path, mode, classifier, thresholds)]
+    seconds=time.perf_counter()-start
+    frames=sum(r['frames'] for r in results)
+    wrong=[r for r in results if not r['correct']]
+    changed=[r for r in results if r['recorded'] is not None and r['recorded'] != r['detected']]
+    return {'recordings': len(paths), 'sessions': len(results), 'frames': frames, 'seconds': seconds,
+        'mode': mode, 'classifier': classifier, 'thresholds': thresholds or {},
+        'sessions_per_s': len(results)/seconds if seconds else 0.0, 'frames_per_s': frames/seconds if seconds else 0.0,
+        'mb_per_s': sum(r['bytes'] for r in results)/1e6/seconds if seconds else 0.0,
+        'analyzed_fraction': sum(r['analyzed'] for r in results)/frames if frames else 0.0,
+        'accuracy': 1-len(wrong)/len(results) if results else 0.0, 'changed': len(changed), 'wrong': wrong}
+
+def parse_threshold(text):
+    name, _, value = text.partition('=')
+    if name not in THRESHOLDS or not value: raise argparse.ArgumentTypeError('expected NAME=VALUE with NAME one of ' + ', '.join(THRESHOLDS))
+    return name, float(value)
+
+def main(argv):
+    arg_parser=argparse.ArgumentParser(description='replay recorded LED captures (led_testing --record) through the analysis')
+    arg_parser.add_argument('paths', nargs='+', help='recording folders, searched recursively')
+    arg_parser.add_argument('-m', '--mode', choices=['batch', 'streaming'], default='batch', help='whichBehavior over all frames or the early stop analyzer (default batch)')
+    arg_parser.add_argument('--blink-classifier', choices=au.BLINK_CLASSIFIERS, default='switches', help='default switches')
+    arg_parser.add_argument('--set', type=parse_threshold, action='append', default=[], metavar='NAME=VALUE',
+        help='analysis threshold for the replay, one of ' + ', '.join(THRESHOLDS))
+    arg_parser.add_argument('-w', '--workers', type=int, default=1, help='processes (default 1)')
+    arg_parser.add_argument('-o', '--output', help='write the report as JSON')
+    arg_parser.add_argument('-v', '--verbose', action='store_true', help='list every wrong session')
+    args=arg_parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    paths=find_recordings(args.paths)
+    if not paths: sys.exit('No recordings found')
+    report=replay(paths, args.mode, args.blink_classifier, dict(args.set), args.workers)
+    logging.info('{0} sessions in {1} recordings, {2} frames in {3:.2f} s: {4:.0f} sessions/s, {5:.0f} frames/s, {6:.0f} MB/s'.format(
+        report['sessions'], report['recordings'], report['frames'], report['seconds'],
+        report['sessions_per_s'], report['frames_per_s'], report['mb_per_s']))
+    logging.info('accuracy {0:.1%}, {1} wrong, {2} differ from the recorded run, {3:.0%} of the frames analyzed'.format(
+        report['accuracy'], len(report['wrong']), report['changed'], report['analyzed_fraction']))
+    if args.verbose:
+        for r in report['wrong']:
+            logging.info('WRONG {0} #{1} {2}: expected {3} detected {4}'.format(r['recording'], r['id'], r['led'], r['expected'], r['detected']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 1 if report['wrong'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
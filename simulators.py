@@ -0,0 +1,735 @@
+import argparse
+import copy
+import hashlib
+import http.server
+import json
+import logging
+import os
+import shlex
+import socket
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+import paramiko
+
+import analysis_util as au
+import calibration
+import synthetic as sy
+from lazy_import import LazyModule
+cv2=LazyModule('cv2')
+
+HW_CONFIG_PATH='/lib/db/config/hw'
+GATEWAY_MODEL='SIM-ED500'
+#time an exec channel stays open after its command finished
+EXEC_CLOSE_DELAY=0.5
+#the camera picture is this much brighter right after a settings change and converges
+#back with this time constant in seconds, like a real auto exposure
+EXPOSURE_OVERSHOOT=0.4
+EXPOSURE_TIME_CONSTANT=0.25
+#video URL of the simulated cameras, to be set as LED_CAMERA_VIDEO_URL for led_testing.py
+VIDEO_URL_FORMAT='http://{0}/img/video.mjpg'
+#send buffer of a video stream in bytes, about one frame
+STREAM_SEND_BUFFER=64*1024
+
+#hw config of the simulated gateways, LED names as expected by led_testing.map_to_visible_led
+DEFAULT_HW_CONFIG='''config led_map 'led_map'
+	list functions 'status'
+	list functions 'broadband'
+	list functions 'internet'
+	list functions 'wifi'
+	list functions 'wps'
+	list functions 'voice1'
+
+config led_map 'led_status'
+	list led_action_ok 'status_green = ON'
+	list led_action_error 'status_red = FLASH_SLOW'
+	list led_action_off 'status_green = OFF'
+
+config led_map 'led_broadband'
+	list led_action_ok 'uplink_green = ON'
+	list led_action_notice 'uplink_green = FLASH_SLOW'
+	list led_action_error 'uplink_red = ON'
+	list led_action_off 'uplink_green = OFF'
+
+config led_map 'led_internet'
+	list led_action_ok 'internet_green = ON'
+	list led_action_error 'internet_red = ON'
+	list led_action_notice 'internet_orange = FLASH_FAST'
+	list led_action_off 'internet_green = OFF'
+	list super_notice 'internet_notice, broadband_ok'
+
+config led_map 'led_wifi'
+	list led_action_ok 'wireless_green = ON'
+	list led_action_notice 'wireless_orange = FLASH_SLOW'
+	list led_action_off 'wireless_green = OFF'
+	list super_notice 'wifi_notice, wps_active'
+
+config led_map 'led_wps'
+	list led_action_active 'wireless_green = FLASH_FAST'
+	list led_action_off 'wireless_green = OFF'
+
+config led_map 'led_voice1'
+	list led_action_ok 'voice_green = ON'
+	list led_action_error 'voice_orange = ON'
+	list led_action_off 'voice_green = OFF'
+'''
+
+'''
+Parses a uci config file
+Returns:
+list of sections {'type', 'name', 'options': list of [kind, key, value]}
+'''
+def parse_uci(text):
+    sections=[]
+    for line in text.splitlines():
+        words=shlex.split(line, comments=True)
+        if not words: continue
+        if words[0] == 'config':
+            sections.append({'type': words[1], 'name': words[2] if len(words) > 2 else '', 'options': []})
+        elif words[0] in ('list', 'option') and sections and len(words) >= 3:
+            sections[-1]['options'].append([words[0], words[1], ' '.join(words[2:])])
+    return sections
+
+def format_uci(sections):
+    text=''
+    for section in sections:
+        text+='config {0} \'{1}\'\n'.format(section['type'], section['name'])
+        text+=''.join('\t{0} {1} \'{2}\'\n'.format(kind, key, value) for kind, key, value in section['options'])
+        text+='\n'
+    return text
+
+'''
+LEDs of one simulated gateway: functions with states drive LEDs through
+the led_map sections of the hw config, as the peripheral manager does.
+The most recently set function wins when two functions drive the same LED. A super state
+(e.g. wifi notice with super_notice 'wifi_notice, wps_active') applies while its conditions
+were all set by one command line, as led_testing sets them, and then wins over the plain
+states of that command.
+'''
+class LedBoard:
+    def __init__(self, hw_config=DEFAULT_HW_CONFIG):
+        self.lock=threading.Lock()
+        self.default_config=hw_config
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.committed=parse_uci(self.default_config)
+            self.staged=None
+            #function -> (state, time it was set, command line that set it)
+            self.states={}
+            self.changes=0
+            self.command=0
+            #LED name -> (color, behavior, time it was lit)
+            self.leds={}
+            self.rules=self._rules()
+        #a booted gateway shows its functions as ok
+        for function in self.functions():
+            self.set_state(function, 'ok')
+
+    def functions(self):
+        with self.lock:
+            return list(self.rules['functions'])
+
+    #led_map sections of the committed config
+    def _rules(self):
+        rules={'functions': [], 'actions': {}, 'supers': {}}
+        for section in self.committed:
+            if section['type'] != 'led_map': continue
+            if section['name'] == 'led_map':
+                rules['functions']=[value for _, key, value in section['options'] if key == 'functions']
+                continue
+            function=section['name'][len('led_'):]
+            for _, key, value in section['options']:
+                if key.startswith('led_action_'):
+                    led_color, _, behavior = value.partition(' = ')
+                    led, _, color = led_color.partition('_')
+                    rules['actions'].setdefault((function, key[len('led_action_'):]), []).append((led, color, behavior.strip()))
+                elif key.startswith('super_'):
+                    conditions=[o_s.strip().rsplit('_', 1) for o_s in value.split(',')]
+                    rules['supers'].setdefault((function, key[len('super_'):]), []).append(conditions)
+        return rules
+
+    #recomputes the LEDs from the function states
+    def _update(self):
+        leds={}
+        now=time.time()
+        applied=[]
+        for function, (state, set_at, command) in self.states.items():
+            if function not in self.rules['functions']: continue
+            supers=self.rules['supers'].get((function, state))
+            if not supers:
+                applied.append((set_at, 0, function, state))
+                continue
+            #a state with super functions only applies if one of them holds and was set by one
+            #command line, it is as recent as its last condition and wins over the states it combines
+            held=[conditions for conditions in supers
+                if all(self.states.get(o, (None,))[0] == s and self.states[o][2] == command for o, s in conditions)]
+            if held:
+                applied.append((max(self.states[o][1] for conditions in held for o, _ in conditions), 1, function, state))
+        for _, _, function, state in sorted(applied):
+            for led, color, behavior in self.rules['actions'].get((function, state), []):
+                if behavior == 'OFF': leds.pop(led, None)
+                else:
+                    previous=self.leds.get(led)
+                    lit=previous[2] if previous and previous[:2] == (color, behavior) else now
+                    leds[led]=(color, behavior, lit)
+        self.leds=leds
+
+    def set_state(self, function, state):
+        with self.lock:
+            self.changes+=1
+            self.states[function]=(state, time.time() + self.changes*1e-9, self.command)
+            self._update()
+
+    #states set until the next call belong to a new command line
+    def begin_command(self):
+        with self.lock:
+            self.command+=1
+
+    def restart(self):
+        with self.lock:
+            self.rules=self._rules()
+            self._update()
+
+    '''
+    Returns:
+    dict LED name -> (color, lit) at time t, lit is False for a blinking LED in its OFF phase
+    '''
+    def snapshot(self, t):
+        with self.lock:
+            leds=dict(self.leds)
+        result={}
+        for led, (color, behavior, since) in leds.items():
+            frequency={'FLASH_SLOW': au.FLASH_SLOW_FREQUENCY, 'FLASH_FAST': au.FLASH_FAST_FREQUENCY}.get(behavior, 0)
+            result[led]=(color, frequency == 0 or int((t-since)*frequency*2) % 2 == 0)
+        return result
+
+    def config_text(self):
+        with self.lock:
+            return format_uci(self.committed)
+
+'''
+Interprets the commands led_testing and gateway_util send to a gateway:
+'a && b || c ; d', '( ... )' groups, '<', '>' and '>&2' redirections,
+printf, echo, cat, md5sum, uci, ubus, db, uname, defaultreset and the peripheral manager.
+Args:
+board: LedBoard of the gateway
+'''
+class GatewayShell:
+    def __init__(self, board, hostname='sim-gateway'):
+        self.board=board
+        self.hostname=hostname
+        self.status=0
+
+    '''
+    Runs one command line
+    Args:
+    out, err: callables receiving str output
+    Returns:
+    exit status
+    '''
+    def run(self, line, out, err):
+        try:
+            lexer=shlex.shlex(line, posix=True, punctuation_chars=True)
+            lexer.whitespace_split=True
+            tokens=[str(self.status) if token == '$?' else token for token in lexer]
+        except ValueError as e:
+            err('sh: syntax error: {0}\n'.format(e))
+            self.status=2
+            return self.status
+        if tokens:
+            self.board.begin_command()
+            node, _ = self._parse_list(tokens, 0)
+            self.status=self._eval(node, out, err)
+        return self.status
+
+    def _parse_list(self, tokens, i):
+        items=[]
+        while i < len(tokens) and tokens[i] != ')':
+            node, i = self._parse_and_or(tokens, i)
+            items.append(node)
+            while i < len(tokens) and tokens[i] in (';', '&'): i+=1
+        return ('list', items), i
+
+    def _parse_and_or(self, tokens, i):
+        node, i = self._parse_command(tokens, i)
+        while i < len(tokens) and tokens[i] in ('&&', '||'):
+            right, j = self._parse_command(tokens, i+1)
+            node, i = (tokens[i], node, right), j
+        return node, i
+
+    def _parse_command(self, tokens, i):
+        if i < len(tokens) and tokens[i] == '(':
+            body, i = self._parse_list(tokens, i+1)
+            node=('group', body)
+            i+=1
+        else:
+            words=[]
+            while i < len(tokens) and tokens[i] not in ('&&', '||', ';', '&', '(', ')', '<', '>', '>&', '>>'):
+                words.append(tokens[i])
+                i+=1
+            node=('simple', words)
+        redirects=[]
+        while i+1 < len(tokens) and tokens[i] in ('<', '>', '>&', '>>'):
+            redirects.append((tokens[i], tokens[i+1]))
+            i+=2
+        return ('redirect', node, redirects), i
+
+    def _eval(self, node, out, err):
+        kind=node[0]
+        if kind == 'list':
+            status=0
+            for item in node[1]: status=self._eval(item, out, err)
+            return status
+        if kind == '&&':
+            status=self._eval(node[1], out, err)
+            return self._eval(node[2], out, err) if status == 0 else status
+        if kind == '||':
+            status=self._eval(node[1], out, err)
+            return self._eval(node[2], out, err) if status != 0 else status
+        if kind == 'redirect':
+            for op, target in node[2]:
+                if op == '>&' and target == '2': out=err
+                elif op in ('>', '>>'): out=lambda text: None
+            return self._eval(node[1], out, err)
+        if kind == 'group':
+            return self._eval(node[1], out, err)
+        return self._command(node[1], out, err)
+
+    def _command(self, words, out, err):
+        if not words: return 0
+        name, args = words[0], words[1:]
+        handler=getattr(self, '_cmd_' + os.path.basename(name).replace('-', '_'), None)
+        if name == ':' or name == 'true': return 0
+        if name == 'false': return 1
+        if handler is None:
+            err('sh: {0}: not found\n'.format(name))
+            return 127
+        return handler(args, out, err)
+
+    def _cmd_printf(self, args, out, err):
+        if not args: return 1
+        text=args[0].replace('\\n', '\n').replace('\\t', '\t')
+        values=[int(a) if a.lstrip('-').isdigit() else a for a in args[1:]]
+        out(text % tuple(values) if values else text)
+        return 0
+
+    def _cmd_echo(self, args, out, err):
+        out(' '.join(args) + '\n')
+        return 0
+
+    def _cmd_sleep(self, args, out, err):
+        time.sleep(float(args[0]) if args else 0)
+        return 0
+
+    def _file(self, path):
+        if path == HW_CONFIG_PATH: return self.board.config_text()
+        if path == '/proc/device-tree/model': return GATEWAY_MODEL
+        return None
+
+    def _cmd_cat(self, args, out, err):
+        status=0
+        for path in args:
+            text=self._file(path)
+            if text is None:
+                err('cat: can\'t open \'{0}\': No such file or directory\n'.format(path))
+                status=1
+            else: out(text)
+        return status
+
+    def _cmd_md5sum(self, args, out, err):
+        status=0
+        for path in args:
+            text=self._file(path)
+            if text is None:
+                err('md5sum: {0}: No such file or directory\n'.format(path))
+                status=1
+            else: out('{0}  {1}\n'.format(hashlib.md5(text.encode()).hexdigest(), path))
+        return status
+
+    def _cmd_uname(self, args, out, err):
+        out(self.hostname + '\n')
+        return 0
+
+    def _cmd_db(self, args, out, err):
+        args=[a for a in args if a != '-q']
+        if args[:2] == ['get', 'hw.board.hardware']:
+            out(GATEWAY_MODEL + '\n')
+            return 0
+        return 1
+
+    def _cmd_defaultreset(self, args, out, err):
+        self.board.reset()
+        return 0
+
+    def _cmd_peripheral_manager(self, args, out, err):
+        if args and args[0] in ('restart', 'reload', 'start'): self.board.restart()
+        return 0
+
+    def _cmd_ubus(self, args, out, err):
+        if len(args) < 3 or args[0] != 'call' or not args[1].startswith('led.'):
+            err('Command failed: Not found\n')
+            return 4
+        function=args[1][len('led.'):]
+        if args[2] == 'set':
+            try: state=json.loads(args[3])['state']
+            except (IndexError, ValueError, KeyError):
+                err('Command failed: Invalid argument\n')
+                return 2
+            self.board.set_state(function, state)
+            return 0
+        if args[2] == 'status':
+            with self.board.lock: state=self.board.states.get(function, ('off',))[0]
+            out(json.dumps({'state': state}, indent='\t') + '\n')
+            return 0
+        err('Command failed: Method not found\n')
+        return 4
+
+    def _cmd_uci(self, args, out, err):
+        i=0
+        while i < len(args) and args[i].startswith('-'):
+            i+=2 if args[i] in ('-c', '-p') else 1
+        if i >= len(args): return 1
+        command, params = args[i], args[i+1:]
+        board=self.board
+        with board.lock:
+            if command == 'commit':
+                if board.staged is not None: board.committed, board.staged = board.staged, None
+                return 0
+            if command == 'revert':
+                board.staged=None
+                return 0
+            sections=board.staged if board.staged is not None else board.committed
+            if command in ('get', 'show'):
+                path=(params[0] if params else 'hw').split('.')
+                section=next((s for s in sections if s['name'] == path[1]), None) if len(path) > 1 else None
+                if section is None:
+                    err('uci: Entry not found\n')
+                    return 1
+                if len(path) == 2:
+                    out(section['type'] + '\n')
+                else:
+                    values=[value for _, key, value in section['options'] if key == path[2]]
+                    if not values:
+                        err('uci: Entry not found\n')
+                        return 1
+                    out(' '.join(values) + '\n')
+                return 0
+            if not params or '=' not in params[0]:
+                err('uci: Invalid argument\n')
+                return 1
+            path, value = params[0].split('=', 1)
+            path=path.split('.')
+            staged=copy.deepcopy(sections)
+            section=next((s for s in staged if len(path) > 1 and s['name'] == path[1]), None)
+            if section is None:
+                err('uci: Entry not found\n')
+                return 1
+            if command == 'rename' and len(path) == 2:
+                section['name']=value
+            elif command == 'add_list' and len(path) == 3:
+                section['options'].append(['list', path[2], value])
+            elif command == 'del_list' and len(path) == 3:
+                section['options']=[o for o in section['options'] if o[1:] != [path[2], value]]
+            elif command == 'set' and len(path) == 3:
+                section['options']=[o for o in section['options'] if o[1] != path[2]] + [['option', path[2], value]]
+            else:
+                err('uci: Invalid argument\n')
+                return 1
+            board.staged=staged
+        return 0
+
+class _SSHServer(paramiko.ServerInterface):
+    def __init__(self, gateway):
+        self.gateway=gateway
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (self.gateway.username, self.gateway.password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session': return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.gateway.serve_exec, args=(channel, command.decode()), name='gateway-exec', daemon=True).start()
+        return True
+
+'''
+Local SSH server acting as a gateway: it answers the commands of led_testing
+against an in-memory hw config and drives a LedBoard
+Args:
+board: LedBoard shown by the simulated camera
+port: listening port on 127.0.0.1, 0 for any free port
+host_key: paramiko key of the server, generated if not given
+'''
+class GatewaySimulator:
+    def __init__(self, board, port=0, username='admin', password='admin', host_key=None):
+        self.board=board
+        self.username=username
+        self.password=password
+        self.host_key=host_key or paramiko.RSAKey.generate(2048)
+        self.sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(64)
+        self.port=self.sock.getsockname()[1]
+        self.transports=[]
+        self.running=True
+        self.thread=threading.Thread(target=self._accept, name='gateway-accept', daemon=True)
+        self.thread.start()
+
+    def _accept(self):
+        while self.running:
+            try: client, _ = self.sock.accept()
+            except OSError: return
+            transport=paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            try: transport.start_server(server=_SSHServer(self))
+            except (paramiko.SSHException, EOFError, OSError): continue
+            self.transports=[t for t in self.transports if t.is_active()] + [transport]
+
+    def serve_exec(self, channel, command):
+        shell=GatewayShell(self.board)
+        out=lambda text: channel.sendall(text.encode())
+        err=lambda text: channel.sendall_stderr(text.encode())
+        try:
+            if command.strip() in ('sh', '/bin/sh'):
+                #persistent shell: run every line as it arrives
+                buffer=b''
+                while True:
+                    data=channel.recv(65536)
+                    if not data: break
+                    buffer+=data
+                    while b'\n' in buffer:
+                        line, buffer = buffer.split(b'\n', 1)
+                        shell.run(line.decode(errors='replace'), out, err)
+                status=shell.status
+            else:
+                status=shell.run(command, out, err)
+            channel.send_exit_status(status)
+            channel.shutdown_write()
+            #the reply to the exec request is sent after check_channel_exec_request returns,
+            #closing the channel before it would fail the request on the client
+            time.sleep(EXEC_CLOSE_DELAY)
+        except OSError:
+            pass
+        finally:
+            channel.close()
+
+    def close(self):
+        self.running=False
+        self.sock.close()
+        for transport in self.transports: transport.close()
+
+'''
+Local HTTP server acting as an IP camera: snapshots, an MJPEG stream and the
+cgi settings interface used by camera_util. The picture shows a display with
+the five LEDs of a LedBoard, blinking as their behaviors require.
+Args:
+board: LedBoard to show
+port: listening port on 127.0.0.1, 0 for any free port
+size: (height, width) of the camera picture, the test uses its central 640x640 part
+fps: frame rate of the stream
+'''
+class CameraSimulator:
+    #LED names from left to right
+    LEDS=['status', 'uplink', 'internet', 'voice', 'wireless']
+    DEFAULT_SETTINGS={'VIDEO': {'saturation': '4', 'sharpness': '7', 'exposure': '4', 'contrast': '4', 'dn_sch': '1'},
+        'H264': {'quality_level': '3', 'gov_length': '30', 'resolution': '3', 'profile': '77'}}
+
+    def __init__(self, board, port=0, size=(704, 704), fps=30):
+        self.board=board
+        self.size=size
+        self.fps=fps
+        self.settings=copy.deepcopy(self.DEFAULT_SETTINGS)
+        #time of the last settings change, the exposure converges after it
+        self.adjusted=0.0
+        self.lock=threading.Lock()
+        self._render_background()
+        simulator=self
+        class Handler(CameraHandler):
+            camera=simulator
+        self.server=ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.port=self.server.server_address[1]
+        self.thread=threading.Thread(target=self.server.serve_forever, name='camera-server', daemon=True)
+        self.thread.start()
+
+    @property
+    def host(self):
+        return '127.0.0.1:{0}'.format(self.port)
+
+    def _render_background(self):
+        h, w = self.size
+        rng=np.random.default_rng(0)
+        self.background=(rng.normal(0, 2, (h, w, 3)) + [70, 72, 68]).clip(0, 255).astype(np.float32)
+        #the gateway front with the LED display in the middle
+        cy, cx = h//2, w//2
+        self.background[cy-60:cy+60, cx-200:cx+200]=[40, 41, 39]
+        #LED boxes (y_UL, x_UL, y_BR, x_BR) in the picture
+        self.boxes=[(cy-10, cx-150+75*i-10, cy+10, cx-150+75*i+10) for i in range(5)]
+        y, x = np.mgrid[-15:15, -15:15]
+        self.light=np.clip(1.0-(np.hypot(y, x)-6)/6, 0, 1)[..., None].astype(np.float32)
+
+    '''Returns the camera picture at time t'''
+    def render(self, t=None):
+        t=time.time() if t is None else t
+        frame=self.background.copy()
+        for name, (color, lit) in self.board.snapshot(t).items():
+            if not lit or name not in self.LEDS: continue
+            y_UL, x_UL, y_BR, x_BR = self.boxes[self.LEDS.index(name)]
+            cy, cx = (y_UL+y_BR)//2, (x_UL+x_BR)//2
+            area=frame[cy-15:cy+15, cx-15:cx+15]
+            area[:]=area*(1-self.light) + np.array(sy.LED_COLORS[color], dtype=np.float32)*self.light
+        gain=1+EXPOSURE_OVERSHOOT*np.exp(-max(0, t-self.adjusted)/EXPOSURE_TIME_CONSTANT)
+        if gain > 1.001: frame*=gain
+        return frame.clip(0, 255).astype(np.uint8)
+
+    def jpeg(self, t=None):
+        ok, buffer = cv2.imencode('.jpg', self.render(t), [cv2.IMWRITE_JPEG_QUALITY, 90])
+        return buffer.tobytes()
+
+    '''LED boxes in the central crop of the given size, in the format of DisplayLedsSchemeModel.detect'''
+    def leds(self, crop_width=640, crop_height=640):
+        h_offset, w_offset = (self.size[0]-crop_height)//2, (self.size[1]-crop_width)//2
+        return [{'class': i, 'box': np.array([y_UL-h_offset, x_UL-w_offset, y_BR-h_offset, x_BR-w_offset], dtype=np.float32), 'score': 1.0}
+            for i, (y_UL, x_UL, y_BR, x_BR) in enumerate(self.boxes)]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads=True
+    allow_reuse_address=True
+
+class CameraHandler(http.server.BaseHTTPRequestHandler):
+    camera=None
+    protocol_version='HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug('camera {0}: {1}'.format(self.camera.port, format % args))
+
+    def _reply(self, body, content_type='text/plain'):
+        body=body.encode() if isinstance(body, str) else body
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url=urllib.parse.urlparse(self.path)
+        params=dict(urllib.parse.parse_qsl(url.query))
+        camera=self.camera
+        if url.path == '/img/snapshot.cgi':
+            return self._reply(camera.jpeg(), 'image/jpeg')
+        if url.path == '/img/video.mjpg':
+            return self._stream()
+        if url.path == '/io/query_filter.cgi':
+            with camera.lock: night=camera.settings['VIDEO']['dn_sch'] == '3'
+            return self._reply('filter={0}\r\n'.format(int(night)))
+        if url.path == '/adm/get_group.cgi':
+            with camera.lock: values=dict(camera.settings.get(params.get('group', ''), {}))
+            return self._reply('[{0}]\n'.format(params.get('group', '')) + ''.join('{0}={1}\n'.format(k, v) for k, v in values.items()))
+        if url.path == '/adm/set_group.cgi':
+            group=params.pop('group', '')
+            with camera.lock:
+                camera.settings.setdefault(group, {}).update(params)
+                camera.adjusted=time.time()
+            return self._reply('OK\n')
+        if url.path == '/adm/reset_to_default.cgi':
+            with camera.lock:
+                camera.settings=copy.deepcopy(camera.DEFAULT_SETTINGS)
+                camera.adjusted=time.time()
+            return self._reply('OK\n')
+        self.send_error(404)
+
+    def _stream(self):
+        self.close_connection=True
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+        self.end_headers()
+        #a slow client gets fewer but current frames instead of a growing backlog in the socket buffers
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, STREAM_SEND_BUFFER)
+        interval=1.0/self.camera.fps
+        next_frame=time.time()
+        try:
+            while True:
+                jpeg=self.camera.jpeg()
+                self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n')
+                next_frame=max(next_frame+interval, time.time())
+                time.sleep(max(0, next_frame-time.time()))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+'''
+A simulated gateway with its camera
+'''
+class SimulatedDevice:
+    def __init__(self, name, camera_port=0, ssh_port=0, host_key=None, hw_config=DEFAULT_HW_CONFIG):
+        self.name=name
+        self.board=LedBoard(hw_config)
+        self.gateway=GatewaySimulator(self.board, ssh_port, host_key=host_key)
+        self.camera=CameraSimulator(self.board, camera_port)
+
+    def inventory_entry(self):
+        return {'name': self.name, 'gateway_ip': '127.0.0.1', 'port': self.gateway.port,
+            'gateway_user': self.gateway.username, 'password': self.gateway.password, 'camera_ip': self.camera.host}
+
+    '''
+    Stores the LED geometry of the simulated camera, so that led_testing -c
+    runs without the detector models
+    '''
+    def seed_calibration(self, store):
+        reference=self.camera.render()
+        h_offset, w_offset = (reference.shape[0]-640)//2, (reference.shape[1]-640)//2
+        store.save(self.camera.host, GATEWAY_MODEL, self.camera.leds(), False, reference[h_offset:h_offset+640, w_offset:w_offset+640])
+
+    def close(self):
+        self.camera.close()
+        self.gateway.close()
+
+def main(argv):
+    arg_parser=argparse.ArgumentParser(description='run simulated gateways and cameras for load tests of led_testing.py and led_farm.py')
+    arg_parser.add_argument('-n', '--devices', type=int, default=1, help='number of simulated gateway/camera pairs (default 1)')
+    arg_parser.add_argument('--camera-port', type=int, default=8100, help='port of the first camera (default 8100)')
+    arg_parser.add_argument('--ssh-port', type=int, default=2300, help='port of the first gateway (default 2300)')
+    arg_parser.add_argument('--hw-config', help='hw config file of the gateways (default: a Pure ed500 like config)')
+    arg_parser.add_argument('-o', '--inventory', default='simulated_inventory.json', help='led_farm inventory to write')
+    arg_parser.add_argument('-c', '--seed-calibration', action='store_true', help='store the LED geometry for led_testing.py -c')
+    arg_parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
+    args=arg_parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(asctime)s [%(levelname)-5.5s]  %(message)s")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+    hw_config=DEFAULT_HW_CONFIG
+    if args.hw_config:
+        with open(args.hw_config) as f: hw_config=f.read()
+
+    host_key=paramiko.RSAKey.generate(2048)
+    devices=[SimulatedDevice('sim{0}'.format(i), args.camera_port+i, args.ssh_port+i, host_key, hw_config) for i in range(args.devices)]
+    if args.seed_calibration:
+        store=calibration.CalibrationStore()
+        for device in devices: device.seed_calibration(store)
+    with open(args.inventory, 'w') as f:
+        json.dump([device.inventory_entry() for device in devices], f, indent=2)
+    logging.info('{0} simulated devices, inventory written to {1}'.format(len(devices), args.inventory))
+    logging.info('run the tests with: LED_CAMERA_VIDEO_URL=\'{0}\' python led_farm.py {1} -- -c -s'.format(VIDEO_URL_FORMAT, args.inventory))
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    for device in devices: device.close()
+
+if __name__ == "__main__":
+    main(sys.argv)
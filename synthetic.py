@@ -0,0 +1,124 @@
+import numpy as np
+
+#BGR colors of a lit LED as seen by the camera in day mode
+LED_COLORS={'green': (70, 230, 40), 'orange': (0, 110, 255), 'red': (80, 10, 230)}
+#ON/OFF cycles per second of the LED behaviors of the hw config
+BEHAVIOR_FREQUENCIES={'CONSTANT': 0.0, 'FLASH_SLOW': 0.67, 'FLASH_FAST': 2.3}
+#names used by the hw config
+LED_NAMES=['status', 'broadband', 'internet', 'wireless', 'voice']
+BEHAVIORS=['ON', 'OFF', 'FLASH_SLOW', 'FLASH_FAST']
+COLORS=['green', 'orange', 'red']
+
+'''
+Generates a clip of one LED, as cut by the test from the camera stream
+Args:
+color: 'green', 'orange', 'red' or None for a LED that stays off
+frequency: ON/OFF cycles per second, 0 for a constantly lit LED
+roi: (height, width) of the clip
+fps: frame rate
+duration: clip length in seconds
+noise: standard deviation of the sensor noise
+night: 1 or 0. In night mode the IR light makes the picture brighter and less saturated
+phase: time of the first frame within the blink period, in seconds
+seed: random seed
+Returns:
+(frames, off, timestamps): list of (h,w,3) uint8 frames, the frame of the switched off LED,
+and the capture times of the frames
+'''
+def led_clip(color, frequency=0.0, roi=(45, 45), fps=30, duration=5.6, noise=3.0, night=0, phase=0.0, seed=0):
+    rng=np.random.default_rng(seed)
+    h, w = roi
+    #housing of the gateway with a little texture
+    background=np.array([60, 62, 58] if not night else [95, 95, 95], dtype=np.float32)
+    off=background + rng.normal(0, 2, (h, w, 3)).astype(np.float32)
+
+    #LED light: a bright disc with a soft glow around it
+    y, x = np.mgrid[0:h, 0:w]
+    r=np.hypot(y-(h-1)/2, x-(w-1)/2)
+    radius=min(h, w)/6
+    light=np.clip(1.0-(r-radius)/radius, 0, 1)[..., None].astype(np.float32)
+    led=off.copy()
+    if color is not None:
+        led_color=np.array(LED_COLORS[color], dtype=np.float32)
+        if night:
+            #IR light washes the colors out
+            led_color=0.7*led_color + 0.3*led_color.mean()
+        led=off*(1-light) + led_color*light
+
+    timestamps=np.arange(int(round(duration*fps)))/fps
+    if frequency > 0: lit=((timestamps+phase)*frequency*2).astype(int) % 2 == 0
+    else: lit=np.full(len(timestamps), color is not None)
+    frames=[]
+    for t in range(len(timestamps)):
+        frame=(led if lit[t] else off) + rng.normal(0, noise, (h, w, 3)).astype(np.float32)
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return frames, np.clip(off, 0, 255).astype(np.uint8), list(timestamps + 1.0)
+
+'''
+Expected (color, behavior) decision of the test for a generated clip
+'''
+def expected_behavior(color, frequency):
+    if color is None: return ('off', 'CONSTANT')
+    for behavior, behavior_frequency in BEHAVIOR_FREQUENCIES.items():
+        if behavior_frequency == frequency: return (color, behavior)
+    raise ValueError('No behavior with frequency {0}'.format(frequency))
+
+'''
+Generates raw detections of the LED scheme model for a display with 5 LEDs in random order
+Args:
+vertical: orientation of the display
+Returns:
+(detections, order): detections dict as returned by get_detections and
+the classes in the order sort_leds has to return them
+'''
+def led_detections(vertical=False, seed=0):
+    rng=np.random.default_rng(seed)
+    start=rng.uniform(0.1, 0.3)
+    across=rng.uniform(0.3, 0.6)
+    boxes=[]
+    for i in range(5):
+        along=start + 0.1*i
+        box=[along, across, along+0.05, across+0.05] if vertical else [across, along, across+0.05, along+0.05]
+        boxes.append(box)
+    classes=rng.permutation(5)
+    order=rng.permutation(5)
+    detections={'detection_boxes': np.array([boxes[i] for i in order], dtype=np.float32),
+        'detection_classes': classes[order],
+        'detection_scores': np.sort(rng.uniform(0.5, 1.0, 5))[::-1].astype(np.float32)}
+    return detections, list(classes)
+
+'''
+Generates /lib/db/config/hw with the given number of functions
+Args:
+functions: number of LED functions
+Returns:
+(config, expected): config lines and the expected records
+    as a list of (objects, states, LED, color, behavior)
+'''
+def hw_config(functions, seed=0):
+    rng=np.random.default_rng(seed)
+    names=['func' + str(i) for i in range(functions)]
+    config=['config led_map \'led_map\'\n']
+    config+=['\tlist functions \'' + name + '\'\n' for name in names]
+    expected=[]
+    for i, name in enumerate(names):
+        config+=['\n', 'config led_map \'led_' + name + '\'\n']
+        actions=[]
+        for state in ['ok', 'error', 'notice', 'off'][:rng.integers(2, 5)]:
+            LED=LED_NAMES[rng.integers(len(LED_NAMES))]
+            color=COLORS[rng.integers(len(COLORS))]
+            behavior='OFF' if state == 'off' else BEHAVIORS[rng.integers(len(BEHAVIORS))]
+            config.append('\tlist led_action_' + state + ' \'' + LED + '_' + color + ' = ' + behavior + '\'\n')
+            actions.append((state, LED, color, behavior))
+        #super functions combine this function with another one and replace its record
+        supers={}
+        if i > 0 and rng.random() < 0.3:
+            state=actions[0][0]
+            other=names[rng.integers(i)]
+            supers[state]=([name + '_test', other + '_test'], [state, 'ok'])
+            config.append('\tlist super_' + state + ' \'' + name + '_' + state + ', ' + other + '_ok\'\n')
+        for state, LED, color, behavior in actions:
+            if state not in supers: expected.append(([name + '_test'], [state], LED, color, behavior))
+        for state, LED, color, behavior in actions:
+            if state in supers: expected.append(supers[state] + (LED, color, behavior))
+    return config, expected
@@ -0,0 +1,141 @@
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+
+import numpy as np
+
+'''
+Collects durations of named stages of a test run. Spans are cheap enough to stay
+enabled all the time: one perf_counter pair and a locked list append each.
+Stage names are dotted, 'module.step', e.g. 'gateway.command' or 'camera.capture'.
+'''
+class Timings:
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.durations={}
+        #stages that run under cProfile, see profile_stages
+        self.profiled=set()
+        self.profiles=[]
+        self.local=threading.local()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    '''
+    Measures the duration of the with block as one span of stage
+    '''
+    @contextlib.contextmanager
+    def span(self, stage):
+        profiler=self._start_profiler() if stage in self.profiled else None
+        start=time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter()-start)
+            if profiler is not None: self._stop_profiler()
+
+    '''Decorator measuring every call of a function as a span of stage'''
+    def timed(self, stage):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    '''
+    Runs the given stages under cProfile, one profiler per thread
+    Args:
+    stages: iterable of stage names, e.g. ['analysis']
+    '''
+    def profile_stages(self, stages):
+        self.profiled=set(stages)
+
+    def _start_profiler(self):
+        #spans of profiled stages may nest, only the outermost one switches the profiler
+        depth=getattr(self.local, 'depth', 0)
+        self.local.depth=depth+1
+        if depth == 0:
+            if getattr(self.local, 'profiler', None) is None:
+                self.local.profiler=cProfile.Profile()
+                with self.lock: self.profiles.append(self.local.profiler)
+            self.local.profiler.enable()
+        return self.local.profiler
+
+    def _stop_profiler(self):
+        self.local.depth-=1
+        if self.local.depth == 0: self.local.profiler.disable()
+
+    '''Writes the merged cProfile statistics of the profiled stages, returns False if there are none'''
+    def dump_profile(self, path):
+        with self.lock: profiles=list(self.profiles)
+        if not profiles: return False
+        stats=pstats.Stats(profiles[0])
+        for profile in profiles[1:]: stats.add(profile)
+        stats.dump_stats(path)
+        return True
+
+    '''
+    Returns:
+    dict stage -> count, total, mean, p50, p95, max in seconds
+    '''
+    def summary(self):
+        with self.lock:
+            durations={stage: list(values) for stage, values in self.durations.items()}
+        summary={}
+        for stage, values in sorted(durations.items()):
+            values=np.array(values)
+            summary[stage]={'count': len(values), 'total': float(values.sum()), 'mean': float(values.mean()),
+                'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+        return summary
+
+    '''
+    Writes the timing profile of the run as JSON
+    Args:
+    info: dict of run information stored next to the stages (e.g. gateway, result)
+    '''
+    def write_json(self, path, info=None):
+        atomic_write(path, json.dumps({'info': info or {}, 'stages': self.summary()}, indent=2))
+
+    '''
+    Writes the stages in the Prometheus text format, for the node_exporter textfile collector
+    Args:
+    labels: dict of labels added to every sample (e.g. gateway, camera)
+    '''
+    def write_prometheus(self, path, labels=None, prefix='led_test'):
+        base=''.join(',{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted((labels or {}).items()))
+        lines=['# HELP {0}_stage_seconds Duration of test stages'.format(prefix),
+            '# TYPE {0}_stage_seconds summary'.format(prefix)]
+        for stage, s in self.summary().items():
+            for quantile, key in (('0.5', 'p50'), ('0.95', 'p95')):
+                lines.append('{0}_stage_seconds{{stage="{1}",quantile="{2}"{3}}} {4:.6f}'.format(prefix, stage, quantile, base, s[key]))
+            lines.append('{0}_stage_seconds_sum{{stage="{1}"{2}}} {3:.6f}'.format(prefix, stage, base, s['total']))
+            lines.append('{0}_stage_seconds_count{{stage="{1}"{2}}} {3}'.format(prefix, stage, base, s['count']))
+        lines.append('# HELP {0}_last_run_timestamp_seconds End of the last run'.format(prefix))
+        lines.append('# TYPE {0}_last_run_timestamp_seconds gauge'.format(prefix))
+        lines.append('{0}_last_run_timestamp_seconds{{{1}}} {2:.0f}'.format(prefix, base[1:], time.time()))
+        atomic_write(path, '\n'.join(lines) + '\n')
+
+    def reset(self):
+        with self.lock:
+            self.durations={}
+            self.profiles=[]
+        self.local=threading.local()
+
+#the collector can only read whole files
+def atomic_write(path, text):
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+#timings of the current process, used by all modules
+TIMINGS=Timings()
+span=TIMINGS.span
+timed=TIMINGS.timed